@@ -0,0 +1,23 @@
+from pyrrent.bencoding import encode, decode
+
+from benchmarks.common import measure, result
+from benchmarks.synthetic import make_metafile, make_tracker_reply
+
+
+def run(scale):
+    results = []
+
+    for piece_count, file_count in scale['metafiles']:
+        encoded = make_metafile(piece_count, file_count)
+        decoded = decode(encoded)
+        params = {'pieces': piece_count, 'files': file_count, 'bytes': len(encoded)}
+        results.append(result('bencoding', 'decode_metafile', params, measure(lambda: decode(encoded), scale['repeat'])))
+        results.append(result('bencoding', 'encode_metafile', params, measure(lambda: encode(decoded), scale['repeat'])))
+
+    for peer_count in scale['tracker_peers']:
+        reply = make_tracker_reply(peer_count)
+        params = {'peers': peer_count, 'bytes': len(reply)}
+        results.append(result('bencoding', 'decode_tracker_reply', params,
+                              measure(lambda: decode(reply), scale['repeat'], number=10)))
+
+    return results
@@ -0,0 +1,28 @@
+from pyrrent.utils import Cache
+
+from benchmarks.common import measure, result
+from benchmarks.synthetic import zipf_keys
+
+
+def run(scale):
+    results = []
+    keys = zipf_keys(scale['cache_keys'], scale['cache_accesses'])
+
+    for capacity in scale['cache_capacities']:
+        hits = 0
+
+        def access_all():
+            nonlocal hits
+            cache = Cache(capacity)
+            hits = 0
+            for key in keys:
+                if cache.get(key) is None:
+                    cache.put(key, key)
+                else:
+                    hits += 1
+
+        timings = measure(access_all, scale['repeat'])
+        params = {'capacity': capacity, 'keys': scale['cache_keys'], 'accesses': len(keys)}
+        results.append(result('cache', 'zipf_access', params, timings, hit_ratio=hits / len(keys)))
+
+    return results
@@ -0,0 +1,88 @@
+# Simulates a large swarm and measures cost of rate accounting and choking rounds.
+# Run with: python -m benchmarks.bench_choking [peer_count] [rounds]
+import random
+import sys
+import time
+
+from pyrrent.choking import Choker
+
+from benchmarks.common import result
+
+
+class _SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def simulate(peer_count=5000, rounds=30, blocks_per_peer_per_round=10, block_size=16384):
+    random.seed(0)
+    clock = _SimulatedClock()
+    choker = Choker(clock=clock)
+    peer_speeds = [random.paretovariate(1.5) for _ in range(peer_count)]
+
+    for peer in range(peer_count):
+        choker.add_peer(peer)
+        choker.set_interested(peer, random.random() < 0.8)
+
+    accounting_time = 0
+    round_time = 0
+    stable_rounds = 0
+    previous_regular = set()
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for second in range(10):
+            clock.now += 1
+            for peer, speed in enumerate(peer_speeds):
+                blocks = int(speed * blocks_per_peer_per_round / 10)
+                if blocks:
+                    choker.record_download(peer, blocks * block_size)
+        accounting_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        choker.run_round()
+        round_time += time.perf_counter() - start
+
+        regular = choker.unchoked - {choker.optimistic_peer}
+        if regular == previous_regular:
+            stable_rounds += 1
+        previous_regular = regular
+
+    accounting_ops = sum(1 for speed in peer_speeds if int(speed * blocks_per_peer_per_round / 10)) * 10 * rounds
+    return {
+        'peer_count': peer_count,
+        'rounds': rounds,
+        'round_ms': round_time / rounds * 1000,
+        'record_ns': accounting_time / max(accounting_ops, 1) * 1e9,
+        'stable_rounds': stable_rounds,
+    }
+
+
+def run(scale):
+    results = []
+
+    for peer_count in scale['choking_peers']:
+        simulation = simulate(peer_count, scale['choking_rounds'])
+        # Round duration is the tracked timing, accounting cost is reported alongside
+        round_seconds = simulation['round_ms'] / 1000
+        timings = {'min': round_seconds, 'median': round_seconds, 'mean': round_seconds}
+        results.append(result('choking', 'round', {'peers': peer_count, 'rounds': simulation['rounds']},
+                              timings, record_ns=simulation['record_ns']))
+
+    return results
+
+
+def main():
+    peer_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    result = simulate(peer_count, rounds)
+    print(f'Peers: {result["peer_count"]}. Rounds: {result["rounds"]}. '
+          f'Choking round: {result["round_ms"]:.2f} ms. Rate record: {result["record_ns"]:.0f} ns. '
+          f'Rounds with unchanged regular slots: {result["stable_rounds"]}')
+
+
+if __name__ == '__main__':
+    main()
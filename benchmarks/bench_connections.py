@@ -0,0 +1,66 @@
+import asyncio
+
+from pyrrent.connections import ConnectionManager, encode_handshake, HANDSHAKE_LENGTH
+from pyrrent.peers import PeerStore
+
+from benchmarks.common import measure, result
+
+
+_INFO_HASH = b'\x01' * 20
+
+
+# Time from registering a torrent with freshly announced peers until all of them are connected.
+# Every peer is a distinct loopback address served by the same listener
+def run(scale):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = []
+    writers = []
+
+    async def handle_peer(reader, writer):
+        writers.append(writer)
+        try:
+            await reader.readexactly(HANDSHAKE_LENGTH)
+            writer.write(encode_handshake(_INFO_HASH, b'-BE0001-000000000000'))
+            await reader.read()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = loop.run_until_complete(asyncio.start_server(handle_peer, host='0.0.0.0', port=0))
+    port = server.sockets[0].getsockname()[1]
+
+    try:
+        for peer_count in scale['connection_peers']:
+            peers = [(f'127.0.{i // 250}.{i % 250 + 1}', port) for i in range(peer_count)]
+
+            for max_half_open in scale['connection_half_open']:
+                def ramp_up():
+                    manager = ConnectionManager(b'-PY0001-000000000000', max_connections=peer_count,
+                                                max_connections_per_torrent=peer_count,
+                                                max_half_open=max_half_open, loop=loop)
+                    peer_store = PeerStore()
+                    peer_store.add(peers)
+                    manager.register(_INFO_HASH, peer_store)
+                    loop.run_until_complete(_wait_for_connections(manager, peer_count))
+                    manager.stop()
+                    loop.run_until_complete(asyncio.sleep(0))
+
+                timings = measure(ramp_up, scale['repeat'])
+                params = {'peers': peer_count, 'half_open': max_half_open}
+                results.append(result('connections', 'ramp_up', params, timings,
+                                      connections_per_second=peer_count / timings['median']))
+    finally:
+        server.close()
+        for writer in writers:
+            writer.close()
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+
+    return results
+
+
+async def _wait_for_connections(manager, count):
+    while manager.connection_count < count:
+        await asyncio.sleep(0.001)
@@ -0,0 +1,34 @@
+import os
+import tempfile
+
+from pyrrent.metafile import Metafile
+from pyrrent.metafile_index import MetafileIndex
+
+from benchmarks.common import measure, result
+from benchmarks.synthetic import make_metafile
+
+
+def run(scale):
+    results = []
+
+    for piece_count, file_count in scale['metafiles']:
+        encoded = make_metafile(piece_count, file_count)
+        params = {'pieces': piece_count, 'files': file_count}
+        results.append(result('metafile', 'parse', params, measure(lambda: Metafile.parse(encoded), scale['repeat'])))
+
+        with tempfile.TemporaryDirectory() as path:
+            metafile_path = os.path.join(path, 'synthetic.torrent')
+            with open(metafile_path, 'wb') as f:
+                f.write(encoded)
+            index = MetafileIndex.open(os.path.join(path, 'index'))
+            index.load(metafile_path)
+            index.close()
+
+            def indexed_load():
+                index = MetafileIndex.open(os.path.join(path, 'index'))
+                index.load(metafile_path)
+                index.close()
+
+            results.append(result('metafile', 'indexed_load', params, measure(indexed_load, scale['repeat'])))
+
+    return results
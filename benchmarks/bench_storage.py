@@ -0,0 +1,90 @@
+import asyncio
+import os
+import shutil
+import tempfile
+
+from pyrrent.metafile import FileInfo
+from pyrrent.storage import Storage
+
+from benchmarks.common import measure, result
+
+
+async def _gather(coroutines):
+    await asyncio.gather(*coroutines)
+
+
+def _storage_locations(disk_path):
+    locations = []
+    if os.path.isdir('/dev/shm'):
+        locations.append(('tmpfs', '/dev/shm'))
+    locations.append(('disk', disk_path or tempfile.gettempdir()))
+    return locations
+
+
+def run(scale, disk_path=None):
+    results = []
+    loop = asyncio.new_event_loop()
+    piece_count = scale['storage_pieces']
+    piece_length = scale['storage_piece_length']
+    data = os.urandom(piece_length)
+
+    try:
+        for location_name, location in _storage_locations(disk_path):
+            base_path = tempfile.mkdtemp(prefix='pyrrent-bench-', dir=location)
+            try:
+                storage = Storage.prepare(base_path)
+                params = {'location': location_name, 'pieces': piece_count, 'piece_length': piece_length}
+                handlers = []
+
+                def store_all():
+                    # Fresh handler every time, so pieces are written and not overwritten in page cache only
+                    # Single record cache, so retrieve below measures reads rather than cache hits
+                    handler = storage.create_handler_for_download(f'store{len(handlers)}', cache_size=1, loop=loop)
+                    handlers.append(handler)
+                    loop.run_until_complete(_gather(handler.store(i, data) for i in range(piece_count)))
+
+                timings = measure(store_all, scale['repeat'])
+                results.append(result('storage', 'store', params, timings,
+                                      bytes_per_second=piece_count * piece_length / timings['median']))
+
+                handler = handlers[-1]
+
+                def retrieve_all():
+                    loop.run_until_complete(_gather(handler.retrieve(i) for i in range(piece_count)))
+
+                timings = measure(retrieve_all, scale['repeat'])
+                results.append(result('storage', 'retrieve', params, timings,
+                                      bytes_per_second=piece_count * piece_length / timings['median']))
+
+                total_length = piece_count * piece_length
+                file_count = scale['storage_files']
+                file_infos = [FileInfo(f'composed/file{i}', total_length // file_count) for i in range(file_count - 1)]
+                file_infos.append(FileInfo(f'composed/file{file_count - 1}',
+                                           total_length - sum(f.length for f in file_infos)))
+
+                timings = measure(lambda: loop.run_until_complete(handler.compose_files(file_infos, piece_length)),
+                                  scale['repeat'])
+                results.append(result('storage', 'compose', dict(params, files=file_count), timings,
+                                      bytes_per_second=total_length / timings['median']))
+
+                # Small blocks at high concurrency, where per-operation overhead dominates over I/O
+                small_handler = storage.create_handler_for_download('small', cache_size=1, loop=loop)
+                small_data = data[:1024]
+                op_count = scale['storage_small_ops']
+                small_params = {'location': location_name, 'operations': op_count, 'block_length': len(small_data)}
+
+                timings = measure(lambda: loop.run_until_complete(
+                    _gather(small_handler.store(i % 512, small_data) for i in range(op_count))), scale['repeat'])
+                results.append(result('storage', 'store_small', small_params, timings,
+                                      operations_per_second=op_count / timings['median']))
+
+                timings = measure(lambda: loop.run_until_complete(
+                    _gather(small_handler.retrieve(i % 512) for i in range(op_count))), scale['repeat'])
+                results.append(result('storage', 'retrieve_small', small_params, timings,
+                                      operations_per_second=op_count / timings['median']))
+            finally:
+                shutil.rmtree(base_path, ignore_errors=True)
+    finally:
+        loop.close()
+
+    return results
@@ -0,0 +1,33 @@
+import statistics
+import time
+
+
+def measure(func, repeat=5, number=1):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.mean(timings),
+    }
+
+
+def result(suite, name, params, timings, **extra):
+    entry = {
+        'suite': suite,
+        'name': name,
+        'params': params,
+        'seconds': timings,
+    }
+    entry.update(extra)
+    return entry
+
+
+def result_key(entry):
+    params = ','.join(f'{k}={v}' for k, v in sorted(entry['params'].items()))
+    return f'{entry["suite"]}.{entry["name"]}[{params}]'
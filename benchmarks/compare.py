@@ -0,0 +1,56 @@
+# Compares two result files of benchmarks.run by median time.
+# Run with: python -m benchmarks.compare base.json new.json [--threshold 0.1]
+import argparse
+import json
+import sys
+
+from benchmarks.common import result_key
+
+
+def compare(base_report, new_report, threshold):
+    base_results = {result_key(entry): entry for entry in base_report['results']}
+    regressions = []
+
+    for entry in new_report['results']:
+        key = result_key(entry)
+        base_entry = base_results.get(key)
+        if not base_entry:
+            print(f'{key}: new')
+            continue
+
+        base_median = base_entry['seconds']['median']
+        new_median = entry['seconds']['median']
+        change = (new_median - base_median) / base_median if base_median else 0
+        marker = ''
+        if change > threshold:
+            marker = ' REGRESSION'
+            regressions.append(key)
+        elif change < -threshold:
+            marker = ' improvement'
+
+        print(f'{key}: {base_median * 1000:.3f} ms -> {new_median * 1000:.3f} ms ({change:+.1%}){marker}')
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare pyrrent benchmark results')
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown reported as regression')
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base_report = json.load(f)
+    with open(args.new) as f:
+        new_report = json.load(f)
+
+    print(f'Base: {base_report.get("commit")}. New: {new_report.get("commit")}')
+    regressions = compare(base_report, new_report, args.threshold)
+    if regressions:
+        print(f'{len(regressions)} regressions')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
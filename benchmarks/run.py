@@ -0,0 +1,107 @@
+# Runs the benchmark suite and writes results as JSON, for comparing with benchmarks.compare.
+# Run with: python -m benchmarks.run [--scale quick|full] [--suite NAME ...] [-o results.json]
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import time
+
+from benchmarks import (bench_bencoding, bench_cache, bench_choking, bench_connections, bench_metafile,
+                        bench_storage)
+from benchmarks.common import result_key
+
+
+SCALES = {
+    'quick': {
+        'repeat': 3,
+        'metafiles': [(1, 1), (1000, 100), (10000, 1000)],
+        'tracker_peers': [50, 200],
+        'cache_keys': 10000,
+        'cache_accesses': 100000,
+        'cache_capacities': [100, 1000],
+        'storage_pieces': 64,
+        'storage_piece_length': 2 ** 18,
+        'storage_files': 16,
+        'storage_small_ops': 5000,
+        'choking_peers': [100, 1000],
+        'choking_rounds': 10,
+        'connection_peers': [50, 200],
+        'connection_half_open': [8, 32],
+    },
+    'full': {
+        'repeat': 5,
+        'metafiles': [(1, 1), (1000, 100), (100000, 10000), (1000000, 100000)],
+        'tracker_peers': [50, 200, 1000],
+        'cache_keys': 100000,
+        'cache_accesses': 1000000,
+        'cache_capacities': [100, 1000, 10000],
+        'storage_pieces': 1024,
+        'storage_piece_length': 2 ** 20,
+        'storage_files': 100,
+        'storage_small_ops': 50000,
+        'choking_peers': [1000, 5000, 20000],
+        'choking_rounds': 30,
+        'connection_peers': [200, 400],
+        'connection_half_open': [8, 32, 128],
+    },
+}
+
+SUITES = {
+    'bencoding': bench_bencoding.run,
+    'metafile': bench_metafile.run,
+    'cache': bench_cache.run,
+    'storage': bench_storage.run,
+    'choking': bench_choking.run,
+    'connections': bench_connections.run,
+}
+
+
+def _git_commit():
+    try:
+        output = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.decode().strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run pyrrent benchmarks')
+    parser.add_argument('--scale', choices=SCALES, default='quick')
+    parser.add_argument('--suite', action='append', choices=SUITES, help='suite to run, all by default')
+    parser.add_argument('--disk-path', help='directory on real disk for storage benchmarks')
+    parser.add_argument('-o', '--output', help='JSON output path')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    scale = SCALES[args.scale]
+    results = []
+
+    for suite_name in args.suite or SUITES:
+        print(f'Running {suite_name}...', flush=True)
+        if suite_name == 'storage':
+            suite_results = SUITES[suite_name](scale, args.disk_path)
+        else:
+            suite_results = SUITES[suite_name](scale)
+
+        for entry in suite_results:
+            print(f'  {result_key(entry)}: {entry["seconds"]["median"] * 1000:.3f} ms')
+        results.extend(suite_results)
+
+    report = {
+        'commit': _git_commit(),
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import bisect
+import itertools
+import random
+import struct
+
+from pyrrent.bencoding import encode
+
+
+def make_metafile(piece_count, file_count, piece_length=2 ** 18, seed=0):
+    rng = random.Random(seed)
+    total_length = piece_count * piece_length - piece_length // 2
+    # Random cut points give files of varying sizes covering the whole content
+    cuts = sorted(rng.sample(range(1, total_length), min(file_count - 1, total_length - 1)))
+    lengths = [end - start for start, end in zip([0] + cuts, cuts + [total_length])]
+
+    info = {
+        'piece length': piece_length,
+        'pieces': rng.getrandbits(160 * piece_count).to_bytes(20 * piece_count, 'big'),
+        'name': 'synthetic',
+    }
+    if file_count == 1:
+        info['length'] = total_length
+    else:
+        info['files'] = [
+            {'length': length, 'path': [f'dir{i % 100}', f'file{i}']}
+            for i, length in enumerate(lengths)
+        ]
+
+    return encode({'announce': 'http://tracker.example.com/announce', 'info': info})
+
+
+def make_tracker_reply(peer_count, seed=0):
+    rng = random.Random(seed)
+    peers = b''.join(struct.pack('!4sH', rng.getrandbits(32).to_bytes(4, 'big'), rng.randrange(1, 65536))
+                     for _ in range(peer_count))
+    return encode({
+        'complete': rng.randrange(1000),
+        'incomplete': rng.randrange(1000),
+        'interval': 1800,
+        'min interval': 60,
+        'peers': peers,
+    })
+
+
+def zipf_keys(key_count, sample_count, exponent=1.1, seed=0):
+    rng = random.Random(seed)
+    weights = [1 / (rank ** exponent) for rank in range(1, key_count + 1)]
+    cumulative = list(itertools.accumulate(weights))
+    total = cumulative[-1]
+    return [bisect.bisect_left(cumulative, rng.random() * total) for _ in range(sample_count)]
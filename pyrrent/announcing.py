@@ -1,10 +1,22 @@
 import asyncio
+import bisect
 import logging
+import random
+import time
 from urllib.parse import urlencode
 
 import aiohttp
 
 from pyrrent import bencoding
+from pyrrent.peers import (decode_compact_peers, decode_compact_peers6, decode_dict_peers,
+                           PeerError)
+from pyrrent.utils.metrics import REGISTRY
+
+
+_ANNOUNCE_DURATION = REGISTRY.histogram('pyrrent_announce_duration_seconds', 'Duration of successful announces')
+_ANNOUNCE_ERRORS = REGISTRY.counter('pyrrent_announce_errors_total', 'Failed announces')
+_ANNOUNCES_POSTPONED = REGISTRY.counter('pyrrent_announces_postponed_total',
+                                        'Announces postponed because tracker circuit was open')
 
 
 class AnnouncerError(Exception):
@@ -18,27 +30,98 @@ class AnnounceResult:
         self.peers = peers
 
 
+class TrackerHealth:
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, failure_threshold=5, open_duration=300, max_open_duration=3600, decay=0.8):
+        self._failure_threshold = failure_threshold
+        self._open_duration = open_duration
+        self._max_open_duration = max_open_duration
+        self._decay = decay
+        self._open_until = 0
+        self.success_count = 0
+        self.failure_count = 0
+        self.consecutive_failures = 0
+        # Exponentially weighted, so recent announces dominate
+        self.success_rate = 1.0
+        # Last slot counts latencies above the largest bucket
+        self.latency_histogram = [0] * (len(self.LATENCY_BUCKETS) + 1)
+
+    @property
+    def is_available(self):
+        return time.monotonic() >= self._open_until
+
+    def time_until_available(self):
+        return max(self._open_until - time.monotonic(), 0)
+
+    def record_success(self, latency):
+        self.success_count += 1
+        self.consecutive_failures = 0
+        self.success_rate = self.success_rate * self._decay + (1 - self._decay)
+        self.latency_histogram[bisect.bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+        self._open_until = 0
+
+    def record_failure(self):
+        self.failure_count += 1
+        self.consecutive_failures += 1
+        self.success_rate *= self._decay
+
+        # Circuit opens at the threshold and stays open longer with every failed probe after it
+        excess_failures = self.consecutive_failures - self._failure_threshold
+        if excess_failures >= 0:
+            open_duration = min(self._open_duration * 2 ** excess_failures, self._max_open_duration)
+            self._open_until = time.monotonic() + open_duration
+
+
 class HTTPAnnouncer:
-    def __init__(self, url, download_info, coordinator, timeout=5, loop=None):
+    def __init__(self, url, download_info, coordinator, timeout=5, max_numwant=200,
+                 default_min_interval=60, retry_base=15, retry_max=1800, health=None, loop=None):
         self._url = url
         self._download_info = download_info
         self._coordinator = coordinator
         self._timeout = timeout
+        self._max_numwant = max_numwant
+        self._min_interval = default_min_interval
+        self._last_announce_time = None
+        self._retry_base = retry_base
+        self._retry_max = retry_max
+        # Can be shared between announcers of the same tracker
+        self._health = health if health else TrackerHealth()
         self._loop = loop if loop else asyncio.get_event_loop()
         self._announce_event = asyncio.Event()
-        self._next_event = 'normal'
+        self._next_event = 'started'
         self._session = aiohttp.ClientSession(loop=self._loop,
                                               read_timeout=timeout,
                                               conn_timeout=timeout)
         self._wake_up_task = None
         self._tracker_id = None
 
+    @property
+    def health(self):
+        return self._health
+
     def stop(self):
         self._set_event('stopped')
 
     def announce_completion(self):
         self._set_event('completed')
 
+    # Called by coordinator when its peer pool runs dry. Brings the next regular announce forward,
+    # but never earlier than the tracker's min interval after the last announce
+    def request_peers(self):
+        if not self._wake_up_task or self._last_announce_time is None:
+            return
+
+        earliest = max(self._last_announce_time + self._min_interval,
+                       self._loop.time() + self._health.time_until_available())
+        if earliest >= self._wake_up_task.when():
+            return
+
+        logging.debug(f'Peers requested, announcing early to {self._url}')
+        self._wake_up_task.cancel()
+        delay = max(earliest - self._loop.time(), 0)
+        self._wake_up_task = self._loop.call_later(delay, self._wake_up)
+
     def _set_event(self, event):
         if self._wake_up_task:
             self._wake_up_task.cancel()
@@ -47,30 +130,65 @@ class HTTPAnnouncer:
         self._next_event = event
         self._announce_event.set()
 
+    # Announcer is done once 'stopped' is sent (or announcing is cancelled), its session is closed then
     async def announcing(self):
         logging.info(f'Starting announcing to {self._url}')
+        self._announce_event.set()
 
         try:
-            await self._announce('started')
-        except AnnouncerError as e:
-            logging.error(f'Failed to announce started to {self._url}. Exception: {e}')
-            self._coordinator.process_announcer_error('started')
-
-        while True:
-            await self._announce_event.wait()
-            self._announce_event.clear()
-            announce_event = self._next_event
-            self._next_event = 'normal'
-
-            try:
-                await self._announce(announce_event)
-            except AnnouncerError as e:
-                logging.warning(f'Failed to announce {announce_event} to {self._url}. Exception: {e}')
-                self._coordinator.process_announcer_error(announce_event)
-
-            if announce_event == 'stopped':
-                logging.info(f'Stopped announcing to {self._url}')
-                return
+            while True:
+                await self._announce_event.wait()
+                self._announce_event.clear()
+                announce_event = self._next_event
+                self._next_event = 'normal'
+
+                if announce_event == 'stopped' and not self._health.is_available:
+                    logging.info(f'Tracker {self._url} unavailable, stopped announcing without notifying it')
+                    return
+
+                if not self._health.is_available:
+                    # Circuit is open - do not spend a connection on a tracker known to be down
+                    logging.debug(f'Tracker {self._url} unavailable, postponing {announce_event} announce')
+                    _ANNOUNCES_POSTPONED.inc()
+                    self._schedule_retry(announce_event)
+                    continue
+
+                start_time = self._loop.time()
+                try:
+                    await self._announce(announce_event)
+                except AnnouncerError as e:
+                    _ANNOUNCE_ERRORS.inc()
+                    self._health.record_failure()
+                    logging.warning(f'Failed to announce {announce_event} to {self._url}. Exception: {e}')
+                    self._coordinator.process_announcer_error(announce_event)
+                    if announce_event != 'stopped':
+                        self._schedule_retry(announce_event)
+                else:
+                    duration = self._loop.time() - start_time
+                    _ANNOUNCE_DURATION.observe(duration)
+                    self._health.record_success(duration)
+
+                if announce_event == 'stopped':
+                    logging.info(f'Stopped announcing to {self._url}')
+                    return
+        finally:
+            await self._session.close()
+
+    # Failed event is retried (a failed 'started' must not turn into 'normal'), unless another event
+    # was already requested in the meantime
+    def _schedule_retry(self, event):
+        if self._announce_event.is_set():
+            return
+
+        self._next_event = event
+
+        failures = max(self._health.consecutive_failures, 1)
+        delay = min(self._retry_base * 2 ** (failures - 1), self._retry_max)
+        delay = random.uniform(delay / 2, delay)
+        delay = max(delay, self._health.time_until_available())
+
+        logging.debug(f'Retrying {self._next_event} announce to {self._url} in {delay:.1f}s')
+        self._wake_up_task = self._loop.call_later(delay, self._wake_up)
 
     async def _announce(self, event='normal'):
         logging.debug(f'Announcing {event} to {self._url}')
@@ -87,13 +205,16 @@ class HTTPAnnouncer:
         except aiohttp.ClientError as e:
             raise AnnouncerError(f'Connection error while announcing to {self._url}') from e
 
-        announce_result, interval, tracker_id = self._parse_tracker_response(response_content)
+        self._last_announce_time = self._loop.time()
+        announce_result, interval, min_interval, tracker_id = self._parse_tracker_response(response_content)
         if tracker_id:
             self._tracker_id = tracker_id
+        if min_interval is not None:
+            self._min_interval = min(min_interval, interval)
 
         self._wake_up_task = self._loop.call_later(interval, self._wake_up)
-        logging.info(f'Announce result from {self._url}. Seeders: {announce_result.complete}. '
-                     f'Leechers: {announce_result.incomplete}. Peers given: {len(announce_result.peers) % 6}')
+        logging.debug(f'Announce result from {self._url}. Seeders: {announce_result.complete}. '
+                      f'Leechers: {announce_result.incomplete}. Peers given: {len(announce_result.peers)}')
         self._coordinator.process_announce_result(announce_result)
 
     def _get_announce_params(self, event):
@@ -106,13 +227,22 @@ class HTTPAnnouncer:
             'uploaded': self._download_info.uploaded,
             'left': self._download_info.left,
             'compact': 1,
-            'numwant': 20, # TODO
+            'numwant': self._get_numwant(event),
         }
         if self._tracker_id:
             params['trackerid'] = self._tracker_id
 
         return params
 
+    # Asks for as many peers as coordinator can still use. When the pool is saturated this drops
+    # to 0, so periodic announces keep us registered without making tracker send peer lists
+    def _get_numwant(self, event):
+        if event == 'stopped':
+            return 0
+
+        wanted = self._coordinator.get_wanted_peer_count()
+        return max(0, min(wanted, self._max_numwant))
+
     def _parse_tracker_response(self, encoded_response):
         try:
             response = bencoding.decode(encoded_response)
@@ -136,17 +266,33 @@ class HTTPAnnouncer:
             raise AnnouncerError(f'Invalid response from tracker {self._url}. Field incomplete not integer')
         if not isinstance(interval, int):
             raise AnnouncerError(f'Invalid response from tracker {self._url}. Field interval not integer')
-        if not isinstance(peers, bytes):
-            raise AnnouncerError(f'Invalid response from tracker {self._url}. Field peers not bytes')
-        if len(peers) % 6:
-            raise AnnouncerError(f'Invalid response from tracker {self._url}. Field peers not multiple of 6 bytes')
+
+        try:
+            if isinstance(peers, bytes):
+                peers = decode_compact_peers(peers)
+            elif isinstance(peers, list):
+                peers = decode_dict_peers(peers)
+            else:
+                raise AnnouncerError(f'Invalid response from tracker {self._url}. Field peers not bytes or list')
+
+            peers6 = response.get('peers6')
+            if peers6:
+                if not isinstance(peers6, bytes):
+                    raise AnnouncerError(f'Invalid response from tracker {self._url}. Field peers6 not bytes')
+                peers.extend(decode_compact_peers6(peers6))
+        except PeerError as e:
+            raise AnnouncerError(f'Invalid response from tracker {self._url}. Invalid peers: {e}') from e
+
+        min_interval = response.get('min interval')
+        if min_interval is not None and not isinstance(min_interval, int):
+            raise AnnouncerError(f'Invalid response from tracker {self._url}. Field min interval not integer')
 
         tracker_id = response.get('trackerid')
         if tracker_id and not isinstance(tracker_id, (int, bytes)):
             raise AnnouncerError(f'Invalid response from tracker {self._url}. Field trackerid not bytes or int')
 
         result = AnnounceResult(complete, incomplete, peers)
-        return result, interval, tracker_id
+        return result, interval, min_interval, tracker_id
 
     def _wake_up(self):
         self._announce_event.set()
@@ -1,3 +1,9 @@
+from pyrrent.utils.metrics import REGISTRY
+
+
+_DECODE_DURATION = REGISTRY.histogram('pyrrent_bencode_decode_duration_seconds', 'Duration of bencode decoding')
+
+
 class BencodingError(Exception):
     pass
 
@@ -42,26 +48,46 @@ def _bencode_dict(d):
     bencoded_items = [b'd']
 
     for k, v in d.items():
-        if not isinstance(k, str):
-            raise BencodingError(f'Dictionary key must be str, not: {type(k)}')
+        if isinstance(k, str):
+            bencoded_items.append(_bencode_string(k))
+        elif isinstance(k, bytes):
+            bencoded_items.append(_bencode_bytes(k))
+        else:
+            raise BencodingError(f'Dictionary key must be str or bytes, not: {type(k)}')
 
-        bencoded_items.append(_bencode_string(k))
         bencoded_items.append(encode(v))
 
     bencoded_items.append(b'e')
     return b''.join(bencoded_items)
 
 
-def decode(encoded):
+# Keys are decoded to ascii str by default. With binary_keys set, keys that are not valid ascii
+# (such as raw info hashes in scrape responses) are kept as bytes instead of raising
+def decode(encoded, binary_keys=False):
     encoded = memoryview(encoded)
-    item, leftover = _bdecode(encoded)
+    with _DECODE_DURATION.time():
+        try:
+            item, leftover = _bdecode(encoded, binary_keys)
+        except IndexError as e:
+            raise BencodingError(f'Truncated data') from e
     if leftover:
         raise BencodingError(f'Failed to decode entire content. Leftover length: {len(leftover)}')
 
     return item
 
 
-def _bdecode(data):
+# Decodes the first item and returns it with the bytes following it, for bencoded headers
+# followed by raw data (such as ut_metadata piece messages)
+def decode_partial(encoded, binary_keys=False):
+    try:
+        item, leftover = _bdecode(memoryview(encoded), binary_keys)
+    except IndexError as e:
+        raise BencodingError(f'Truncated data') from e
+
+    return item, leftover.tobytes()
+
+
+def _bdecode(data, binary_keys=False):
     first_byte = data[0]
 
     if first_byte == 105:
@@ -69,9 +95,9 @@ def _bdecode(data):
     elif 48 <= first_byte <= 57:
         return _bdecode_bytes(data)
     elif first_byte == 108:
-        return _bdecode_list(data)
+        return _bdecode_list(data, binary_keys)
     elif first_byte == 100:
-        return _bdecode_dict(data)
+        return _bdecode_dict(data, binary_keys)
     else:
         raise BencodingError(f'Invalid item start byte: {first_byte}')
 
@@ -108,31 +134,32 @@ def _bdecode_bytes(data):
 
     return data[:length].tobytes(), data[length:]
 
-def _bdecode_list(data):
+def _bdecode_list(data, binary_keys=False):
     items = []
     data = data[1:]
 
     while data[0] != 101:
-        item, data = _bdecode(data)
+        item, data = _bdecode(data, binary_keys)
         items.append(item)
 
     return items, data[1:]
 
-def _bdecode_dict(data):
+def _bdecode_dict(data, binary_keys=False):
     items = {}
     data = data[1:]
 
     while data[0] != 101:
-        key, data = _bdecode(data)
+        key, data = _bdecode(data, binary_keys)
         if not isinstance(key, bytes):
             raise BencodingError(f'Reached dictionary key which is of type {type(key)}')
 
         try:
             key = key.decode('ascii')
         except UnicodeDecodeError as e:
-            raise BencodingError(f'Invalid dictionary key string {key}') from e
+            if not binary_keys:
+                raise BencodingError(f'Invalid dictionary key string {key}') from e
 
-        value, data = _bdecode(data)
+        value, data = _bdecode(data, binary_keys)
         items[key] = value
 
     return items, data[1:]
@@ -0,0 +1,159 @@
+import asyncio
+import heapq
+import logging
+import random
+import time
+
+
+class RateMeter:
+    __slots__ = '_window', '_clock', '_buckets', '_total', '_current_second'
+
+    # Sliding window over per-second buckets. Both add and rate are O(1) amortized - at most
+    # window buckets are cleared when the meter was idle for a long time
+    def __init__(self, window=20, clock=time.monotonic):
+        self._window = window
+        self._clock = clock
+        self._buckets = [0] * window
+        self._total = 0
+        self._current_second = int(clock())
+
+    def add(self, amount):
+        self._advance()
+        self._buckets[self._current_second % self._window] += amount
+        self._total += amount
+
+    @property
+    def rate(self):
+        self._advance()
+        return self._total / self._window
+
+    def _advance(self):
+        second = int(self._clock())
+        elapsed = second - self._current_second
+        if not elapsed:
+            return
+
+        if elapsed >= self._window:
+            self._buckets = [0] * self._window
+            self._total = 0
+        else:
+            for s in range(self._current_second + 1, second + 1):
+                index = s % self._window
+                self._total -= self._buckets[index]
+                self._buckets[index] = 0
+
+        self._current_second = second
+
+
+class Choker:
+    def __init__(self, upload_slots=4, interval=10, optimistic_rounds=3, rate_window=20,
+                 on_change=None, clock=time.monotonic, loop=None):
+        self._upload_slots = upload_slots
+        self._interval = interval
+        self._optimistic_rounds = optimistic_rounds
+        self._rate_window = rate_window
+        self._on_change = on_change
+        self._clock = clock
+        self._loop = loop if loop else asyncio.get_event_loop()
+        self._peers = {}
+        self._unchoked = set()
+        self._optimistic_peer = None
+        self._round = 0
+        self._seeding = False
+        self._wake_up_task = None
+
+    @property
+    def unchoked(self):
+        return frozenset(self._unchoked)
+
+    @property
+    def optimistic_peer(self):
+        return self._optimistic_peer
+
+    def set_seeding(self, seeding):
+        self._seeding = seeding
+
+    def add_peer(self, peer):
+        if peer not in self._peers:
+            self._peers[peer] = _ChokerPeer(self._rate_window, self._clock)
+
+    def remove_peer(self, peer):
+        self._peers.pop(peer, None)
+        self._unchoked.discard(peer)
+        if peer == self._optimistic_peer:
+            self._optimistic_peer = None
+
+    def set_interested(self, peer, interested):
+        state = self._peers.get(peer)
+        if state:
+            state.interested = interested
+
+    def record_download(self, peer, amount):
+        state = self._peers.get(peer)
+        if state:
+            state.download_rate.add(amount)
+
+    def record_upload(self, peer, amount):
+        state = self._peers.get(peer)
+        if state:
+            state.upload_rate.add(amount)
+
+    def start(self):
+        if not self._wake_up_task:
+            self._run_periodically()
+
+    def stop(self):
+        if self._wake_up_task:
+            self._wake_up_task.cancel()
+            self._wake_up_task = None
+
+    # Returns peers that got unchoked and choked in this round
+    def run_round(self):
+        interested = [peer for peer, state in self._peers.items() if state.interested]
+
+        # Leeching - reciprocate to peers we download from fastest (tit-for-tat).
+        # Seeding - nothing to reciprocate, so favour peers we upload to fastest
+        if self._seeding:
+            rate_key = lambda peer: self._peers[peer].upload_rate.rate
+        else:
+            rate_key = lambda peer: self._peers[peer].download_rate.rate
+
+        regular_slots = max(self._upload_slots - 1, 0)
+        unchoked = set(heapq.nlargest(regular_slots, interested, key=rate_key))
+
+        # Kept optimistic peer that ranked into regular slots would leave one slot unused
+        optimistic_state = self._peers.get(self._optimistic_peer)
+        if (self._round % self._optimistic_rounds == 0
+                or not optimistic_state or not optimistic_state.interested
+                or self._optimistic_peer in unchoked):
+            candidates = [peer for peer in interested if peer not in unchoked]
+            self._optimistic_peer = random.choice(candidates) if candidates else None
+        if self._optimistic_peer is not None:
+            unchoked.add(self._optimistic_peer)
+
+        self._round += 1
+        newly_unchoked = unchoked - self._unchoked
+        newly_choked = self._unchoked - unchoked
+        self._unchoked = unchoked
+
+        return newly_unchoked, newly_choked
+
+    def _run_periodically(self):
+        newly_unchoked, newly_choked = self.run_round()
+        logging.debug(f'Choking round {self._round}. Unchoked: {len(newly_unchoked)}. '
+                      f'Choked: {len(newly_choked)}')
+
+        if self._on_change:
+            self._on_change(newly_unchoked, newly_choked)
+
+        self._wake_up_task = self._loop.call_later(self._interval, self._run_periodically)
+
+
+class _ChokerPeer:
+    __slots__ = 'interested', 'download_rate', 'upload_rate'
+
+
+    def __init__(self, rate_window, clock):
+        self.interested = False
+        self.download_rate = RateMeter(rate_window, clock)
+        self.upload_rate = RateMeter(rate_window, clock)
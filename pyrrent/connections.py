@@ -0,0 +1,384 @@
+import asyncio
+import logging
+import struct
+import time
+
+from pyrrent.utils.metrics import REGISTRY
+
+
+_CONNECTIONS = REGISTRY.gauge('pyrrent_peer_connections', 'Established peer connections')
+_HALF_OPEN = REGISTRY.gauge('pyrrent_peer_connections_half_open', 'Outgoing peer connections being set up')
+_CONNECT_FAILURES = REGISTRY.counter('pyrrent_peer_connect_failures_total', 'Failed outgoing peer connections')
+_EVICTIONS = REGISTRY.counter('pyrrent_peer_evictions_total', 'Peer connections closed for being unproductive')
+
+
+class ConnectionManagerError(Exception):
+    pass
+
+
+PROTOCOL = b'BitTorrent protocol'
+# Extension protocol (BEP 10) support bit is 0x10 in reserved byte 5
+RESERVED = b'\x00\x00\x00\x00\x00\x10\x00\x00'
+_HANDSHAKE = struct.Struct('!B19s8s20s20s')
+HANDSHAKE_LENGTH = _HANDSHAKE.size
+
+
+def encode_handshake(info_hash, peer_id, reserved=RESERVED):
+    return _HANDSHAKE.pack(len(PROTOCOL), PROTOCOL, reserved, info_hash, peer_id)
+
+
+# Returns (info hash, peer id, reserved)
+def decode_handshake(data):
+    try:
+        protocol_length, protocol, reserved, info_hash, peer_id = _HANDSHAKE.unpack(data)
+    except struct.error as e:
+        raise ConnectionManagerError(f'Invalid handshake length: {len(data)}') from e
+
+    if protocol_length != len(PROTOCOL) or protocol != PROTOCOL:
+        raise ConnectionManagerError(f'Unknown protocol: {protocol}')
+
+    return info_hash, peer_id, reserved
+
+
+class PeerConnection:
+    # Handshaken connection handed to the torrent. Whoever reads from it reports traffic with
+    # record_download/record_upload, which is what tells productive peers from idle ones, and
+    # closes it when the peer goes away
+    def __init__(self, reader, writer, peer, info_hash, peer_id, reserved, outgoing, on_close):
+        self.reader = reader
+        self.writer = writer
+        self.peer = peer
+        self.info_hash = info_hash
+        self.peer_id = peer_id
+        self.reserved = reserved
+        self.outgoing = outgoing
+        self.downloaded = 0
+        self.uploaded = 0
+        self.connected_at = time.monotonic()
+        self.last_active = self.connected_at
+        self._on_close = on_close
+        self._closed = False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def supports_extensions(self):
+        return bool(self.reserved[5] & 0x10)
+
+    def record_download(self, length):
+        self.downloaded += length
+        self.last_active = time.monotonic()
+
+    def record_upload(self, length):
+        self.uploaded += length
+        self.last_active = time.monotonic()
+
+    def close(self):
+        if self._closed:
+            return
+
+        self._closed = True
+        self.writer.close()
+        self._on_close(self)
+
+
+class ConnectionManager:
+    # Dials peers from torrents' peer stores and accepts incoming connections on one listening
+    # socket, routed to torrents by the info hash in the handshake. Slots are refilled as soon as
+    # a connection is set up, fails or closes, so a fresh announce turns into connections at the
+    # rate peers answer rather than at a timer's pace. Failed peers back off through PeerStore.
+    # When caps are reached, connections without traffic for unproductive_timeout make room.
+    # Reading from a socket pauses once receive_buffer_size unread bytes are buffered. With an
+    # optional pyrrent.utils.MemoryBudget, each socket's buffer is accounted as receive_buffers from
+    # dialing until it closes, and no peers are dialed or accepted while another one does not fit
+    def __init__(self, peer_id, max_connections=200, max_connections_per_torrent=50, max_half_open=20,
+                 connect_timeout=5, handshake_timeout=10, fallback_delay=0.25, unproductive_timeout=120,
+                 eviction_interval=30, receive_buffer_size=2 ** 16, memory_budget=None, loop=None):
+        self._peer_id = peer_id
+        self._max_connections = max_connections
+        self._max_connections_per_torrent = max_connections_per_torrent
+        self._max_half_open = max_half_open
+        self._connect_timeout = connect_timeout
+        self._handshake_timeout = handshake_timeout
+        self._fallback_delay = fallback_delay
+        self._unproductive_timeout = unproductive_timeout
+        self._eviction_interval = eviction_interval
+        self._receive_buffer_size = receive_buffer_size
+        # StreamReader pauses reading only once its buffer grows past twice its limit
+        self._stream_limit = max(receive_buffer_size // 2, 1)
+        self._memory_budget = memory_budget
+        self._loop = loop if loop else asyncio.get_event_loop()
+        self._torrents = {}
+        self._connection_count = 0
+        self._half_open = 0
+        self._fill_scheduled = False
+        self._server = None
+        self._wake_up_task = None
+
+    @property
+    def connection_count(self):
+        return self._connection_count
+
+    @property
+    def half_open_count(self):
+        return self._half_open
+
+    @property
+    def address(self):
+        return self._server.sockets[0].getsockname()[:2] if self._server else None
+
+    async def start(self, host='0.0.0.0', port=6881):
+        try:
+            self._server = await asyncio.start_server(self._handle_incoming, host=host, port=port,
+                                                      limit=self._stream_limit)
+        except OSError as e:
+            raise ConnectionManagerError(f'Failed to listen on {host}:{port}') from e
+
+        logging.info(f'Accepting peer connections on {self.address}')
+        self._wake_up_task = self._loop.call_later(self._eviction_interval, self._wake_up)
+
+    def stop(self):
+        if self._server:
+            self._server.close()
+            self._server = None
+        if self._wake_up_task:
+            self._wake_up_task.cancel()
+            self._wake_up_task = None
+
+        for info_hash in list(self._torrents):
+            self.unregister(info_hash)
+
+    # Connections are handed to on_connected as they are set up
+    def register(self, info_hash, peer_store, on_connected=None):
+        if info_hash in self._torrents:
+            raise ConnectionManagerError(f'Torrent {info_hash.hex()} already registered')
+
+        self._torrents[info_hash] = _TorrentEntry(info_hash, peer_store, on_connected)
+        self._schedule_fill()
+
+    def unregister(self, info_hash):
+        entry = self._torrents.pop(info_hash, None)
+        if not entry:
+            return
+
+        for task in entry.connect_tasks:
+            task.cancel()
+        for connection in list(entry.connections):
+            connection.close()
+
+    # Called when torrent's peer store got new peers
+    def peers_added(self, info_hash):
+        if info_hash in self._torrents:
+            self._schedule_fill()
+
+    def get_connections(self, info_hash):
+        entry = self._torrents.get(info_hash)
+        return list(entry.connections) if entry else []
+
+    def _schedule_fill(self):
+        if not self._fill_scheduled:
+            self._fill_scheduled = True
+            self._loop.call_soon(self._fill)
+
+    def _fill(self):
+        self._fill_scheduled = False
+
+        # Torrents with fewest connections go first, so one big swarm does not take all slots
+        for entry in sorted(self._torrents.values(), key=lambda e: len(e.connections) + len(e.connecting)):
+            global_free = min(self._max_half_open - self._half_open,
+                              self._max_connections - self._connection_count - self._half_open)
+            if global_free <= 0:
+                return
+
+            torrent_free = self._max_connections_per_torrent - len(entry.connections) - len(entry.connecting)
+            count = min(global_free, torrent_free)
+            if count <= 0:
+                continue
+
+            exclude = entry.connected_peers | entry.connecting
+            for peer in entry.peers.get_connectable(count, exclude=exclude):
+                if not self._reserve_buffer():
+                    logging.debug(f'No memory left for receive buffers, not dialing more peers')
+                    _HALF_OPEN.set(self._half_open)
+                    return
+
+                entry.connecting.add(peer)
+                self._half_open += 1
+                task = self._loop.create_task(self._connect(entry, peer))
+                entry.connect_tasks.add(task)
+                task.add_done_callback(entry.connect_tasks.discard)
+
+        _HALF_OPEN.set(self._half_open)
+
+    async def _connect(self, entry, peer):
+        writer = None
+        try:
+            # Host names resolving to several addresses are tried in parallel, staggered by fallback delay
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(peer[0], peer[1], happy_eyeballs_delay=self._fallback_delay,
+                                        limit=self._stream_limit),
+                self._connect_timeout)
+
+            writer.write(encode_handshake(entry.info_hash, self._peer_id))
+            await writer.drain()
+            data = await asyncio.wait_for(reader.readexactly(HANDSHAKE_LENGTH), self._handshake_timeout)
+            info_hash, peer_id, reserved = decode_handshake(data)
+            if info_hash != entry.info_hash:
+                raise ConnectionManagerError(f'Peer serves different info hash: {info_hash.hex()}')
+            if peer_id == self._peer_id:
+                entry.peers.remove(peer)
+                raise ConnectionManagerError(f'Connected to self')
+        except asyncio.CancelledError:
+            if writer:
+                writer.close()
+            self._release_buffer()
+            raise
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionManagerError) as e:
+            logging.debug(f'Failed to connect to peer {peer}. Exception: {e}')
+            _CONNECT_FAILURES.inc()
+            if writer:
+                writer.close()
+            self._release_buffer()
+            entry.peers.connect_failed(peer)
+            return
+        finally:
+            entry.connecting.discard(peer)
+            self._half_open -= 1
+            _HALF_OPEN.set(self._half_open)
+            self._schedule_fill()
+
+        entry.peers.connect_succeeded(peer)
+        # Torrent may have been unregistered, or incoming connections may have taken the slots meanwhile
+        if self._torrents.get(entry.info_hash) is not entry or not self._make_room(entry):
+            writer.close()
+            self._release_buffer()
+            return
+
+        self._add_connection(entry, PeerConnection(reader, writer, peer, info_hash, peer_id, reserved, True,
+                                                   self._on_connection_closed))
+
+    async def _handle_incoming(self, reader, writer):
+        peer = writer.get_extra_info('peername')[:2]
+        if not self._reserve_buffer():
+            logging.debug(f'Rejected incoming connection from {peer}, no memory left for receive buffers')
+            writer.close()
+            return
+
+        try:
+            data = await asyncio.wait_for(reader.readexactly(HANDSHAKE_LENGTH), self._handshake_timeout)
+            info_hash, peer_id, reserved = decode_handshake(data)
+
+            entry = self._torrents.get(info_hash)
+            if not entry:
+                raise ConnectionManagerError(f'Unknown info hash: {info_hash.hex()}')
+            if peer_id == self._peer_id:
+                raise ConnectionManagerError(f'Connected to self')
+            if not self._make_room(entry):
+                raise ConnectionManagerError(f'No free connection slots')
+
+            writer.write(encode_handshake(info_hash, self._peer_id))
+            await writer.drain()
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionManagerError) as e:
+            logging.debug(f'Rejected incoming connection from {peer}. Exception: {e}')
+            writer.close()
+            self._release_buffer()
+            return
+
+        # Slot may have been taken while the handshake was being written
+        if self._torrents.get(info_hash) is not entry or not self._make_room(entry):
+            writer.close()
+            self._release_buffer()
+            return
+
+        self._add_connection(entry, PeerConnection(reader, writer, peer, info_hash, peer_id, reserved, False,
+                                                   self._on_connection_closed))
+
+    def _add_connection(self, entry, connection):
+        logging.debug(f'Connected to peer {connection.peer} for {entry.info_hash.hex()}')
+        entry.connections.add(connection)
+        entry.connected_peers.add(connection.peer)
+        self._connection_count += 1
+        _CONNECTIONS.set(self._connection_count)
+
+        if entry.on_connected:
+            entry.on_connected(connection)
+
+    def _on_connection_closed(self, connection):
+        entry = self._torrents.get(connection.info_hash)
+        if entry and connection in entry.connections:
+            entry.connections.discard(connection)
+            entry.connected_peers.discard(connection.peer)
+
+        self._connection_count -= 1
+        _CONNECTIONS.set(self._connection_count)
+        self._release_buffer()
+        self._schedule_fill()
+
+    def _reserve_buffer(self):
+        if not self._memory_budget:
+            return True
+        return self._memory_budget.try_allocate('receive_buffers', self._receive_buffer_size)
+
+    def _release_buffer(self):
+        if self._memory_budget:
+            self._memory_budget.release('receive_buffers', self._receive_buffer_size)
+
+    # True if a connection for the torrent fits in, evicting an unproductive one if it is needed
+    def _make_room(self, entry):
+        torrent_full = len(entry.connections) >= self._max_connections_per_torrent
+        global_full = self._connection_count >= self._max_connections
+        if not torrent_full and not global_full:
+            return True
+
+        if torrent_full:
+            candidates = entry.connections
+        else:
+            candidates = [c for e in self._torrents.values() for c in e.connections]
+
+        victim = min(candidates, key=lambda c: c.last_active, default=None)
+        if not victim or time.monotonic() - victim.last_active < self._unproductive_timeout:
+            return False
+
+        self._evict(victim)
+        return True
+
+    def _evict(self, connection):
+        logging.debug(f'Evicting unproductive peer {connection.peer}')
+        _EVICTIONS.inc()
+        connection.close()
+
+    # Unproductive connections are only closed when there are peers waiting for their slots.
+    # Filling is retried here too, dialing may have stopped for lack of memory
+    def _wake_up(self):
+        now = time.monotonic()
+        for entry in self._torrents.values():
+            at_capacity = (len(entry.connections) >= self._max_connections_per_torrent or
+                           self._connection_count >= self._max_connections)
+            if not at_capacity:
+                continue
+
+            exclude = entry.connected_peers | entry.connecting
+            waiting_count = len(entry.peers.get_connectable(len(entry.connections), exclude=exclude))
+            idle = sorted((c for c in entry.connections if now - c.last_active >= self._unproductive_timeout),
+                          key=lambda c: c.last_active)
+            for connection in idle[:waiting_count]:
+                self._evict(connection)
+
+        self._schedule_fill()
+        self._wake_up_task = self._loop.call_later(self._eviction_interval, self._wake_up)
+
+
+class _TorrentEntry:
+    __slots__ = 'info_hash', 'peers', 'on_connected', 'connections', 'connected_peers', 'connecting', 'connect_tasks'
+
+
+    def __init__(self, info_hash, peers, on_connected):
+        self.info_hash = info_hash
+        self.peers = peers
+        self.on_connected = on_connected
+        self.connections = set()
+        self.connected_peers = set()
+        self.connecting = set()
+        self.connect_tasks = set()
@@ -0,0 +1,166 @@
+import argparse
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pyrrent.bencoding import encode
+from pyrrent.metafile import MetafileError
+
+
+MIN_PIECE_LENGTH = 2 ** 14
+MAX_PIECE_LENGTH = 2 ** 24
+_TARGET_PIECE_COUNT = 1500
+# Size of file range hashed by single worker task. Large enough to keep task overhead negligible,
+# small enough to spread work evenly
+_TASK_SIZE = 2 ** 26
+
+
+def choose_piece_length(total_length):
+    piece_length = MIN_PIECE_LENGTH
+    while piece_length < MAX_PIECE_LENGTH and total_length // piece_length > _TARGET_PIECE_COUNT:
+        piece_length *= 2
+    return piece_length
+
+
+# Path can be a single file, creating single file metafile, or a directory whose files are
+# included sorted by their path components. Pieces are hashed on a thread pool - hashlib releases the GIL while
+# hashing, and each task reads its own file range, so hashing scales across cores and disks
+def create_metafile(path, announce_url, piece_length=None, name=None, comment=None, workers=None):
+    path = os.path.abspath(path)
+    name = name or os.path.basename(path)
+    files = _list_files(path)
+    total_length = sum(length for _, _, length in files)
+    if not total_length:
+        raise MetafileError(f'Nothing to create metafile from at: {path}')
+
+    if piece_length is None:
+        piece_length = choose_piece_length(total_length)
+    if piece_length <= 0 or piece_length & (piece_length - 1):
+        raise MetafileError(f'Piece length must be a power of two: {piece_length}')
+
+    logging.info(f'Creating metafile for {path}. Files: {len(files)}. Total length: {total_length}. '
+                 f'Piece length: {piece_length}')
+    pieces = _hash_all_pieces(files, total_length, piece_length, workers)
+
+    # Keys are inserted in sorted order, since bencoding.encode keeps insertion order. Text fields are
+    # stored as UTF-8 bytes, bencoding only takes ascii str
+    info = {}
+    if os.path.isdir(path):
+        info['files'] = [
+            {'length': length, 'path': [item.encode('utf-8') for item in os.path.relpath(file_path, path).split(os.sep)]}
+            for file_path, _, length in files
+        ]
+    else:
+        info['length'] = total_length
+    info['name'] = name.encode('utf-8')
+    info['piece length'] = piece_length
+    info['pieces'] = pieces
+
+    metafile = {'announce': announce_url}
+    if comment:
+        metafile['comment'] = comment.encode('utf-8')
+    metafile['created by'] = 'pyrrent'
+    metafile['creation date'] = int(time.time())
+    metafile['info'] = info
+
+    return encode(metafile)
+
+
+# Returns (path, offset in torrent content, length) for every file, in metafile order
+def _list_files(path):
+    if os.path.isfile(path):
+        file_paths = [path]
+    elif os.path.isdir(path):
+        file_paths = []
+        for dir_path, _, file_names in os.walk(path):
+            file_paths.extend(os.path.join(dir_path, file_name) for file_name in file_names)
+        file_paths.sort(key=lambda file_path: os.path.relpath(file_path, path).split(os.sep))
+    else:
+        raise MetafileError(f'Path does not exist: {path}')
+
+    files = []
+    offset = 0
+    for file_path in file_paths:
+        try:
+            length = os.path.getsize(file_path)
+        except OSError as e:
+            raise MetafileError(f'Failed to check size of: {file_path}') from e
+
+        files.append((file_path, offset, length))
+        offset += length
+
+    return files
+
+
+def _hash_all_pieces(files, total_length, piece_length, workers):
+    task_length = max(_TASK_SIZE // piece_length, 1) * piece_length
+    ranges = [(start, min(start + task_length, total_length)) for start in range(0, total_length, task_length)]
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        results = pool.map(lambda r: _hash_pieces(files, r[0], r[1], piece_length), ranges)
+        return b''.join(results)
+
+
+# Range must start on piece boundary. Pieces span file boundaries the same way files are
+# composed from pieces - files are concatenated in metafile order
+def _hash_pieces(files, start, end, piece_length):
+    hashes = []
+    piece_hash = hashlib.sha1()
+    filled = 0
+
+    for file_path, file_start, file_length in files:
+        segment_start = max(start, file_start)
+        segment_end = min(end, file_start + file_length)
+        if segment_start >= segment_end:
+            continue
+
+        try:
+            with open(file_path, 'rb') as f:
+                f.seek(segment_start - file_start)
+                remaining = segment_end - segment_start
+
+                while remaining:
+                    chunk = f.read(min(piece_length - filled, remaining))
+                    if not chunk:
+                        raise MetafileError(f'File changed while creating metafile: {file_path}')
+
+                    piece_hash.update(chunk)
+                    filled += len(chunk)
+                    remaining -= len(chunk)
+                    if filled == piece_length:
+                        hashes.append(piece_hash.digest())
+                        piece_hash = hashlib.sha1()
+                        filled = 0
+        except OSError as e:
+            raise MetafileError(f'Failed to read: {file_path}') from e
+
+    if filled:
+        hashes.append(piece_hash.digest())
+
+    return b''.join(hashes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create metafile from file or directory')
+    parser.add_argument('path')
+    parser.add_argument('-a', '--announce', required=True, help='tracker announce URL')
+    parser.add_argument('-o', '--output', help='output path, defaults to <path>.torrent')
+    parser.add_argument('-l', '--piece-length', type=int, help='piece length in bytes, chosen by size if omitted')
+    parser.add_argument('-n', '--name', help='name stored in metafile, defaults to base name of path')
+    parser.add_argument('-c', '--comment')
+    parser.add_argument('-w', '--workers', type=int, help='hashing threads, defaults to CPU count')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    content = create_metafile(args.path, args.announce, args.piece_length, args.name, args.comment, args.workers)
+
+    output = args.output or os.path.abspath(args.path).rstrip(os.sep) + '.torrent'
+    with open(output, 'wb') as f:
+        f.write(content)
+    logging.info(f'Metafile written to {output}')
+
+
+if __name__ == '__main__':
+    main()
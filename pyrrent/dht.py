@@ -0,0 +1,622 @@
+import asyncio
+import hashlib
+import heapq
+import itertools
+import logging
+import os
+import random
+import socket
+import struct
+import time
+
+from pyrrent import bencoding
+from pyrrent.announcing import AnnounceResult
+from pyrrent.peers import decode_compact_peers, encode_compact_peers, PeerError
+from pyrrent.utils.metrics import REGISTRY
+
+
+_QUERIES_SENT = REGISTRY.counter('pyrrent_dht_queries_sent_total', 'DHT queries sent')
+_QUERY_TIMEOUTS = REGISTRY.counter('pyrrent_dht_query_timeouts_total', 'DHT queries left without response')
+_QUERIES_RECEIVED = REGISTRY.counter('pyrrent_dht_queries_received_total', 'DHT queries received')
+_LOOKUP_DURATION = REGISTRY.histogram('pyrrent_dht_lookup_duration_seconds', 'Duration of iterative DHT lookups')
+
+
+class DHTError(Exception):
+    pass
+
+
+ID_LENGTH = 20
+_ID_BITS = ID_LENGTH * 8
+_COMPACT_NODE = struct.Struct('!20s4sH')
+_TRANSACTION_ID = struct.Struct('!H')
+# Buckets untouched for this long are refreshed with a lookup of a random ID in their range
+_BUCKET_REFRESH_AGE = 15 * 60
+# Keeps get_peers responses within a single UDP datagram
+_MAX_VALUES = 50
+_TOKEN_LENGTH = 8
+
+_ERROR_PROTOCOL = 203
+_ERROR_METHOD_UNKNOWN = 204
+
+
+def generate_node_id():
+    return os.urandom(ID_LENGTH)
+
+
+def encode_compact_nodes(nodes):
+    encoded = []
+
+    for node in nodes:
+        ip, port = node.address
+        try:
+            encoded.append(_COMPACT_NODE.pack(node.id.to_bytes(ID_LENGTH, 'big'), socket.inet_aton(ip), port))
+        except (OSError, struct.error):
+            continue
+
+    return b''.join(encoded)
+
+
+def decode_compact_nodes(data):
+    if not isinstance(data, bytes) or len(data) % _COMPACT_NODE.size:
+        raise DHTError(f'Compact nodes not bytes of multiple of {_COMPACT_NODE.size} length')
+
+    inet_ntoa = socket.inet_ntoa
+    return [_Node(int.from_bytes(node_id, 'big'), (inet_ntoa(ip), port))
+            for node_id, ip, port in _COMPACT_NODE.iter_unpack(data) if port]
+
+
+class RoutingTable:
+    # Bucket i holds nodes whose XOR distance from own ID is i + 1 bits long, which is the same as
+    # splitting buckets along own ID all the way down. Every bucket keeps at most k nodes, and known
+    # nodes are kept over new ones - long-lived nodes are the most likely to stay up
+    @classmethod
+    def load(cls, path, k=8, max_failures=2):
+        try:
+            with open(path, 'rb') as f:
+                state = bencoding.decode(f.read())
+        except OSError as e:
+            raise DHTError(f'Failed to read routing table from: {path}') from e
+        except bencoding.BencodingError as e:
+            raise DHTError(f'Invalid routing table at: {path}') from e
+
+        if not isinstance(state, dict):
+            raise DHTError(f'Invalid routing table at: {path}')
+
+        node_id = state.get('id')
+        if not isinstance(node_id, bytes) or len(node_id) != ID_LENGTH:
+            raise DHTError(f'Invalid node ID in routing table at: {path}')
+
+        table = cls(int.from_bytes(node_id, 'big'), k, max_failures)
+        for node in decode_compact_nodes(state.get('nodes', b'')):
+            table.add(node.id, node.address, last_seen=0)
+
+        return table
+
+    def __init__(self, node_id, k=8, max_failures=2):
+        self.node_id = node_id
+        self._k = k
+        self._max_failures = max_failures
+        # Dicts keep insertion order, so the oldest node of a bucket comes first
+        self._buckets = [{} for _ in range(_ID_BITS)]
+        self._bucket_updated = [0] * _ID_BITS
+        self._node_count = 0
+
+    def __len__(self):
+        return self._node_count
+
+    def __contains__(self, node_id):
+        return node_id != self.node_id and node_id in self._buckets[self._get_bucket_index(node_id)]
+
+    def add(self, node_id, address, last_seen=None):
+        if node_id == self.node_id:
+            return False
+
+        now = time.monotonic()
+        bucket_index = self._get_bucket_index(node_id)
+        bucket = self._buckets[bucket_index]
+
+        node = bucket.get(node_id)
+        if node:
+            node.address = address
+            node.failures = 0
+        elif len(bucket) < self._k:
+            node = _Node(node_id, address)
+            bucket[node_id] = node
+            self._node_count += 1
+        else:
+            # Full bucket only makes room by dropping a node that stopped responding
+            worst = max(bucket.values(), key=lambda n: n.failures)
+            if not worst.failures:
+                return False
+
+            del bucket[worst.id]
+            node = _Node(node_id, address)
+            bucket[node_id] = node
+
+        node.last_seen = now if last_seen is None else last_seen
+        self._bucket_updated[bucket_index] = now
+        return True
+
+    def remove(self, node_id):
+        if self._buckets[self._get_bucket_index(node_id)].pop(node_id, None):
+            self._node_count -= 1
+
+    def node_failed(self, node_id):
+        bucket = self._buckets[self._get_bucket_index(node_id)]
+        node = bucket.get(node_id)
+        if not node:
+            return
+
+        node.failures += 1
+        if node.failures >= self._max_failures:
+            del bucket[node_id]
+            self._node_count -= 1
+
+    def closest(self, target, count=None):
+        return heapq.nsmallest(count or self._k, self.get_nodes(), key=lambda node: node.id ^ target)
+
+    def get_nodes(self):
+        return [node for bucket in self._buckets for node in bucket.values()]
+
+    def get_stale_buckets(self, max_age):
+        now = time.monotonic()
+        return [i for i, bucket in enumerate(self._buckets) if bucket and now - self._bucket_updated[i] > max_age]
+
+    def get_random_id_in_bucket(self, bucket_index):
+        return self.node_id ^ random.randrange(1 << bucket_index, 1 << (bucket_index + 1))
+
+    def save(self, path):
+        state = {'id': self.node_id.to_bytes(ID_LENGTH, 'big'), 'nodes': encode_compact_nodes(self.get_nodes())}
+        temp_path = path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(bencoding.encode(state))
+            os.replace(temp_path, path)
+        except OSError as e:
+            raise DHTError(f'Failed to save routing table to: {path}') from e
+
+    def _get_bucket_index(self, node_id):
+        return (self.node_id ^ node_id).bit_length() - 1
+
+
+class _Node:
+    __slots__ = 'id', 'address', 'last_seen', 'failures'
+
+
+    def __init__(self, node_id, address):
+        self.id = node_id
+        self.address = address
+        self.last_seen = 0
+        self.failures = 0
+
+
+class DHTNode:
+    # Mainline DHT (BEP 5) node. Routing table is saved to state_path on stop and maintenance, and
+    # loaded on start, so a restarted node can look up through its old contacts right away
+    def __init__(self, node_id=None, state_path=None, k=8, alpha=3, query_timeout=2, maintenance_interval=300,
+                 peer_ttl=1800, max_peers_per_torrent=1000, loop=None):
+        self._state_path = state_path
+        self._k = k
+        self._alpha = alpha
+        self._query_timeout = query_timeout
+        self._maintenance_interval = maintenance_interval
+        self._peer_ttl = peer_ttl
+        self._max_peers_per_torrent = max_peers_per_torrent
+        self._loop = loop if loop else asyncio.get_event_loop()
+        self._table = RoutingTable(int.from_bytes(node_id or generate_node_id(), 'big'), k)
+        self._transport = None
+        self._pending = {}
+        self._transaction_ids = itertools.count()
+        # Current and previous secret - a token stays valid for one to two maintenance intervals
+        self._token_secrets = [os.urandom(16), os.urandom(16)]
+        self._stored_peers = {}
+        self._wake_up_task = None
+        self._refresh_task = None
+        self._query_handlers = {
+            b'ping': self._on_ping,
+            b'find_node': self._on_find_node,
+            b'get_peers': self._on_get_peers,
+            b'announce_peer': self._on_announce_peer,
+        }
+
+    @property
+    def node_id(self):
+        return self._table.node_id.to_bytes(ID_LENGTH, 'big')
+
+    @property
+    def routing_table(self):
+        return self._table
+
+    @property
+    def address(self):
+        return self._transport.get_extra_info('sockname') if self._transport else None
+
+    async def start(self, host='0.0.0.0', port=6881, bootstrap=()):
+        if self._transport:
+            raise DHTError(f'DHT node already started')
+
+        if self._state_path and os.path.exists(self._state_path):
+            try:
+                self._table = RoutingTable.load(self._state_path, self._k)
+            except DHTError as e:
+                # Routing table is only a head start, a damaged one is dropped instead of failing startup
+                logging.warning(f'Discarding DHT routing table. Exception: {e}')
+
+        try:
+            self._transport, _ = await self._loop.create_datagram_endpoint(lambda: _DHTProtocol(self),
+                                                                           local_addr=(host, port))
+        except OSError as e:
+            raise DHTError(f'Failed to bind DHT node to {host}:{port}') from e
+
+        logging.info(f'Started DHT node {self.node_id.hex()} on {self.address}. Known nodes: {len(self._table)}')
+        self._wake_up_task = self._loop.call_later(self._maintenance_interval, self._wake_up)
+        await self.bootstrap(bootstrap)
+
+    def stop(self):
+        if not self._transport:
+            return
+
+        logging.info(f'Stopping DHT node {self.node_id.hex()}')
+        if self._wake_up_task:
+            self._wake_up_task.cancel()
+            self._wake_up_task = None
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+        for future, _ in self._pending.values():
+            if not future.done():
+                future.set_exception(DHTError(f'DHT node stopped'))
+        self._pending.clear()
+
+        self._transport.close()
+        self._transport = None
+        self._save_state()
+
+    # Bootstrap nodes are queried directly, as their IDs are not known up front. Nodes they return,
+    # together with the ones already in the routing table, start a lookup of own ID
+    async def bootstrap(self, addresses=()):
+        resolved = await asyncio.gather(*(self._resolve(address) for address in addresses))
+        queries = [self._query(address, b'find_node', {'target': self.node_id}) for address in resolved if address]
+        responses = await asyncio.gather(*queries, return_exceptions=True)
+
+        seeds = []
+        for response in responses:
+            if isinstance(response, dict):
+                try:
+                    seeds.extend(decode_compact_nodes(response.get('nodes', b'')))
+                except DHTError as e:
+                    logging.debug(f'Invalid nodes from bootstrap node. Exception: {e}')
+
+        await self._lookup(self.node_id, b'find_node', seeds)
+        logging.info(f'DHT node {self.node_id.hex()} bootstrapped. Known nodes: {len(self._table)}')
+
+    async def get_peers(self, info_hash):
+        peers, _ = await self._lookup(info_hash, b'get_peers')
+        return peers
+
+    # Announces to the closest nodes that handed out tokens during the lookup. Returns peers found
+    # on the way, so one traversal serves both announcing and peer discovery
+    async def announce_peer(self, info_hash, port):
+        peers, responders = await self._lookup(info_hash, b'get_peers')
+
+        announces = [self._query(node.address, b'announce_peer', {'info_hash': info_hash, 'port': port, 'token': token})
+                     for node, token in responders if isinstance(token, bytes)]
+        results = await asyncio.gather(*announces, return_exceptions=True)
+
+        accepted = sum(1 for result in results if isinstance(result, dict))
+        logging.debug(f'Announced {info_hash.hex()} to {accepted} DHT nodes. Peers found: {len(peers)}')
+        return peers
+
+    # Iterative lookup - up to alpha queries in flight, always to the closest nodes not queried yet.
+    # Ends once the k closest nodes seen so far have all answered or failed.
+    # Returns peers found and the closest responders along with their tokens
+    async def _lookup(self, target, method, seeds=()):
+        target_id = int.from_bytes(target, 'big')
+        argument = 'info_hash' if method == b'get_peers' else 'target'
+        distance = lambda node: node.id ^ target_id
+
+        candidates = {node.id: node for node in self._table.closest(target_id)}
+        for node in seeds:
+            if node.id != self._table.node_id:
+                candidates.setdefault(node.id, node)
+
+        queried = set()
+        responders = []
+        peers = set()
+        in_flight = {}
+
+        start_time = self._loop.time()
+        try:
+            while True:
+                for node in heapq.nsmallest(self._k, candidates.values(), key=distance):
+                    if len(in_flight) >= self._alpha:
+                        break
+                    if node.id in queried:
+                        continue
+
+                    queried.add(node.id)
+                    task = self._loop.create_task(self._query(node.address, method, {argument: target}))
+                    in_flight[task] = node
+
+                if not in_flight:
+                    break
+
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    node = in_flight.pop(task)
+                    try:
+                        response = task.result()
+                        found_nodes = decode_compact_nodes(response.get('nodes', b''))
+                        found_peers = _decode_values(response.get('values', []))
+                    except DHTError as e:
+                        logging.debug(f'DHT node {node.address} failed {method.decode()}. Exception: {e}')
+                        self._table.node_failed(node.id)
+                        del candidates[node.id]
+                        continue
+
+                    responders.append((node, response.get('token')))
+                    peers.update(found_peers)
+                    for found_node in found_nodes:
+                        if found_node.id != self._table.node_id:
+                            candidates.setdefault(found_node.id, found_node)
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+        _LOOKUP_DURATION.observe(self._loop.time() - start_time)
+        responders.sort(key=lambda responder: distance(responder[0]))
+        return list(peers), responders[:self._k]
+
+    async def _query(self, address, method, arguments):
+        if not self._transport:
+            raise DHTError(f'DHT node not started')
+
+        transaction_id = _TRANSACTION_ID.pack(next(self._transaction_ids) & 0xffff)
+        future = self._loop.create_future()
+        self._pending[transaction_id] = (future, address)
+
+        arguments = dict(arguments, id=self.node_id)
+        message = {'a': _sorted_dict(arguments), 'q': method, 't': transaction_id, 'y': b'q'}
+        _QUERIES_SENT.inc()
+        try:
+            self._transport.sendto(bencoding.encode(message), address)
+            return await asyncio.wait_for(future, self._query_timeout)
+        except asyncio.TimeoutError:
+            _QUERY_TIMEOUTS.inc()
+            raise DHTError(f'Query {method.decode()} to {address} timed out') from None
+        finally:
+            self._pending.pop(transaction_id, None)
+
+    async def _resolve(self, address):
+        host, port = address
+        try:
+            infos = await self._loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        except OSError as e:
+            logging.warning(f'Failed to resolve DHT bootstrap node {host}:{port}. Exception: {e}')
+            return None
+
+        return infos[0][4] if infos else None
+
+    def _datagram_received(self, data, address):
+        try:
+            message = bencoding.decode(data)
+        except bencoding.BencodingError:
+            logging.debug(f'Invalid DHT message from {address}')
+            return
+
+        if not isinstance(message, dict) or not isinstance(message.get('t'), bytes):
+            return
+
+        message_type = message.get('y')
+        if message_type == b'q':
+            self._handle_query(message, address)
+        elif message_type in (b'r', b'e'):
+            self._handle_reply(message, address)
+
+    def _handle_reply(self, message, address):
+        pending = self._pending.get(message['t'])
+        if not pending or pending[1] != address:
+            return
+
+        future, _ = self._pending.pop(message['t'])
+        if future.done():
+            return
+
+        if message['y'] == b'e':
+            future.set_exception(DHTError(f'Error reply from {address}: {message.get("e")}'))
+            return
+
+        response = message.get('r')
+        node_id = response.get('id') if isinstance(response, dict) else None
+        if not isinstance(node_id, bytes) or len(node_id) != ID_LENGTH:
+            future.set_exception(DHTError(f'Invalid reply from {address}'))
+            return
+
+        self._table.add(int.from_bytes(node_id, 'big'), address)
+        future.set_result(response)
+
+    def _handle_query(self, message, address):
+        _QUERIES_RECEIVED.inc()
+        transaction_id = message['t']
+        arguments = message.get('a')
+        node_id = arguments.get('id') if isinstance(arguments, dict) else None
+        if not isinstance(node_id, bytes) or len(node_id) != ID_LENGTH:
+            self._send_error(transaction_id, _ERROR_PROTOCOL, 'Invalid arguments', address)
+            return
+
+        handler = self._query_handlers.get(message.get('q'))
+        if not handler:
+            self._send_error(transaction_id, _ERROR_METHOD_UNKNOWN, 'Method unknown', address)
+            return
+
+        try:
+            response = handler(arguments, address)
+        except DHTError as e:
+            self._send_error(transaction_id, _ERROR_PROTOCOL, str(e), address)
+            return
+
+        self._table.add(int.from_bytes(node_id, 'big'), address)
+        response['id'] = self.node_id
+        self._send({'r': _sorted_dict(response), 't': transaction_id, 'y': b'r'}, address)
+
+    def _on_ping(self, arguments, address):
+        return {}
+
+    def _on_find_node(self, arguments, address):
+        target = _get_id_argument(arguments, 'target')
+        return {'nodes': encode_compact_nodes(self._table.closest(target))}
+
+    def _on_get_peers(self, arguments, address):
+        info_hash = _get_id_argument(arguments, 'info_hash')
+        response = {
+            'nodes': encode_compact_nodes(self._table.closest(info_hash)),
+            'token': self._make_token(address[0], self._token_secrets[0]),
+        }
+
+        stored_peers = self._stored_peers.get(arguments['info_hash'])
+        if stored_peers:
+            peers = random.sample(list(stored_peers), min(len(stored_peers), _MAX_VALUES))
+            response['values'] = [encode_compact_peers([peer]) for peer in peers]
+
+        return response
+
+    def _on_announce_peer(self, arguments, address):
+        _get_id_argument(arguments, 'info_hash')
+        token = arguments.get('token')
+        if not any(token == self._make_token(address[0], secret) for secret in self._token_secrets):
+            raise DHTError(f'Invalid token')
+
+        port = address[1] if arguments.get('implied_port') else arguments.get('port')
+        if not isinstance(port, int) or not 0 < port < 65536:
+            raise DHTError(f'Invalid port')
+
+        stored_peers = self._stored_peers.setdefault(arguments['info_hash'], {})
+        peer = (address[0], port)
+        if peer in stored_peers or len(stored_peers) < self._max_peers_per_torrent:
+            stored_peers[peer] = time.monotonic() + self._peer_ttl
+
+        return {}
+
+    def _make_token(self, ip, secret):
+        return hashlib.sha1(secret + ip.encode()).digest()[:_TOKEN_LENGTH]
+
+    def _send(self, message, address):
+        if self._transport:
+            self._transport.sendto(bencoding.encode(message), address)
+
+    def _send_error(self, transaction_id, code, text, address):
+        logging.debug(f'Sending DHT error {code} to {address}: {text}')
+        self._send({'e': [code, text], 't': transaction_id, 'y': b'e'}, address)
+
+    def _wake_up(self):
+        self._token_secrets = [os.urandom(16), self._token_secrets[0]]
+        self._expire_stored_peers()
+        if not self._refresh_task or self._refresh_task.done():
+            self._refresh_task = self._loop.create_task(self._refresh())
+        self._wake_up_task = self._loop.call_later(self._maintenance_interval, self._wake_up)
+
+    # Lookups run one after another, so maintenance does not burst queries at the network
+    async def _refresh(self):
+        targets = [self._table.get_random_id_in_bucket(i) for i in self._table.get_stale_buckets(_BUCKET_REFRESH_AGE)]
+        if len(self._table) < self._k:
+            targets.append(self._table.node_id)
+
+        logging.debug(f'Refreshing {len(targets)} DHT buckets')
+        for target in targets:
+            await self._lookup(target.to_bytes(ID_LENGTH, 'big'), b'find_node')
+
+        self._save_state()
+
+    def _expire_stored_peers(self):
+        now = time.monotonic()
+        for info_hash, stored_peers in list(self._stored_peers.items()):
+            for peer, expires_at in list(stored_peers.items()):
+                if expires_at <= now:
+                    del stored_peers[peer]
+            if not stored_peers:
+                del self._stored_peers[info_hash]
+
+    def _save_state(self):
+        if not self._state_path:
+            return
+
+        try:
+            self._table.save(self._state_path)
+        except DHTError as e:
+            logging.warning(f'Failed to save DHT routing table. Exception: {e}')
+
+
+class _DHTProtocol(asyncio.DatagramProtocol):
+    def __init__(self, node):
+        self._node = node
+
+    def datagram_received(self, data, address):
+        self._node._datagram_received(data, address)
+
+    def error_received(self, exc):
+        logging.debug(f'DHT socket error: {exc}')
+
+
+class DHTAnnouncer:
+    # Announces download to DHT periodically and hands found peers to coordinator the same way
+    # tracker announcers do, so DHT is just one more peer source
+    def __init__(self, dht, download_info, coordinator, interval=900, loop=None):
+        self._dht = dht
+        self._download_info = download_info
+        self._coordinator = coordinator
+        self._interval = interval
+        self._loop = loop if loop else asyncio.get_event_loop()
+        self._stopped = asyncio.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    async def announcing(self):
+        info_hash = self._download_info.info_hash
+        logging.info(f'Starting DHT announcing for {info_hash.hex()}')
+
+        while not self._stopped.is_set():
+            try:
+                peers = await self._dht.announce_peer(info_hash, self._download_info.port)
+            except DHTError as e:
+                logging.warning(f'Failed to announce {info_hash.hex()} to DHT. Exception: {e}')
+                self._coordinator.process_announcer_error('normal')
+            else:
+                # Swarm size is not known in DHT
+                self._coordinator.process_announce_result(AnnounceResult(None, None, peers), source='dht')
+
+            try:
+                await asyncio.wait_for(self._stopped.wait(), self._interval)
+            except asyncio.TimeoutError:
+                pass
+
+        logging.info(f'Stopped DHT announcing for {info_hash.hex()}')
+
+
+def _get_id_argument(arguments, name):
+    value = arguments.get(name)
+    if not isinstance(value, bytes) or len(value) != ID_LENGTH:
+        raise DHTError(f'Invalid {name}')
+    return int.from_bytes(value, 'big')
+
+
+def _decode_values(values):
+    if not isinstance(values, list):
+        raise DHTError(f'Invalid values type: {type(values)}')
+
+    peers = []
+    for value in values:
+        if not isinstance(value, bytes):
+            raise DHTError(f'Invalid value type: {type(value)}')
+        try:
+            peers.extend(decode_compact_peers(value))
+        except PeerError as e:
+            raise DHTError(f'Invalid peer value') from e
+
+    return peers
+
+
+# Bencoded dictionaries must have sorted keys, and bencoding.encode keeps insertion order
+def _sorted_dict(d):
+    return dict(sorted(d.items()))
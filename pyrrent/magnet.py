@@ -0,0 +1,414 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import math
+import os
+import struct
+from urllib.parse import urlsplit, parse_qs
+
+from pyrrent import bencoding
+from pyrrent.connections import (encode_handshake, decode_handshake, HANDSHAKE_LENGTH,
+                                 ConnectionManagerError)
+from pyrrent.metafile import Metafile
+from pyrrent.utils import Cache
+from pyrrent.utils.metrics import REGISTRY
+
+
+_METADATA_FETCH_DURATION = REGISTRY.histogram('pyrrent_metadata_fetch_duration_seconds',
+                                              'Duration of successful metadata fetches from peers')
+_METADATA_CACHE_HITS = REGISTRY.counter('pyrrent_metadata_cache_hits_total', 'Metadata served from cache')
+
+
+class MagnetError(Exception):
+    pass
+
+
+METADATA_PIECE_LENGTH = 2 ** 14
+# Larger info dictionaries are refused - nothing legitimate comes close, and size is peer supplied
+MAX_METADATA_SIZE = 2 ** 24
+
+_MESSAGE_LENGTH = struct.Struct('!I')
+# Large enough for bitfields of big torrents, which peers may send before anything else
+_MAX_MESSAGE_LENGTH = 2 ** 18
+
+_EXTENDED_MESSAGE_ID = 20
+_EXTENDED_HANDSHAKE_ID = 0
+# ID peers use for ut_metadata messages sent to us, announced in our extended handshake
+_UT_METADATA_ID = 1
+
+_REQUEST = 0
+_DATA = 1
+_REJECT = 2
+
+
+class MagnetLink:
+    @classmethod
+    def parse(cls, uri):
+        parts = urlsplit(uri)
+        if parts.scheme != 'magnet':
+            raise MagnetError(f'Not a magnet link: {uri}')
+
+        params = parse_qs(parts.query)
+        exact_topics = [topic for topic in params.get('xt', []) if topic.startswith('urn:btih:')]
+        if not exact_topics:
+            raise MagnetError(f'Magnet link without BitTorrent info hash: {uri}')
+
+        info_hash = _decode_info_hash(exact_topics[0][len('urn:btih:'):])
+        name = params.get('dn', [None])[0]
+        trackers = params.get('tr', [])
+        peers = [_parse_peer_address(address) for address in params.get('x.pe', [])]
+
+        return cls(info_hash, name, trackers, peers)
+
+    def __init__(self, info_hash, name=None, trackers=(), peers=()):
+        self.info_hash = info_hash
+        self.name = name
+        self.trackers = list(trackers)
+        self.peers = list(peers)
+
+
+def _decode_info_hash(encoded):
+    try:
+        if len(encoded) == 40:
+            return bytes.fromhex(encoded)
+        if len(encoded) == 32:
+            return base64.b32decode(encoded.upper())
+    except ValueError as e:
+        raise MagnetError(f'Invalid info hash: {encoded}') from e
+
+    raise MagnetError(f'Invalid info hash length: {len(encoded)}')
+
+
+def _parse_peer_address(address):
+    host, _, port = address.rpartition(':')
+    try:
+        port = int(port)
+    except ValueError:
+        raise MagnetError(f'Invalid peer address: {address}') from None
+
+    if not host or not 0 < port < 65536:
+        raise MagnetError(f'Invalid peer address: {address}')
+
+    return host.strip('[]'), port
+
+
+class MetadataCache:
+    # Keeps fetched info dictionaries in memory and, with path given, on disk, so adding the same
+    # magnet again does not touch the network. Entries are checked against info hash when loaded
+    def __init__(self, path=None, max_records=100):
+        self._path = path
+        self._records = Cache(max_records)
+
+    def get(self, info_hash):
+        encoded_info = self._records.get(info_hash)
+        if encoded_info is None and self._path:
+            encoded_info = self._load(info_hash)
+            if encoded_info is not None:
+                self._records.put(info_hash, encoded_info)
+
+        if encoded_info is not None:
+            _METADATA_CACHE_HITS.inc()
+        return encoded_info
+
+    def put(self, info_hash, encoded_info):
+        self._records.put(info_hash, encoded_info)
+        if not self._path:
+            return
+
+        metadata_path = self._get_metadata_path(info_hash)
+        temp_path = metadata_path + '.tmp'
+        try:
+            os.makedirs(self._path, 0o700, exist_ok=True)
+            with open(temp_path, 'wb') as f:
+                f.write(encoded_info)
+            os.replace(temp_path, metadata_path)
+        except OSError as e:
+            # Cache is only a shortcut, losing an entry costs a refetch
+            logging.warning(f'Failed to save metadata for {info_hash.hex()}. Exception: {e}')
+
+    def _load(self, info_hash):
+        metadata_path = self._get_metadata_path(info_hash)
+        try:
+            with open(metadata_path, 'rb') as f:
+                encoded_info = f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logging.warning(f'Failed to read cached metadata for {info_hash.hex()}. Exception: {e}')
+            return None
+
+        if hashlib.sha1(encoded_info).digest() != info_hash:
+            logging.warning(f'Discarding corrupted cached metadata for {info_hash.hex()}')
+            return None
+
+        return encoded_info
+
+    def _get_metadata_path(self, info_hash):
+        return os.path.join(self._path, f'{info_hash.hex()}.info')
+
+
+class MetadataFetcher:
+    # Fetches info dictionary from peers with ut_metadata (BEP 9). Up to max_connections peers are
+    # asked at once, each taking the next piece nobody is working on, so pieces come in parallel.
+    # When all pieces are in flight, idle peers duplicate the least requested one. If a dictionary
+    # assembled from several peers fails the hash check, the bad peer cannot be told apart, so from
+    # then on every peer has to deliver the whole dictionary itself and only failing peers are banned.
+    # With an optional pyrrent.utils.MemoryBudget, the assembly buffer is accounted as metadata, and
+    # each peer's own copy in single source mode has to fit in the budget or the peer is dropped
+    def __init__(self, info_hash, peer_id, max_connections=8, connect_timeout=5, request_timeout=10,
+                 memory_budget=None, loop=None):
+        self._info_hash = info_hash
+        self._peer_id = peer_id
+        self._max_connections = max_connections
+        self._connect_timeout = connect_timeout
+        self._request_timeout = request_timeout
+        self._loop = loop if loop else asyncio.get_event_loop()
+        self._memory_budget = memory_budget
+        self._metadata_size = None
+        self._pieces = []
+        self._piece_sources = []
+        self._in_flight = {}
+        self._banned = set()
+        self._single_source = False
+        self._result = None
+
+    async def fetch(self, peers):
+        logging.info(f'Fetching metadata for {self._info_hash.hex()} from up to {len(peers)} peers')
+        start_time = self._loop.time()
+        remaining = list(peers)
+        tasks = set()
+
+        try:
+            while self._result is None and (remaining or tasks):
+                while remaining and len(tasks) < self._max_connections:
+                    tasks.add(self._loop.create_task(self._fetch_from_peer(remaining.pop(0))))
+
+                _, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if self._memory_budget and self._metadata_size is not None:
+                self._memory_budget.release('metadata', self._metadata_size)
+
+        if self._result is None:
+            raise MagnetError(f'Failed to fetch metadata for {self._info_hash.hex()} from {len(peers)} peers')
+
+        _METADATA_FETCH_DURATION.observe(self._loop.time() - start_time)
+        return self._result
+
+    async def _fetch_from_peer(self, peer):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*peer), self._connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            logging.debug(f'Failed to connect to {peer} for metadata. Exception: {e}')
+            return
+
+        own_copy_reserved = False
+        try:
+            metadata_id, metadata_size = await asyncio.wait_for(self._handshake(reader, writer),
+                                                                self._request_timeout)
+            if not self._accept_metadata_size(metadata_size):
+                logging.debug(f'Peer {peer} reported unusable metadata size {metadata_size}')
+                return
+
+            own_pieces = {}
+            while self._result is None and peer not in self._banned:
+                if self._single_source and self._memory_budget and not own_copy_reserved:
+                    if not self._memory_budget.try_allocate('metadata', self._metadata_size):
+                        logging.debug(f'No memory left to fetch own metadata copy from {peer}')
+                        return
+                    own_copy_reserved = True
+
+                piece_index = self._get_next_piece(own_pieces)
+                _send_extended(writer, metadata_id, {'msg_type': _REQUEST, 'piece': piece_index})
+                self._in_flight[piece_index] = self._in_flight.get(piece_index, 0) + 1
+                try:
+                    received = await asyncio.wait_for(self._receive_piece(reader, piece_index), self._request_timeout)
+                finally:
+                    self._in_flight[piece_index] -= 1
+
+                if not received:
+                    logging.debug(f'Peer {peer} rejected metadata piece {piece_index}')
+                    return
+                own_pieces[piece_index] = received
+                self._store_piece(piece_index, received, peer, own_pieces)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, MagnetError) as e:
+            logging.debug(f'Failed to fetch metadata from {peer}. Exception: {e}')
+        finally:
+            writer.close()
+            if own_copy_reserved:
+                self._memory_budget.release('metadata', self._metadata_size)
+
+    async def _handshake(self, reader, writer):
+        writer.write(encode_handshake(self._info_hash, self._peer_id))
+        _send_extended(writer, _EXTENDED_HANDSHAKE_ID, {'m': {'ut_metadata': _UT_METADATA_ID}})
+        await writer.drain()
+
+        try:
+            info_hash, _, reserved = decode_handshake(await reader.readexactly(HANDSHAKE_LENGTH))
+        except ConnectionManagerError as e:
+            raise MagnetError(f'Invalid handshake') from e
+
+        if info_hash != self._info_hash:
+            raise MagnetError(f'Peer serves different info hash: {info_hash.hex()}')
+        if not reserved[5] & 0x10:
+            raise MagnetError(f'Peer does not support extension protocol')
+
+        # Peer may send bitfield and other messages before its extended handshake
+        while True:
+            extended_id, payload = await _read_extended(reader)
+            if extended_id == _EXTENDED_HANDSHAKE_ID:
+                break
+
+        header, _ = _decode_extended_payload(payload)
+        extensions = header.get('m')
+        metadata_id = extensions.get('ut_metadata') if isinstance(extensions, dict) else None
+        metadata_size = header.get('metadata_size')
+        if not isinstance(metadata_id, int) or not metadata_id:
+            raise MagnetError(f'Peer does not support ut_metadata')
+        if not isinstance(metadata_size, int):
+            raise MagnetError(f'Peer did not report metadata size')
+
+        return metadata_id, metadata_size
+
+    async def _receive_piece(self, reader, piece_index):
+        while True:
+            extended_id, payload = await _read_extended(reader)
+            if extended_id != _UT_METADATA_ID:
+                continue
+
+            header, data = _decode_extended_payload(payload)
+            message_type = header.get('msg_type')
+            if header.get('piece') != piece_index:
+                continue
+            if message_type == _REJECT:
+                return None
+            if message_type == _DATA:
+                if len(data) != self._get_piece_length(piece_index):
+                    raise MagnetError(f'Metadata piece {piece_index} has invalid length {len(data)}')
+                return data
+
+    # First peer to report a plausible size sets it, later peers have to agree
+    def _accept_metadata_size(self, metadata_size):
+        if self._metadata_size is None:
+            if not 0 < metadata_size <= MAX_METADATA_SIZE:
+                return False
+
+            self._metadata_size = metadata_size
+            if self._memory_budget:
+                self._memory_budget.allocate('metadata', metadata_size)
+            piece_count = math.ceil(metadata_size / METADATA_PIECE_LENGTH)
+            self._pieces = [None] * piece_count
+            self._piece_sources = [None] * piece_count
+            return True
+
+        return metadata_size == self._metadata_size
+
+    def _get_next_piece(self, own_pieces):
+        if self._single_source:
+            missing = [i for i in range(len(self._pieces)) if i not in own_pieces]
+        else:
+            missing = [i for i, piece in enumerate(self._pieces) if piece is None]
+        return min(missing, key=lambda i: self._in_flight.get(i, 0))
+
+    def _get_piece_length(self, piece_index):
+        return min(METADATA_PIECE_LENGTH, self._metadata_size - piece_index * METADATA_PIECE_LENGTH)
+
+    def _store_piece(self, piece_index, data, peer, own_pieces):
+        if self._result is not None:
+            return
+
+        if self._single_source:
+            if len(own_pieces) < len(self._pieces):
+                return
+            if not self._verify(b''.join(own_pieces[i] for i in range(len(self._pieces)))):
+                logging.warning(f'Peer {peer} sent metadata failing hash check')
+                self._banned.add(peer)
+            return
+
+        if self._pieces[piece_index] is not None:
+            return
+
+        self._pieces[piece_index] = data
+        self._piece_sources[piece_index] = peer
+        if any(piece is None for piece in self._pieces):
+            return
+
+        if self._verify(b''.join(self._pieces)):
+            return
+
+        sources = set(self._piece_sources)
+        logging.warning(f'Metadata for {self._info_hash.hex()} from {len(sources)} peers failed hash check')
+        if len(sources) == 1:
+            self._banned.update(sources)
+        else:
+            self._single_source = True
+        self._pieces = [None] * len(self._pieces)
+        self._piece_sources = [None] * len(self._pieces)
+
+    def _verify(self, encoded_info):
+        if hashlib.sha1(encoded_info).digest() != self._info_hash:
+            return False
+
+        logging.info(f'Fetched metadata for {self._info_hash.hex()}. Size: {self._metadata_size}')
+        self._result = encoded_info
+        return True
+
+
+# Returns bencoded info dictionary for the magnet link, from cache when possible. Peers are taken
+# from the link itself and from DHT if given, extra_peers (such as tracker results) are tried first
+async def fetch_metadata(magnet, peer_id, cache=None, dht=None, extra_peers=(), loop=None, **fetcher_options):
+    encoded_info = cache.get(magnet.info_hash) if cache else None
+    if encoded_info is not None:
+        return encoded_info
+
+    peers = list(dict.fromkeys(list(extra_peers) + magnet.peers))
+    if dht:
+        peers.extend(peer for peer in await dht.get_peers(magnet.info_hash) if peer not in peers)
+
+    fetcher = MetadataFetcher(magnet.info_hash, peer_id, loop=loop, **fetcher_options)
+    encoded_info = await fetcher.fetch(peers)
+    if cache:
+        cache.put(magnet.info_hash, encoded_info)
+
+    return encoded_info
+
+
+async def resolve_magnet(magnet, peer_id, cache=None, dht=None, extra_peers=(), loop=None, **fetcher_options):
+    encoded_info = await fetch_metadata(magnet, peer_id, cache, dht, extra_peers, loop, **fetcher_options)
+    return Metafile.from_info(encoded_info, magnet.trackers[0] if magnet.trackers else None)
+
+
+def _send_extended(writer, extended_id, header, data=b''):
+    payload = bytes([_EXTENDED_MESSAGE_ID, extended_id]) + bencoding.encode(_sorted_dict(header)) + data
+    writer.write(_MESSAGE_LENGTH.pack(len(payload)) + payload)
+
+
+# Skips keep-alives and regular peer messages, returns (extended message ID, payload)
+async def _read_extended(reader):
+    while True:
+        length, = _MESSAGE_LENGTH.unpack(await reader.readexactly(_MESSAGE_LENGTH.size))
+        if length > _MAX_MESSAGE_LENGTH:
+            raise MagnetError(f'Peer message too long: {length}')
+        if not length:
+            continue
+
+        message = await reader.readexactly(length)
+        if message[0] == _EXTENDED_MESSAGE_ID and length > 1:
+            return message[1], message[2:]
+
+
+def _decode_extended_payload(payload):
+    try:
+        header, data = bencoding.decode_partial(payload)
+    except bencoding.BencodingError as e:
+        raise MagnetError(f'Invalid extended message') from e
+
+    if not isinstance(header, dict):
+        raise MagnetError(f'Invalid extended message header type: {type(header)}')
+    return header, data
+
+
+def _sorted_dict(d):
+    return dict(sorted(d.items()))
@@ -19,9 +19,40 @@ class Metafile:
         try:
             announce_url = decoded_content['announce'].decode('ascii')
             info = decoded_content['info']
-            if not isinstance(info, dict):
-                raise MetafileError(f'Invalid metafile. Invalid info field type: {type(info)}')
+        except KeyError as e:
+            raise MetafileError(f'Missing required metafile field: {e}') from e
+        except ValueError as e:
+            raise MetafileError(f'Metafile contains invalid field') from e
+
+        if not isinstance(info, dict):
+            raise MetafileError(f'Invalid metafile. Invalid info field type: {type(info)}')
+
+        # Must use originally encoded, since info hash can encode to different value
+        # because it is an unordered map
+        encoded_info = encode(info)
+        info_index = encoded_content.find(b'4:info') + 6
+        original_encoded_info = encoded_content[info_index:info_index + len(encoded_info)]
+        info_hash = hashlib.sha1(original_encoded_info).digest()
+
+        return cls._from_decoded_info(info, info_hash, announce_url)
+
+    # Builds metafile from bencoded info dictionary alone, such as one fetched from peers for
+    # a magnet link. Announce URL is optional, torrents from magnet links may be trackerless
+    @classmethod
+    def from_info(cls, encoded_info, announce_url=None):
+        try:
+            info = decode(encoded_info)
+        except BencodingError as e:
+            raise MetafileError(f'Failed to decode provided info') from e
+
+        if not isinstance(info, dict):
+            raise MetafileError(f'Invalid info type: {type(info)}')
 
+        return cls._from_decoded_info(info, hashlib.sha1(encoded_info).digest(), announce_url)
+
+    @classmethod
+    def _from_decoded_info(cls, info, info_hash, announce_url):
+        try:
             files = FileInfo.from_info(info)
             pieces = Piece.from_info(info)
         except KeyError as e:
@@ -35,14 +66,9 @@ class Metafile:
         if not pieces:
             raise MetafileError(f'Invalid metafile. Empty pieces list')
 
-        pieces[-1].length = sum(file.length for file in files) % pieces[-1].length
-
-        # Must use originally encoded, since info hash can encode to different value
-        # because it is an unordered map
-        encoded_info = encode(info)
-        info_index = encoded_content.find(b'4:info') + 6
-        original_encoded_info = encoded_content[info_index:info_index + len(encoded_info)]
-        info_hash = hashlib.sha1(original_encoded_info).digest()
+        last_piece_length = sum(file.length for file in files) % pieces[-1].length
+        if last_piece_length:
+            pieces[-1].length = last_piece_length
 
         return cls(info_hash, announce_url, pieces, files)
 
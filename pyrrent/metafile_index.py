@@ -0,0 +1,389 @@
+import logging
+import mmap
+import os
+import struct
+from collections.abc import Sequence
+
+from pyrrent.metafile import Metafile, FileInfo, Piece
+
+
+class MetafileIndexError(Exception):
+    pass
+
+
+_MAGIC = b'PYMI'
+_VERSION = 2
+# Magic, version, hashes blob generation, entry count
+_HEADER = struct.Struct('!4sHII')
+_STRING_LENGTH = struct.Struct('!H')
+_ENTRY_FIELDS = struct.Struct('!qq20sQQIQI')
+_FILE_LENGTH = struct.Struct('!Q')
+
+_INDEX_FILE_NAME = 'index'
+_HASHES_FILE_NAME = 'hashes'
+_HASH_LENGTH = 20
+# Blob is compacted on save once at least this share of it belongs to no entry
+_COMPACTION_RATIO = 0.5
+
+
+class MetafileIndex:
+    # Keeps everything needed to rebuild a Metafile except piece hashes in a compact index file,
+    # and piece hashes in a separate append-only blob that is mmapped and read only on demand.
+    # Entries are invalidated when mtime or size of the source .torrent changes.
+    # Hashes of invalidated and removed entries stay in the blob until save finds enough of them,
+    # then live hashes are copied to a blob of the next generation. Index names the generation it
+    # belongs to, so a crash in between leaves either the old or the new pair in use
+    @classmethod
+    def open(cls, path):
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path, 0o700)
+            except OSError as e:
+                raise MetafileIndexError(f'Failed to create metafile index at: {path}') from e
+
+        index = cls(path)
+        index._load_entries()
+        index._remove_unused_hashes_files()
+        return index
+
+    def __init__(self, path):
+        self._path = path
+        self._index_path = os.path.join(path, _INDEX_FILE_NAME)
+        self._generation = 0
+        self._hashes_path = self._get_hashes_path(self._generation)
+        self._entries = {}
+        # Entries dropped since last compaction, Metafiles built from them may still read hashes
+        self._stale_entries = []
+        self._hashes_file = None
+        self._hashes_map = None
+        self._hashes_size = None
+        self._dirty = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self, metafile_path):
+        try:
+            file_stat = os.stat(metafile_path)
+        except OSError as e:
+            raise MetafileIndexError(f'Failed to stat metafile: {metafile_path}') from e
+
+        entry = self._entries.get(metafile_path)
+        if entry and entry.mtime_ns == file_stat.st_mtime_ns and entry.size == file_stat.st_size:
+            # Blob may be shorter than the index expects if the process died before it was synced
+            if self._has_hashes(entry):
+                return self._build_metafile(entry)
+            logging.warning(f'Piece hashes of {metafile_path} missing from {self._hashes_path}')
+
+        logging.debug(f'Metafile index miss for {metafile_path}')
+        try:
+            with open(metafile_path, 'rb') as f:
+                content = f.read()
+        except OSError as e:
+            raise MetafileIndexError(f'Failed to read metafile: {metafile_path}') from e
+
+        metafile = Metafile.parse(content)
+        self._add_entry(metafile_path, file_stat, metafile)
+        return metafile
+
+    def remove(self, metafile_path):
+        entry = self._entries.pop(metafile_path, None)
+        if entry:
+            self._stale_entries.append(entry)
+            self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+
+        old_hashes_path = self._compact_if_needed()
+        self._sync_hashes()
+
+        logging.debug(f'Saving metafile index with {len(self._entries)} entries to {self._path}')
+        temp_path = self._index_path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(_HEADER.pack(_MAGIC, _VERSION, self._generation, len(self._entries)))
+                for entry in self._entries.values():
+                    f.write(entry.serialize())
+            os.replace(temp_path, self._index_path)
+        except OSError as e:
+            raise MetafileIndexError(f'Failed to save metafile index to: {self._index_path}') from e
+
+        self._dirty = False
+        if old_hashes_path:
+            _remove_quietly(old_hashes_path)
+
+    def close(self):
+        self.save()
+        self._close_hashes()
+
+    def _close_hashes(self):
+        if self._hashes_map:
+            self._hashes_map.close()
+            self._hashes_map = None
+        if self._hashes_file:
+            self._hashes_file.close()
+            self._hashes_file = None
+
+    def _load_entries(self):
+        try:
+            with open(self._index_path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            raise MetafileIndexError(f'Failed to read metafile index: {self._index_path}') from e
+
+        # Index is only a cache, so a damaged one is dropped instead of failing startup
+        try:
+            magic, version, generation, entry_count = _HEADER.unpack_from(content)
+            if magic != _MAGIC or version != _VERSION:
+                raise ValueError(f'Unsupported index format')
+
+            offset = _HEADER.size
+            for _ in range(entry_count):
+                entry, offset = _IndexEntry.deserialize(content, offset)
+                self._entries[entry.source_path] = entry
+        except (struct.error, ValueError, UnicodeDecodeError) as e:
+            logging.warning(f'Discarding invalid metafile index at {self._index_path}. Exception: {e}')
+            self._entries = {}
+            self._dirty = True
+            return
+
+        self._generation = generation
+        self._hashes_path = self._get_hashes_path(generation)
+
+    # Leftovers of compactions interrupted before or after the index was replaced
+    def _remove_unused_hashes_files(self):
+        for name in os.listdir(self._path):
+            path = os.path.join(self._path, name)
+            if name.startswith(_HASHES_FILE_NAME) and path != self._hashes_path:
+                _remove_quietly(path)
+
+    # Returns path of the replaced blob, to be removed once the index referring to it is replaced
+    def _compact_if_needed(self):
+        size = self._get_hashes_size()
+        live_size = sum(entry.piece_count for entry in self._entries.values()) * _HASH_LENGTH
+        if size == 0 or size - live_size < size * _COMPACTION_RATIO:
+            return None
+
+        generation = self._generation + 1
+        new_path = self._get_hashes_path(generation)
+        logging.debug(f'Compacting piece hashes from {size} to {live_size} bytes into {new_path}')
+
+        offsets = {}
+        try:
+            with open(new_path, 'wb') as f:
+                for entry in list(self._entries.values()):
+                    if not self._has_hashes(entry):
+                        # Gets reparsed on next load anyway
+                        del self._entries[entry.source_path]
+                        self._stale_entries.append(entry)
+                        continue
+
+                    offsets[entry.source_path] = f.tell()
+                    f.write(self._read_hashes(entry.hashes_offset, entry.piece_count * _HASH_LENGTH))
+                f.flush()
+                os.fsync(f.fileno())
+                new_size = f.tell()
+        except OSError as e:
+            _remove_quietly(new_path)
+            raise MetafileIndexError(f'Failed to compact piece hashes into: {new_path}') from e
+
+        self._close_hashes()
+        for entry in self._entries.values():
+            entry.hashes_offset = offsets[entry.source_path]
+        for entry in self._stale_entries:
+            entry.hashes_offset = -1
+        self._stale_entries = []
+
+        old_path = self._hashes_path
+        self._generation = generation
+        self._hashes_path = new_path
+        self._hashes_size = new_size
+        return old_path
+
+    def _sync_hashes(self):
+        if not self._hashes_file:
+            return
+
+        try:
+            self._hashes_file.flush()
+            os.fsync(self._hashes_file.fileno())
+        except OSError as e:
+            raise MetafileIndexError(f'Failed to sync piece hashes: {self._hashes_path}') from e
+
+    def _add_entry(self, metafile_path, file_stat, metafile):
+        hashes = b''.join(piece.hash for piece in metafile.pieces)
+        old_entry = self._entries.get(metafile_path)
+        if old_entry:
+            self._stale_entries.append(old_entry)
+
+        hashes_file = self._get_hashes_file()
+        try:
+            hashes_file.seek(0, os.SEEK_END)
+            hashes_offset = hashes_file.tell()
+            hashes_file.write(hashes)
+            hashes_file.flush()
+            self._hashes_size = hashes_offset + len(hashes)
+        except OSError as e:
+            raise MetafileIndexError(f'Failed to write piece hashes to: {self._hashes_path}') from e
+
+        # Blob grew, map has to be recreated on next read
+        if self._hashes_map:
+            self._hashes_map.close()
+            self._hashes_map = None
+
+        entry = _IndexEntry(metafile_path, file_stat.st_mtime_ns, file_stat.st_size, metafile.info_hash,
+                            metafile.announce_url, metafile.pieces[0].length, metafile.pieces[-1].length,
+                            len(metafile.pieces), hashes_offset,
+                            [(file.path, file.length) for file in metafile.files])
+        self._entries[metafile_path] = entry
+        self._dirty = True
+
+    def _build_metafile(self, entry):
+        files = [FileInfo(path, length) for path, length in entry.files]
+        pieces = _LazyPieces(self, entry)
+        return Metafile(entry.info_hash, entry.announce_url, pieces, files)
+
+    def _read_hashes(self, offset, length):
+        if not self._hashes_map:
+            hashes_file = self._get_hashes_file()
+            try:
+                self._hashes_map = mmap.mmap(hashes_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError) as e:
+                raise MetafileIndexError(f'Failed to map piece hashes: {self._hashes_path}') from e
+
+        data = self._hashes_map[offset:offset + length]
+        if len(data) != length:
+            raise MetafileIndexError(f'Piece hashes blob truncated: {self._hashes_path}')
+        return data
+
+    def _has_hashes(self, entry):
+        end = entry.hashes_offset + entry.piece_count * _HASH_LENGTH
+        return entry.hashes_offset >= 0 and end <= self._get_hashes_size()
+
+    def _get_hashes_size(self):
+        if self._hashes_size is None:
+            try:
+                self._hashes_size = os.path.getsize(self._hashes_path)
+            except FileNotFoundError:
+                self._hashes_size = 0
+            except OSError as e:
+                raise MetafileIndexError(f'Failed to stat piece hashes: {self._hashes_path}') from e
+        return self._hashes_size
+
+    def _get_hashes_path(self, generation):
+        return os.path.join(self._path, f'{_HASHES_FILE_NAME}-{generation}')
+
+    def _get_hashes_file(self):
+        if not self._hashes_file:
+            try:
+                self._hashes_file = open(self._hashes_path, 'a+b')
+            except OSError as e:
+                raise MetafileIndexError(f'Failed to open piece hashes: {self._hashes_path}') from e
+        return self._hashes_file
+
+
+class _IndexEntry:
+    __slots__ = ('source_path', 'mtime_ns', 'size', 'info_hash', 'announce_url', 'piece_length',
+                 'last_piece_length', 'piece_count', 'hashes_offset', 'files')
+
+
+    def __init__(self, source_path, mtime_ns, size, info_hash, announce_url, piece_length,
+                 last_piece_length, piece_count, hashes_offset, files):
+        self.source_path = source_path
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.info_hash = info_hash
+        self.announce_url = announce_url
+        self.piece_length = piece_length
+        self.last_piece_length = last_piece_length
+        self.piece_count = piece_count
+        self.hashes_offset = hashes_offset
+        self.files = files
+
+    def serialize(self):
+        parts = [
+            _pack_string(self.source_path),
+            _pack_string(self.announce_url),
+            _ENTRY_FIELDS.pack(self.mtime_ns, self.size, self.info_hash, self.piece_length,
+                               self.last_piece_length, self.piece_count, self.hashes_offset, len(self.files)),
+        ]
+        for path, length in self.files:
+            parts.append(_pack_string(path))
+            parts.append(_FILE_LENGTH.pack(length))
+
+        return b''.join(parts)
+
+    @classmethod
+    def deserialize(cls, data, offset):
+        source_path, offset = _unpack_string(data, offset)
+        announce_url, offset = _unpack_string(data, offset)
+        (mtime_ns, size, info_hash, piece_length, last_piece_length, piece_count,
+         hashes_offset, file_count) = _ENTRY_FIELDS.unpack_from(data, offset)
+        offset += _ENTRY_FIELDS.size
+
+        files = []
+        for _ in range(file_count):
+            path, offset = _unpack_string(data, offset)
+            length, = _FILE_LENGTH.unpack_from(data, offset)
+            offset += _FILE_LENGTH.size
+            files.append((path, length))
+
+        entry = cls(source_path, mtime_ns, size, info_hash, announce_url, piece_length,
+                    last_piece_length, piece_count, hashes_offset, files)
+        return entry, offset
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _pack_string(s):
+    encoded = s.encode('utf-8')
+    return _STRING_LENGTH.pack(len(encoded)) + encoded
+
+
+def _unpack_string(data, offset):
+    length, = _STRING_LENGTH.unpack_from(data, offset)
+    offset += _STRING_LENGTH.size
+    encoded = data[offset:offset + length]
+    if len(encoded) != length:
+        raise ValueError(f'String truncated')
+    return encoded.decode('utf-8'), offset + length
+
+
+# Sequence of Piece objects created on access from the mmapped hashes blob. Valid only while
+# the index it came from is open
+class _LazyPieces(Sequence):
+    def __init__(self, index, entry):
+        self._index = index
+        # Offset is read from the entry on access, compaction moves hashes around
+        self._entry = entry
+        self._count = entry.piece_count
+        self._piece_length = entry.piece_length
+        self._last_piece_length = entry.last_piece_length
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._count))]
+
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(f'Piece index out of range: {i}')
+
+        if self._entry.hashes_offset < 0:
+            raise MetafileIndexError(f'Metafile index entry for {self._entry.source_path} no longer valid')
+
+        piece_hash = self._index._read_hashes(self._entry.hashes_offset + i * _HASH_LENGTH, _HASH_LENGTH)
+        length = self._last_piece_length if i == self._count - 1 else self._piece_length
+        return Piece(i, piece_hash, length)
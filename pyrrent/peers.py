@@ -0,0 +1,145 @@
+import socket
+import struct
+import time
+
+
+class PeerError(Exception):
+    pass
+
+
+_COMPACT_IPV4 = struct.Struct('!4sH')
+_COMPACT_IPV6 = struct.Struct('!16sH')
+
+
+def decode_compact_peers(data):
+    if len(data) % _COMPACT_IPV4.size:
+        raise PeerError(f'Compact peers not multiple of {_COMPACT_IPV4.size} bytes: {len(data)}')
+
+    inet_ntoa = socket.inet_ntoa
+    return [(inet_ntoa(ip), port) for ip, port in _COMPACT_IPV4.iter_unpack(data)]
+
+
+# IPv4 peers only, others have no place in the 6 byte format and are skipped
+def encode_compact_peers(peers):
+    encoded = []
+
+    for ip, port in peers:
+        try:
+            encoded.append(_COMPACT_IPV4.pack(socket.inet_aton(ip), port))
+        except (OSError, struct.error):
+            continue
+
+    return b''.join(encoded)
+
+
+def decode_compact_peers6(data):
+    if len(data) % _COMPACT_IPV6.size:
+        raise PeerError(f'Compact IPv6 peers not multiple of {_COMPACT_IPV6.size} bytes: {len(data)}')
+
+    inet_ntop = socket.inet_ntop
+    return [(inet_ntop(socket.AF_INET6, ip), port) for ip, port in _COMPACT_IPV6.iter_unpack(data)]
+
+
+def decode_dict_peers(peer_dicts):
+    peers = []
+
+    for peer_dict in peer_dicts:
+        if not isinstance(peer_dict, dict):
+            raise PeerError(f'Invalid peer type: {type(peer_dict)}')
+
+        try:
+            ip = peer_dict['ip']
+            port = peer_dict['port']
+        except KeyError as e:
+            raise PeerError(f'Peer missing field {e}') from e
+
+        if not isinstance(ip, bytes):
+            raise PeerError(f'Invalid peer ip type: {type(ip)}')
+        if not isinstance(port, int) or not 0 < port < 65536:
+            raise PeerError(f'Invalid peer port: {port}')
+
+        try:
+            ip = ip.decode('ascii')
+        except UnicodeDecodeError as e:
+            raise PeerError(f'Invalid peer ip: {ip}') from e
+
+        peers.append((ip, port))
+
+    return peers
+
+
+class PeerStore:
+    def __init__(self, base_backoff=30, max_backoff=3600, max_failures=8):
+        self._base_backoff = base_backoff
+        self._max_backoff = max_backoff
+        self._max_failures = max_failures
+        self._records = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, peer):
+        return peer in self._records
+
+    def add(self, peers, source=None):
+        new_count = 0
+
+        for peer in peers:
+            record = self._records.get(peer)
+            if record is None:
+                record = _PeerRecord()
+                self._records[peer] = record
+                new_count += 1
+
+            if source is not None:
+                record.sources.add(source)
+
+        return new_count
+
+    def remove(self, peer):
+        self._records.pop(peer, None)
+
+    def connect_failed(self, peer):
+        record = self._records.get(peer)
+        if not record:
+            return
+
+        record.failures += 1
+        if record.failures >= self._max_failures:
+            del self._records[peer]
+            return
+
+        backoff = min(self._base_backoff * 2 ** (record.failures - 1), self._max_backoff)
+        record.retry_at = time.monotonic() + backoff
+
+    def connect_succeeded(self, peer):
+        record = self._records.get(peer)
+        if record:
+            record.failures = 0
+            record.retry_at = 0
+
+    def get_connectable(self, count, exclude=()):
+        now = time.monotonic()
+        connectable = []
+
+        for peer, record in self._records.items():
+            if record.retry_at <= now and peer not in exclude:
+                connectable.append(peer)
+                if len(connectable) == count:
+                    break
+
+        return connectable
+
+    def get_sources(self, peer):
+        record = self._records.get(peer)
+        return frozenset(record.sources) if record else frozenset()
+
+
+class _PeerRecord:
+    __slots__ = 'sources', 'failures', 'retry_at'
+
+
+    def __init__(self):
+        self.sources = set()
+        self.failures = 0
+        self.retry_at = 0
@@ -0,0 +1,160 @@
+import asyncio
+from collections import deque
+
+
+class RateLimitError(Exception):
+    pass
+
+
+class BandwidthLimiter:
+    # Tokens are added on a fixed tick instead of on every call. Buckets refill lazily from the
+    # tick counter when touched, so a tick costs nothing for buckets nobody is waiting on
+    def __init__(self, rate=None, burst=1.0, tick=0.1, loop=None):
+        self._tick_duration = tick
+        self._tick = 0
+        self._loop = loop if loop else asyncio.get_event_loop()
+        # Buckets with waiters, in round robin order
+        self._waiting = {}
+        self._wake_up_task = None
+        self.root = TokenBucket(self, None, rate, burst)
+
+    def create_bucket(self, rate=None, burst=1.0, parent=None):
+        return TokenBucket(self, parent if parent else self.root, rate, burst)
+
+    # Ticking also starts with the first request that has to wait, so a limiter that was never
+    # started still lets waiters through
+    def start(self):
+        if not self._wake_up_task:
+            self._wake_up_task = self._loop.call_later(self._tick_duration, self._on_tick)
+
+    # Waiting requests are let through, nothing would serve them otherwise
+    def stop(self):
+        if self._wake_up_task:
+            self._wake_up_task.cancel()
+            self._wake_up_task = None
+
+        waiting, self._waiting = self._waiting, {}
+        for bucket in waiting:
+            while bucket._waiters:
+                _, future = bucket._waiters.popleft()
+                if not future.done():
+                    future.set_result(None)
+
+    def _on_tick(self):
+        self._tick += 1
+        self._serve_waiters()
+        self._wake_up_task = self._loop.call_later(self._tick_duration, self._on_tick)
+
+    # Every pass grants at most one request per bucket, so torrents (and peers) waiting on
+    # a shared parent get its bandwidth in turns instead of first come first served
+    def _serve_waiters(self):
+        progress = True
+
+        while self._waiting and progress:
+            progress = False
+
+            for bucket in list(self._waiting):
+                waiters = bucket._waiters
+                amount, future = waiters[0]
+
+                if future.cancelled():
+                    waiters.popleft()
+                    progress = True
+                elif bucket._has_tokens():
+                    bucket._take(amount)
+                    waiters.popleft()
+                    future.set_result(None)
+                    progress = True
+                else:
+                    continue
+
+                # Served bucket goes to the back of the queue, also across ticks
+                del self._waiting[bucket]
+                if waiters:
+                    self._waiting[bucket] = None
+
+    def _add_waiter(self, bucket, amount):
+        future = self._loop.create_future()
+        bucket._waiters.append((amount, future))
+        self._waiting[bucket] = None
+        self.start()
+        return future
+
+
+class TokenBucket:
+    def __init__(self, limiter, parent, rate, burst):
+        self._limiter = limiter
+        self._parent = parent
+        self._burst = burst
+        self._rate = None
+        self._capacity = None
+        self._tokens = 0
+        self._tick = limiter._tick
+        self._waiters = deque()
+        self.rate = rate
+
+    @property
+    def rate(self):
+        return self._rate
+
+    # Can be changed at any time, waiters are served with the new rate from the next tick
+    @rate.setter
+    def rate(self, rate):
+        if rate is not None and rate <= 0:
+            raise RateLimitError(f'Rate must be positive or None for unlimited: {rate}')
+
+        self._refill()
+        if rate is None:
+            self._capacity = None
+            self._tokens = 0
+        else:
+            capacity = max(rate * self._burst, rate * self._limiter._tick_duration)
+            # Bucket that becomes limited starts full, otherwise keep what was accumulated
+            self._tokens = capacity if self._rate is None else min(self._tokens, capacity)
+            self._capacity = capacity
+        self._rate = rate
+
+    def create_child(self, rate=None, burst=1.0):
+        return TokenBucket(self._limiter, self, rate, burst)
+
+    def try_consume(self, amount):
+        if self._waiters or not self._has_tokens():
+            return False
+
+        self._take(amount)
+        return True
+
+    async def consume(self, amount):
+        if self.try_consume(amount):
+            return
+
+        await self._limiter._add_waiter(self, amount)
+
+    # Request is allowed as soon as every bucket up the tree has any tokens. Buckets may go into
+    # debt, which lets requests larger than the burst through and is paid back by later refills
+    def _has_tokens(self):
+        bucket = self
+        while bucket is not None:
+            if bucket._rate is not None:
+                bucket._refill()
+                if bucket._tokens <= 0:
+                    return False
+            bucket = bucket._parent
+        return True
+
+    def _take(self, amount):
+        bucket = self
+        while bucket is not None:
+            if bucket._rate is not None:
+                bucket._tokens -= amount
+            bucket = bucket._parent
+
+    def _refill(self):
+        tick = self._limiter._tick
+        if tick == self._tick:
+            return
+
+        if self._rate is not None:
+            elapsed = (tick - self._tick) * self._limiter._tick_duration
+            self._tokens = min(self._capacity, self._tokens + self._rate * elapsed)
+        self._tick = tick
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import time
+from urllib.parse import urlencode, urlsplit, urlunsplit
+
+import aiohttp
+
+from pyrrent import bencoding
+
+
+class ScraperError(Exception):
+    pass
+
+
+class ScrapeResult:
+    __slots__ = 'complete', 'downloaded', 'incomplete'
+
+    def __init__(self, complete, downloaded, incomplete):
+        self.complete = complete
+        self.downloaded = downloaded
+        self.incomplete = incomplete
+
+
+def get_scrape_url(announce_url):
+    # By convention scrape URL is derived by replacing 'announce' in the last path component
+    # with 'scrape'. If the last component does not start with 'announce', scrape is not supported
+    scheme, netloc, path, query, fragment = urlsplit(announce_url)
+    head, separator, last_component = path.rpartition('/')
+    if not last_component.startswith('announce'):
+        raise ScraperError(f'Tracker does not support scrape: {announce_url}')
+
+    path = head + separator + 'scrape' + last_component[len('announce'):]
+    return urlunsplit((scheme, netloc, path, query, fragment))
+
+
+class HTTPScraper:
+    def __init__(self, announce_url, cache_ttl=1800, batch_size=50, timeout=5, loop=None):
+        self._url = get_scrape_url(announce_url)
+        self._cache_ttl = cache_ttl
+        self._batch_size = batch_size
+        self._loop = loop if loop else asyncio.get_event_loop()
+        self._session = aiohttp.ClientSession(loop=self._loop,
+                                              read_timeout=timeout,
+                                              conn_timeout=timeout)
+        # info_hash -> (expiration time, ScrapeResult or None if tracker does not know the torrent)
+        self._cache = {}
+
+    # Result has only info hashes the tracker reported. Failed batches are left out too, the call
+    # raises only when every batch failed
+    async def scrape(self, info_hashes):
+        self.purge_expired()
+        now = time.monotonic()
+        results = {}
+        to_scrape = []
+
+        for info_hash in info_hashes:
+            cached = self._cache.get(info_hash)
+            if cached and cached[0] > now:
+                if cached[1] is not None:
+                    results[info_hash] = cached[1]
+            else:
+                to_scrape.append(info_hash)
+
+        if not to_scrape:
+            return results
+
+        batches = [to_scrape[i:i + self._batch_size] for i in range(0, len(to_scrape), self._batch_size)]
+        logging.debug(f'Scraping {len(to_scrape)} info hashes from {self._url} in {len(batches)} requests')
+        batch_results = await asyncio.gather(*(self._scrape(batch) for batch in batches), return_exceptions=True)
+
+        errors = []
+        for batch, batch_result in zip(batches, batch_results):
+            if isinstance(batch_result, Exception):
+                logging.warning(f'Failed to scrape {len(batch)} info hashes from {self._url}. '
+                                f'Exception: {batch_result}')
+                errors.append(batch_result)
+                continue
+
+            scraped, ttl = batch_result
+            expiration = time.monotonic() + ttl
+            # Hashes missing from the response are cached too, so they are not asked for again until expiration
+            for info_hash in batch:
+                self._cache[info_hash] = (expiration, None)
+            for info_hash, result in scraped.items():
+                self._cache[info_hash] = (expiration, result)
+            results.update(scraped)
+
+        if len(errors) == len(batches):
+            raise errors[0]
+
+        return results
+
+    def invalidate(self, info_hash):
+        self._cache.pop(info_hash, None)
+
+    def purge_expired(self):
+        now = time.monotonic()
+        expired = [info_hash for info_hash, (expiration, _) in self._cache.items() if expiration <= now]
+        for info_hash in expired:
+            del self._cache[info_hash]
+
+    async def _scrape(self, info_hashes):
+        params = [('info_hash', info_hash) for info_hash in info_hashes]
+        separator = '&' if '?' in self._url else '?'
+        full_url = self._url + separator + urlencode(params)
+
+        try:
+            async with self._session.get(full_url) as resp:
+                resp.raise_for_status()
+                response_content = await resp.read()
+        except asyncio.TimeoutError as e:
+            raise ScraperError(f'Timeouted while scraping {self._url}') from e
+        except aiohttp.ClientError as e:
+            raise ScraperError(f'Connection error while scraping {self._url}') from e
+
+        return self._parse_scrape_response(response_content)
+
+    def _parse_scrape_response(self, encoded_response):
+        try:
+            response = bencoding.decode(encoded_response, binary_keys=True)
+        except bencoding.BencodingError as e:
+            raise ScraperError(f'Invalid response from tracker {self._url}') from e
+
+        if not isinstance(response, dict):
+            raise ScraperError(f'Invalid response from tracker {self._url}. Bad item type')
+
+        failure_reason = response.get('failure reason')
+        if failure_reason:
+            raise ScraperError(f'Scrape failed on tracker {self._url}. Reason: {failure_reason}')
+
+        files = response.get('files')
+        if not isinstance(files, dict):
+            raise ScraperError(f'Invalid response from tracker {self._url}. Field files not dictionary')
+
+        results = {}
+        for info_hash, stats in files.items():
+            # Keys which happen to be valid ascii are decoded to str by bencoding
+            if isinstance(info_hash, str):
+                info_hash = info_hash.encode('ascii')
+            if not isinstance(stats, dict):
+                raise ScraperError(f'Invalid response from tracker {self._url}. Bad file stats type')
+
+            try:
+                complete = stats['complete']
+                downloaded = stats['downloaded']
+                incomplete = stats['incomplete']
+            except KeyError as e:
+                raise ScraperError(f'Invalid response from tracker {self._url}. Missing field {e}')
+
+            if not all(isinstance(field, int) for field in (complete, downloaded, incomplete)):
+                raise ScraperError(f'Invalid response from tracker {self._url}. File stats not integers')
+
+            results[info_hash] = ScrapeResult(complete, downloaded, incomplete)
+
+        ttl = self._cache_ttl
+        flags = response.get('flags')
+        if isinstance(flags, dict):
+            min_request_interval = flags.get('min_request_interval')
+            if isinstance(min_request_interval, int):
+                ttl = max(ttl, min_request_interval)
+
+        return results, ttl
@@ -0,0 +1,119 @@
+import bisect
+
+
+class SelectionError(Exception):
+    pass
+
+
+class FilePriority:
+    SKIP = 0
+    LOW = 1
+    NORMAL = 2
+    HIGH = 3
+
+    ALL = (SKIP, LOW, NORMAL, HIGH)
+
+
+class FileSelection:
+    # Maps per-file priorities to per-piece priorities. Piece gets the highest priority of
+    # the files it overlaps, so a boundary piece shared with a wanted file is always downloaded
+    @classmethod
+    def from_metafile(cls, metafile):
+        return cls(metafile.files, metafile.pieces[0].length, len(metafile.pieces))
+
+    def __init__(self, files, piece_length, piece_count):
+        self._piece_length = piece_length
+        self._piece_count = piece_count
+        self._file_starts = []
+        self._file_ends = []
+
+        offset = 0
+        for file in files:
+            self._file_starts.append(offset)
+            offset += file.length
+            self._file_ends.append(offset)
+
+        self._total_length = offset
+        self._file_priorities = [FilePriority.NORMAL] * len(files)
+        self._piece_priorities = [FilePriority.NORMAL] * piece_count
+        self._urgent_pieces = []
+
+    @property
+    def piece_length(self):
+        return self._piece_length
+
+    def get_file_priority(self, file_index):
+        return self._file_priorities[file_index]
+
+    def set_file_priority(self, file_index, priority):
+        if priority not in FilePriority.ALL:
+            raise SelectionError(f'Invalid file priority: {priority}')
+        if not 0 <= file_index < len(self._file_priorities):
+            raise SelectionError(f'Invalid file index: {file_index}')
+
+        self._file_priorities[file_index] = priority
+
+        first, end = self.get_file_piece_range(file_index)
+        if first == end:
+            return
+
+        # Interior pieces belong to this file only, just the boundary ones need a full check
+        self._piece_priorities[first:end] = [priority] * (end - first)
+        self._piece_priorities[first] = self._compute_piece_priority(first)
+        self._piece_priorities[end - 1] = self._compute_piece_priority(end - 1)
+
+    def is_file_wanted(self, file_index):
+        return self._file_priorities[file_index] != FilePriority.SKIP
+
+    def get_piece_priority(self, piece_index):
+        return self._piece_priorities[piece_index]
+
+    def is_piece_wanted(self, piece_index):
+        return self._piece_priorities[piece_index] != FilePriority.SKIP
+
+    # Urgent pieces (such as the read-ahead window of a stream) go before any priority,
+    # in the given order. Replaces previously set urgent pieces
+    def set_urgent_pieces(self, piece_indexes):
+        self._urgent_pieces = [i for i in piece_indexes if 0 <= i < self._piece_count]
+
+    # Wanted piece indexes - urgent first, then highest priority first, in index order
+    # within same priority
+    def get_wanted_pieces(self):
+        urgent = set(self._urgent_pieces)
+        wanted = [i for i, priority in enumerate(self._piece_priorities)
+                  if priority != FilePriority.SKIP and i not in urgent]
+        wanted.sort(key=lambda i: -self._piece_priorities[i])
+        return self._urgent_pieces + wanted
+
+    def get_wanted_length(self):
+        return sum(self._get_piece_length(i) for i in range(self._piece_count) if self.is_piece_wanted(i))
+
+    # Returns half-open range of pieces holding any of the file's data. Empty for empty files
+    def get_file_piece_range(self, file_index):
+        start = self._file_starts[file_index]
+        end = self._file_ends[file_index]
+        if start == end:
+            return start // self._piece_length, start // self._piece_length
+
+        return start // self._piece_length, (end - 1) // self._piece_length + 1
+
+    def get_file_offset(self, file_index):
+        return self._file_starts[file_index]
+
+    def _compute_piece_priority(self, piece_index):
+        start = piece_index * self._piece_length
+        end = start + self._get_piece_length(piece_index)
+        priority = FilePriority.SKIP
+
+        file_index = bisect.bisect_right(self._file_starts, start) - 1
+        while file_index < len(self._file_starts) and self._file_starts[file_index] < end:
+            file_end = self._file_ends[file_index]
+            if file_end > start and file_end > self._file_starts[file_index]:
+                priority = max(priority, self._file_priorities[file_index])
+            file_index += 1
+
+        return priority
+
+    def _get_piece_length(self, piece_index):
+        start = piece_index * self._piece_length
+        return min(self._piece_length, self._total_length - start)
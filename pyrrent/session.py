@@ -0,0 +1,461 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+
+from pyrrent.announcing import HTTPAnnouncer
+from pyrrent.dht import DHTNode, DHTAnnouncer, DHTError
+from pyrrent.magnet import MagnetLink, MetadataCache, MagnetError, MAX_METADATA_SIZE, fetch_metadata
+from pyrrent.metafile import Metafile, MetafileError
+from pyrrent.peers import PeerStore
+from pyrrent.storage import Storage, StorageError
+from pyrrent.utils import MemoryBudget
+
+
+class SessionError(Exception):
+    pass
+
+
+_PEER_ID_PREFIX = b'-PY0001-'
+
+
+def generate_peer_id():
+    return _PEER_ID_PREFIX + os.urandom(20 - len(_PEER_ID_PREFIX))
+
+
+class Session:
+    # Torrents are sharded across worker processes, each running its own event loop, so peer I/O
+    # scales with cores. Main process only keeps the torrent -> worker mapping and relays commands.
+    # With dht_port set, every worker runs its own DHT node on dht_port + worker index.
+    # memory_limit caps bytes held in piece caches, write queues and metadata assembly. Main
+    # process keeps enough for fetching one dictionary, workers split the rest evenly
+    def __init__(self, storage_path, worker_count=None, port=6881, dht_port=None, dht_bootstrap=(), memory_limit=None,
+                 loop=None):
+        self._storage_path = storage_path
+        self._worker_count = worker_count or os.cpu_count() or 1
+        self._port = port
+        self._dht_port = dht_port
+        self._dht_bootstrap = tuple(dht_bootstrap)
+        self._loop = loop if loop else asyncio.get_event_loop()
+        self._workers = []
+        self._torrent_workers = {}
+        self._peer_id = generate_peer_id()
+        self._metadata_cache = MetadataCache(os.path.join(storage_path, '.metadata'))
+
+        self._memory_budget = None
+        self._worker_memory_limit = None
+        if memory_limit is not None:
+            self._worker_memory_limit = (memory_limit - MAX_METADATA_SIZE) // self._worker_count
+            if self._worker_memory_limit <= 0:
+                raise SessionError(f'Memory limit {memory_limit} too low for {self._worker_count} workers')
+            self._memory_budget = MemoryBudget(MAX_METADATA_SIZE, loop=self._loop)
+
+    async def start(self):
+        if self._workers:
+            raise SessionError(f'Session already started')
+
+        logging.info(f'Starting session with {self._worker_count} workers at {self._storage_path}')
+        # Prepared once here, so workers do not race on creating it
+        Storage.prepare(self._storage_path)
+
+        # Spawn instead of fork - forking a process with a running event loop is not safe
+        context = multiprocessing.get_context('spawn')
+        for i in range(self._worker_count):
+            dht_port = self._dht_port + i if self._dht_port is not None else None
+            worker = _WorkerHandle(i, context, self._storage_path, self._port, dht_port, self._dht_bootstrap,
+                                   self._worker_memory_limit, self._loop)
+            self._workers.append(worker)
+
+    async def close(self):
+        logging.info(f'Closing session at {self._storage_path}')
+        await asyncio.gather(*(worker.close() for worker in self._workers))
+        self._workers = []
+        self._torrent_workers = {}
+
+    async def add(self, metafile_content):
+        if not self._workers:
+            raise SessionError(f'Session not started')
+
+        return await self._add_to_worker('add', metafile_content)
+
+    # Metadata is fetched from peers given here and in the link. Fetched metadata is cached under
+    # storage path, so adding the same magnet again is instant
+    async def add_magnet(self, uri, peers=()):
+        if not self._workers:
+            raise SessionError(f'Session not started')
+
+        try:
+            magnet = MagnetLink.parse(uri)
+            encoded_info = await fetch_metadata(magnet, self._peer_id, self._metadata_cache, extra_peers=peers,
+                                                loop=self._loop, memory_budget=self._memory_budget)
+        except MagnetError as e:
+            raise SessionError(f'Failed to add magnet link. Exception: {e}') from e
+
+        announce_url = magnet.trackers[0] if magnet.trackers else None
+        return await self._add_to_worker('add_info', encoded_info, announce_url)
+
+    async def start_torrent(self, info_hash):
+        await self._get_worker(info_hash).request('start', info_hash)
+
+    async def pause_torrent(self, info_hash):
+        await self._get_worker(info_hash).request('pause', info_hash)
+
+    async def stop_torrent(self, info_hash):
+        await self._get_worker(info_hash).request('stop', info_hash)
+
+    async def remove_torrent(self, info_hash):
+        worker = self._get_worker(info_hash)
+        await worker.request('remove', info_hash)
+        worker.torrent_count -= 1
+        del self._torrent_workers[info_hash]
+
+    async def stats(self):
+        worker_stats = await asyncio.gather(*(worker.request('stats') for worker in self._workers))
+        worker_memory = await asyncio.gather(*(worker.request('memory') for worker in self._workers))
+
+        torrents = {}
+        for stats in worker_stats:
+            torrents.update(stats)
+
+        return {
+            'torrents': torrents,
+            'downloaded': sum(stats['downloaded'] for stats in torrents.values()),
+            'uploaded': sum(stats['uploaded'] for stats in torrents.values()),
+            'peers': sum(stats['peers'] for stats in torrents.values()),
+            'memory': _merge_memory_stats([_get_memory_stats(self._memory_budget)] + worker_memory),
+        }
+
+    async def _add_to_worker(self, command, *args):
+        # Least loaded worker, ties broken by order
+        worker = min(self._workers, key=lambda w: w.torrent_count)
+        info_hash = await worker.request(command, *args)
+        if info_hash in self._torrent_workers:
+            await worker.request('remove', info_hash)
+            raise SessionError(f'Torrent {info_hash.hex()} already added')
+
+        worker.torrent_count += 1
+        self._torrent_workers[info_hash] = worker
+        return info_hash
+
+    def _get_worker(self, info_hash):
+        try:
+            return self._torrent_workers[info_hash]
+        except KeyError:
+            raise SessionError(f'Unknown torrent {info_hash.hex()}') from None
+
+
+# Control channel is a pipe carrying (request id, command, args) tuples one way and
+# (request id, success, result) the other. Replies are read from the event loop via add_reader
+class _WorkerHandle:
+    def __init__(self, index, context, storage_path, port, dht_port, dht_bootstrap, memory_limit, loop):
+        self._index = index
+        self._loop = loop
+        self._connection, child_connection = context.Pipe()
+        self._process = context.Process(target=_run_worker,
+                                        args=(child_connection, index, storage_path, port, dht_port,
+                                              dht_bootstrap, memory_limit),
+                                        name=f'pyrrent-worker-{index}',
+                                        daemon=True)
+        self._process.start()
+        child_connection.close()
+        self._request_ids = itertools.count()
+        self._pending = {}
+        self.torrent_count = 0
+        self._loop.add_reader(self._connection.fileno(), self._on_reply)
+
+    async def request(self, command, *args):
+        request_id = next(self._request_ids)
+        future = self._loop.create_future()
+        self._pending[request_id] = future
+
+        try:
+            self._connection.send((request_id, command, args))
+        except OSError as e:
+            del self._pending[request_id]
+            raise SessionError(f'Worker {self._index} not reachable') from e
+
+        return await future
+
+    async def close(self):
+        try:
+            await self.request('close')
+        except SessionError as e:
+            logging.warning(f'Failed to close worker {self._index} gracefully. Exception: {e}')
+
+        self._loop.remove_reader(self._connection.fileno())
+        await self._loop.run_in_executor(None, self._process.join, 5)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._connection.close()
+
+    def _on_reply(self):
+        try:
+            request_id, success, result = self._connection.recv()
+        except (EOFError, OSError):
+            logging.error(f'Worker {self._index} exited unexpectedly')
+            self._loop.remove_reader(self._connection.fileno())
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(SessionError(f'Worker {self._index} exited'))
+            self._pending.clear()
+            return
+
+        future = self._pending.pop(request_id, None)
+        if not future or future.done():
+            return
+
+        if success:
+            future.set_result(result)
+        else:
+            future.set_exception(SessionError(result))
+
+
+def _run_worker(connection, index, storage_path, port, dht_port, dht_bootstrap, memory_limit):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    worker = _SessionWorker(connection, storage_path, port, loop, memory_limit)
+    if dht_port is not None:
+        state_path = os.path.join(storage_path, f'.dht-{index}')
+        loop.run_until_complete(worker.start_dht(dht_port, dht_bootstrap, state_path))
+
+    loop.add_reader(connection.fileno(), worker.handle_request)
+    try:
+        loop.run_until_complete(worker.closed)
+    finally:
+        loop.remove_reader(connection.fileno())
+        connection.close()
+        loop.close()
+
+
+class _SessionWorker:
+    def __init__(self, connection, storage_path, port, loop, memory_limit=None):
+        self._connection = connection
+        self._storage = Storage.prepare(storage_path)
+        self._port = port
+        self._loop = loop
+        self._memory_budget = MemoryBudget(memory_limit, loop=loop) if memory_limit is not None else None
+        self._peer_id = generate_peer_id()
+        self._torrents = {}
+        self._dht = None
+        self.closed = loop.create_future()
+
+    # DHT is optional - a worker that cannot start it keeps serving torrents from trackers only
+    async def start_dht(self, port, bootstrap, state_path):
+        dht = DHTNode(state_path=state_path, loop=self._loop)
+        try:
+            await dht.start(port=port, bootstrap=bootstrap)
+        except DHTError as e:
+            logging.error(f'Failed to start DHT on port {port}. Exception: {e}')
+            return
+
+        self._dht = dht
+
+    def handle_request(self):
+        try:
+            request_id, command, args = self._connection.recv()
+        except (EOFError, OSError):
+            # Parent is gone, nothing left to serve
+            self._close()
+            return
+
+        handler = getattr(self, f'_handle_{command}', None)
+        if not handler:
+            self._connection.send((request_id, False, f'Unknown command {command}'))
+            return
+
+        try:
+            result = handler(*args)
+        except (SessionError, MetafileError, StorageError) as e:
+            self._connection.send((request_id, False, str(e)))
+        except Exception as e:
+            # Caller waits for a reply no matter what, so unexpected errors (bad arguments or
+            # malformed input tripping a bug) are reported too
+            logging.exception(f'Worker failed to handle {command}')
+            self._connection.send((request_id, False, f'{type(e).__name__}: {e}'))
+        else:
+            self._connection.send((request_id, True, result))
+
+    def _handle_add(self, metafile_content):
+        return self._add_torrent(Metafile.parse(metafile_content))
+
+    def _handle_add_info(self, encoded_info, announce_url):
+        return self._add_torrent(Metafile.from_info(encoded_info, announce_url))
+
+    def _add_torrent(self, metafile):
+        if metafile.info_hash in self._torrents:
+            raise SessionError(f'Torrent {metafile.info_hash.hex()} already added')
+
+        self._torrents[metafile.info_hash] = Torrent(metafile, self._storage, self._peer_id, self._port, self._loop,
+                                                     dht=self._dht, memory_budget=self._memory_budget)
+        return metafile.info_hash
+
+    def _handle_start(self, info_hash):
+        self._get_torrent(info_hash).start()
+
+    def _handle_pause(self, info_hash):
+        self._get_torrent(info_hash).pause()
+
+    def _handle_stop(self, info_hash):
+        self._get_torrent(info_hash).stop()
+
+    def _handle_remove(self, info_hash):
+        torrent = self._get_torrent(info_hash)
+        torrent.stop()
+        del self._torrents[info_hash]
+
+    def _handle_stats(self):
+        return {info_hash: torrent.get_stats() for info_hash, torrent in self._torrents.items()}
+
+    def _handle_memory(self):
+        return _get_memory_stats(self._memory_budget)
+
+    def _handle_close(self):
+        for torrent in self._torrents.values():
+            torrent.stop()
+
+        # Give stopped announces a chance to reach trackers before the loop goes away
+        tasks = [task for torrent in self._torrents.values() for task in torrent.announcing_tasks]
+        self._loop.create_task(self._close_after(tasks))
+
+    async def _close_after(self, tasks, timeout=3):
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            # Cancelled announcers still close their HTTP sessions, which has to happen before the loop goes
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        self._close()
+
+    def _close(self):
+        if self._dht:
+            self._dht.stop()
+            self._dht = None
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def _get_torrent(self, info_hash):
+        try:
+            return self._torrents[info_hash]
+        except KeyError:
+            raise SessionError(f'Unknown torrent {info_hash.hex()}') from None
+
+
+class Torrent:
+    # Acts as download info and peer coordinator for its announcers
+    def __init__(self, metafile, storage, peer_id, port, loop, max_peers=200, dht=None, memory_budget=None):
+        self.metafile = metafile
+        self.info_hash = metafile.info_hash
+        self.peer_id = peer_id
+        self.port = port
+        self.downloaded = 0
+        self.uploaded = 0
+        self.left = sum(file.length for file in metafile.files)
+        self.state = 'stopped'
+        self._storage = storage
+        self._loop = loop
+        self._max_peers = max_peers
+        self._peers = PeerStore()
+        self._storage_handler = None
+        self._dht = dht
+        self._memory_budget = memory_budget
+        self._announcers = []
+        self._announcing_tasks = set()
+
+    @property
+    def name(self):
+        return self.info_hash.hex()
+
+    @property
+    def announcing_tasks(self):
+        return [task for task in self._announcing_tasks if not task.done()]
+
+
+    def start(self):
+        if self.state == 'started':
+            return
+
+        logging.info(f'Starting torrent {self.name}')
+        if not self._storage_handler:
+            self._storage_handler = self._storage.create_handler_for_download(self.name, loop=self._loop,
+                                                                              memory_budget=self._memory_budget)
+
+        # Torrents from magnet links may have no tracker
+        self._announcers = []
+        if self.metafile.announce_url:
+            self._announcers.append(HTTPAnnouncer(self.metafile.announce_url, self, self, loop=self._loop))
+        if self._dht:
+            self._announcers.append(DHTAnnouncer(self._dht, self, self, loop=self._loop))
+
+        for announcer in self._announcers:
+            task = self._loop.create_task(announcer.announcing())
+            self._announcing_tasks.add(task)
+            task.add_done_callback(self._announcing_tasks.discard)
+        self.state = 'started'
+
+    # Leaves tracker, but keeps storage handler and known peers for a quick resume
+    def pause(self):
+        if self.state != 'started':
+            return
+
+        logging.info(f'Pausing torrent {self.name}')
+        self._stop_announcing()
+        self.state = 'paused'
+
+    def stop(self):
+        if self.state == 'stopped':
+            return
+
+        logging.info(f'Stopping torrent {self.name}')
+        self._stop_announcing()
+        self._storage.remove_handler_for_download(self.name)
+        self._storage_handler = None
+        self._peers = PeerStore()
+        self.state = 'stopped'
+
+    def get_stats(self):
+        return {
+            'state': self.state,
+            'downloaded': self.downloaded,
+            'uploaded': self.uploaded,
+            'left': self.left,
+            'peers': len(self._peers),
+        }
+
+    def process_announce_result(self, result, source=None):
+        new_count = self._peers.add(result.peers, source=source or self.metafile.announce_url)
+        logging.debug(f'Torrent {self.name} got {new_count} new peers. Known peers: {len(self._peers)}')
+
+    def process_announcer_error(self, event):
+        logging.debug(f'Torrent {self.name} failed to announce {event}')
+
+    def get_wanted_peer_count(self):
+        return max(self._max_peers - len(self._peers), 0)
+
+    def _stop_announcing(self):
+        for announcer in self._announcers:
+            announcer.stop()
+        self._announcers = []
+
+
+def _get_memory_stats(budget):
+    if not budget:
+        return {'limit': None, 'used': 0, 'subsystems': {}}
+    return {'limit': budget.limit, 'used': budget.used, 'subsystems': budget.usage()}
+
+
+# Limit is left out when any process runs without a budget
+def _merge_memory_stats(all_stats):
+    subsystems = {}
+    for stats in all_stats:
+        for subsystem, size in stats['subsystems'].items():
+            subsystems[subsystem] = subsystems.get(subsystem, 0) + size
+
+    limits = [stats['limit'] for stats in all_stats]
+    return {
+        'limit': None if None in limits else sum(limits),
+        'used': sum(stats['used'] for stats in all_stats),
+        'subsystems': subsystems,
+    }
@@ -1,10 +1,30 @@
 import asyncio
+import itertools
 import logging
 import os
 import stat
 from concurrent.futures import ThreadPoolExecutor
 
 from pyrrent.utils import Cache
+from pyrrent.utils.metrics import REGISTRY
+
+
+_STORE_DURATION = REGISTRY.histogram('pyrrent_storage_store_duration_seconds',
+                                     'Duration of piece stores, including executor queueing')
+_RETRIEVE_DURATION = REGISTRY.histogram('pyrrent_storage_retrieve_duration_seconds',
+                                        'Duration of piece retrievals from disk, including executor queueing')
+_EXECUTOR_IN_FLIGHT = REGISTRY.gauge('pyrrent_storage_executor_in_flight',
+                                     'Storage operations queued or running in executors')
+_EXECUTOR_WORKERS = REGISTRY.gauge('pyrrent_storage_executor_workers', 'Storage executor threads')
+_CACHE_HITS = REGISTRY.counter('pyrrent_storage_cache_hits_total', 'Piece retrievals served from cache')
+_CACHE_MISSES = REGISTRY.counter('pyrrent_storage_cache_misses_total', 'Piece retrievals read from disk')
+_COMMIT_DURATION = REGISTRY.histogram('pyrrent_storage_commit_duration_seconds',
+                                      'Duration of group commits syncing stored pieces to disk')
+_COMMITTED_PIECES = REGISTRY.counter('pyrrent_storage_committed_pieces_total', 'Pieces synced by group commits')
+
+_TEMP_SUFFIX = '.tmp'
+# fdatasync skips metadata flushes that are not needed to read data back, not available everywhere
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
 
 
 class StorageError(Exception):
@@ -31,25 +51,31 @@ class Storage:
         self._base_path = base_path
         self._handlers = {}
 
-    def create_handler_for_download(self, download_name, workers=3, cache_size=100, loop=None):
+    def create_handler_for_download(self, download_name, workers=3, cache_size=100, loop=None,
+                                    read_bucket=None, write_bucket=None, sync_interval=None, cache_bytes=None,
+                                    memory_budget=None):
         logging.info(f'Creating handler for download {download_name}')
         if download_name in self._handlers:
             raise StorageError(f'Download {download_name} already active')
 
         download_path = os.path.join(self._base_path, download_name)
-        handler = StorageHandler.create(download_path, workers, cache_size, loop)
+        handler = StorageHandler.create(download_path, workers, cache_size, loop, read_bucket, write_bucket,
+                                        sync_interval, cache_bytes, memory_budget)
         self._handlers[download_name] = handler
 
         return handler
 
     def remove_handler_for_download(self, download_name):
         logging.info(f'Removing handler for download {download_name}')
-        self._handlers.pop(download_name, None)
+        handler = self._handlers.pop(download_name, None)
+        if handler:
+            handler.close()
 
 
 class StorageHandler:
     @classmethod
-    def create(cls, path, workers, cache_size, loop):
+    def create(cls, path, workers, cache_size, loop, read_bucket=None, write_bucket=None, sync_interval=None,
+               cache_bytes=None, memory_budget=None):
         pieces_path = os.path.join(path, '.pieces')
         if not os.path.exists(pieces_path):
             try:
@@ -59,45 +85,212 @@ class StorageHandler:
 
         else:
             _check_ownership_and_permissions(pieces_path)
-
-        return cls(path, pieces_path, workers, cache_size, loop)
-
-
-    def __init__(self, path, pieces_path, workers, cache_size, loop):
+            _remove_temp_files(pieces_path)
+
+        return cls(path, pieces_path, workers, cache_size, loop, read_bucket, write_bucket, sync_interval,
+                   cache_bytes, memory_budget)
+
+
+    # Read and write buckets are optional pyrrent.ratelimiting.TokenBucket instances, typically
+    # per-torrent children of a global limiter.
+    # Pieces are written to temp files and renamed into place, so a killed process never leaves a
+    # truncated piece behind. With sync_interval set, stored pieces are also made durable - renames
+    # are held back and done in group commits every sync_interval seconds, and store returns only
+    # once its piece is committed.
+    # cache_size caps cached pieces by count and cache_bytes by size. With an optional
+    # pyrrent.utils.MemoryBudget, the cache is accounted and shrunk under pressure, and store
+    # reserves its piece data until stored, so stores wait while the budget is exhausted
+    def __init__(self, path, pieces_path, workers, cache_size, loop, read_bucket=None, write_bucket=None,
+                 sync_interval=None, cache_bytes=None, memory_budget=None):
         self._path = path
         self._pieces_path = pieces_path
         self._loop = loop or asyncio.get_event_loop()
         self._pool = ThreadPoolExecutor(max_workers=workers)
-        self._cache = Cache(cache_size)
+        self._workers = workers
+        self._batcher = _BatchingExecutor(self._pool, workers, self._loop)
+        _EXECUTOR_WORKERS.inc(workers)
+        self._cache = Cache(cache_size, cache_bytes, memory_budget, subsystem='piece_cache')
+        self._memory_budget = memory_budget
+        self._read_bucket = read_bucket
+        self._write_bucket = write_bucket
+        self._piece_waiters = {}
+        self._sync_interval = sync_interval
+        self._uncommitted = []
+        self._temp_ids = itertools.count()
+        self._commit_task = None
+        self._in_flight = 0
+        self._closed = False
 
     async def store(self, piece_index, piece_data):
-        await self._loop.run_in_executor(self._pool, self._store, piece_index, piece_data)
+        if self._memory_budget:
+            await self._memory_budget.reserve('write_queue', len(piece_data))
 
-    async def retrieve(self, piece_index):
+        try:
+            if self._write_bucket:
+                await self._write_bucket.consume(len(piece_data))
+
+            with _STORE_DURATION.time():
+                temp_path = await self._run_in_pool(self._store, piece_index, piece_data)
+                if self._sync_interval is not None:
+                    await self._wait_for_commit(temp_path, self._get_piece_path(piece_index))
+        finally:
+            if self._memory_budget:
+                self._memory_budget.release('write_queue', len(piece_data))
+
+        waiter = self._piece_waiters.pop(piece_index, None)
+        if waiter and not waiter.done():
+            waiter.set_result(None)
+
+    # Local consumers (such as streams) pass throttle=False, read bucket limits what goes to peers
+    async def retrieve(self, piece_index, throttle=True):
         data = self._cache.get(piece_index)
         if data:
-            return data
+            _CACHE_HITS.inc()
+        else:
+            _CACHE_MISSES.inc()
+            with _RETRIEVE_DURATION.time():
+                data = await self._run_in_pool(self._retrieve, piece_index)
+            if not self._closed:
+                self._cache.put(piece_index, data)
 
-        data = await self._loop.run_in_executor(self._pool, self._retrieve, piece_index)
-        self._cache.put(piece_index, data)
+        if throttle and self._read_bucket:
+            await self._read_bucket.consume(len(data))
 
         return data
 
-    # NOTE - assumes all the pieces are download, does not perform checks. For example it could
-    # list all pieces, multiply by full piece length and check if enough to fill all files
-    async def compose_files(self, file_infos):
-        await self._loop.run_in_executor(self._pool, self._compose_files, file_infos)
-
+    async def wait_for_piece(self, piece_index):
+        if self._cache.get(piece_index):
+            return
+
+        waiter = self._piece_waiters.get(piece_index)
+        if not waiter:
+            # Registered before checking the disk, so a store finishing in between is not missed
+            waiter = self._loop.create_future()
+            self._piece_waiters[piece_index] = waiter
+
+            piece_path = self._get_piece_path(piece_index)
+            if await self._run_in_pool(os.path.exists, piece_path):
+                self._piece_waiters.pop(piece_index, None)
+                if not waiter.done():
+                    waiter.set_result(None)
+
+        # Shielded, so one cancelled waiter does not cancel the others
+        await asyncio.shield(waiter)
+
+    # NOTE - assumes all pieces of wanted files are stored. With selection, skipped files are not
+    # composed and their pieces may be missing
+    async def compose_files(self, file_infos, piece_length, selection=None):
+        await self._run_in_pool(self._compose_files, file_infos, piece_length, selection, batched=False)
+
+    # Drops cached pieces, returning their memory to the budget. Pieces waiting for a group commit
+    # are committed right away, and the pool is shut down once operations in flight are done
+    def close(self):
+        if self._closed:
+            return
+
+        self._closed = True
+        self._cache.close()
+        if self._commit_task:
+            self._commit_task.cancel()
+            self._start_commit()
+        self._shutdown_if_idle()
+
+    # Short per-piece operations are batched. Long ones (compose, group commit) go to the pool on
+    # their own, as every operation in a batch completes only when the whole batch is done
+    async def _run_in_pool(self, func, *args, batched=True):
+        if self._pool is None:
+            raise StorageError(f'Storage handler for {self._path} is closed')
+
+        _EXECUTOR_IN_FLIGHT.inc()
+        self._in_flight += 1
+        try:
+            if batched:
+                return await self._batcher.submit(func, *args)
+            return await self._loop.run_in_executor(self._pool, func, *args)
+        finally:
+            _EXECUTOR_IN_FLIGHT.dec()
+            self._in_flight -= 1
+            self._shutdown_if_idle()
+
+    def _shutdown_if_idle(self):
+        if not self._closed or self._in_flight or self._pool is None:
+            return
+
+        self._pool.shutdown(wait=False)
+        self._pool = None
+        _EXECUTOR_WORKERS.dec(self._workers)
+
+    def _wait_for_commit(self, temp_path, piece_path):
+        future = self._loop.create_future()
+        self._uncommitted.append((temp_path, piece_path, future))
+        if not self._commit_task:
+            self._commit_task = self._loop.call_later(self._sync_interval, self._start_commit)
+
+        return future
+
+    def _start_commit(self):
+        self._commit_task = None
+        batch, self._uncommitted = self._uncommitted, []
+        # Counted from here, so closing meanwhile does not shut the pool down before the commit runs
+        self._in_flight += 1
+        asyncio.ensure_future(self._commit(batch), loop=self._loop)
+
+    async def _commit(self, batch):
+        try:
+            with _COMMIT_DURATION.time():
+                await self._run_in_pool(self._sync_and_rename, [(t, p) for t, p, _ in batch], batched=False)
+        except StorageError as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._in_flight -= 1
+            self._shutdown_if_idle()
+
+        _COMMITTED_PIECES.inc(len(batch))
+        for _, _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    # Returns temp file path when piece is left for group commit
     def _store(self, piece_index, piece_data):
         piece_path = self._get_piece_path(piece_index)
         logging.debug(f'Storing piece with index {piece_index} at path {piece_path}')
 
+        temp_path = None
         try:
-            with open(piece_path, 'wb') as f:
+            # Unique temp file, so concurrent stores of the same piece do not write into each other
+            temp_path = f'{piece_path}.{next(self._temp_ids)}{_TEMP_SUFFIX}'
+            with open(temp_path, 'wb') as f:
                 f.write(piece_data)
+
+            if self._sync_interval is None:
+                os.replace(temp_path, piece_path)
+                return None
         except OSError as e:
+            if temp_path:
+                _remove_quietly(temp_path)
             raise StorageError(f'Failed to store piece at: {piece_path}') from e
 
+        return temp_path
+
+    # Data of every piece is synced before any rename, so a rename that survives a crash always
+    # points to complete data. One directory sync then covers all renames of the batch
+    def _sync_and_rename(self, paths):
+        logging.debug(f'Committing {len(paths)} pieces at path {self._pieces_path}')
+
+        try:
+            for temp_path, _ in paths:
+                _sync_file(temp_path)
+            for temp_path, piece_path in paths:
+                os.replace(temp_path, piece_path)
+            _sync_file(self._pieces_path)
+        except OSError as e:
+            for temp_path, _ in paths:
+                _remove_quietly(temp_path)
+            raise StorageError(f'Failed to commit pieces at: {self._pieces_path}') from e
+
     def _retrieve(self, piece_index):
         piece_path = self._get_piece_path(piece_index)
         logging.debug(f'Retrieving piece with index {piece_index} from path {piece_path}')
@@ -111,52 +304,137 @@ class StorageHandler:
         return content
 
     # TODO - add cleanup and retries here. Long operation so it is good to be resilient as possible
-    # TODO - check if last piece is completely used, meaning total file size and total piece size are equal
-    def _compose_files(self, file_infos):
+    # Pieces are located from file offsets rather than listed, so boundary pieces shared with
+    # skipped files are read only for the part belonging to wanted files
+    def _compose_files(self, file_infos, piece_length, selection=None):
         logging.info(f'Composing files at path: {self._path}')
-        piece_file_names = self._list_piece_file_names()
-        piece_index = 0
-        piece_offset = 0
+        file_offset = 0
+        temp_path = None
 
         try:
-            for file in file_infos:
+            for file_index, file in enumerate(file_infos):
+                position = file_offset
+                file_end = file_offset + file.length
+                file_offset = file_end
+
+                if selection and not selection.is_file_wanted(file_index):
+                    continue
+
                 file_path = os.path.join(self._path, file.path)
                 file_dir = os.path.dirname(file_path)
                 if not os.path.exists(file_dir):
                     os.makedirs(file_dir, 0o700)
 
-                with open(file_path, 'wb') as f:
-                    to_write = file.size
-
-                    while to_write:
-                        piece_file_name = piece_file_names[piece_index]
-                        piece_path = os.path.join(self._pieces_path, piece_file_name)
+                # Composed in a temp file as well, so an interrupted compose does not look finished
+                temp_path = file_path + _TEMP_SUFFIX
+                with open(temp_path, 'wb') as f:
+                    while position < file_end:
+                        piece_index, piece_offset = divmod(position, piece_length)
+                        to_read = min(file_end - position, piece_length - piece_offset)
 
-                        with open(piece_path, 'rb') as pf:
+                        with open(self._get_piece_path(piece_index), 'rb') as pf:
                             pf.seek(piece_offset)
-                            content = pf.read(to_write)
+                            content = pf.read(to_read)
+
+                        if len(content) != to_read:
+                            raise StorageError(f'Piece {piece_index} shorter than expected while composing files')
 
                         f.write(content)
-                        to_write -= len(content)
-                        if to_write:
-                            piece_index += 1
-                            piece_offset = 0
-                        else:
-                            piece_offset += len(content)
+                        position += to_read
+
+                    if self._sync_interval is not None:
+                        f.flush()
+                        _fdatasync(f.fileno())
+
+                os.replace(temp_path, file_path)
+                temp_path = None
         except OSError as e:
             raise StorageError(f'Error occurred while composing files') from e
+        finally:
+            # Left only by a failed compose, nothing else would remove it
+            if temp_path:
+                _remove_quietly(temp_path)
 
     def _get_piece_path(self, piece_index):
         return os.path.join(self._pieces_path, f'{piece_index}.piece')
 
-    def _list_piece_file_names(self):
-        try:
-            piece_names = os.listdir(self._pieces_path)
-        except OSError as e:
-            raise StorageError(f'Failed to list piece files') from e
 
-        piece_names.sort(key=lambda name: int(name.split('.')[0]))
-        return piece_names
+# Operations submitted during one loop iteration are collected and handed to the pool as at most
+# one job per worker, and each job reports all its results with a single loop wake-up. Under load
+# this replaces per-operation future wrapping, thread handoff and wake-up with per-batch ones
+class _BatchingExecutor:
+    def __init__(self, pool, workers, loop):
+        self._pool = pool
+        self._workers = workers
+        self._loop = loop
+        self._pending = []
+        self._flush_scheduled = False
+
+    def submit(self, func, *args):
+        future = self._loop.create_future()
+        self._pending.append((func, args, future))
+
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+
+        return future
+
+    def _flush(self):
+        self._flush_scheduled = False
+        pending, self._pending = self._pending, []
+
+        # Split so that a big batch still keeps all workers busy
+        job_count = min(self._workers, len(pending))
+        for i in range(job_count):
+            self._pool.submit(self._run_batch, pending[i::job_count])
+
+    def _run_batch(self, batch):
+        results = []
+        for func, args, future in batch:
+            try:
+                results.append((future, None, func(*args)))
+            except Exception as e:
+                results.append((future, e, None))
+
+        self._loop.call_soon_threadsafe(self._complete_batch, results)
+
+    def _complete_batch(self, results):
+        for future, exception, result in results:
+            if future.cancelled():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+
+def _sync_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        _fdatasync(fd)
+    finally:
+        os.close(fd)
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# Leftovers of stores interrupted by a crash. Never renamed, so never complete pieces
+def _remove_temp_files(pieces_path):
+    try:
+        temp_names = [name for name in os.listdir(pieces_path) if name.endswith(_TEMP_SUFFIX)]
+    except OSError as e:
+        raise StorageError(f'Failed to list pieces at: {pieces_path}') from e
+
+    if temp_names:
+        logging.info(f'Removing {len(temp_names)} unfinished pieces at path: {pieces_path}')
+    for name in temp_names:
+        _remove_quietly(os.path.join(pieces_path, name))
 
 
 def _check_ownership_and_permissions(path):
@@ -0,0 +1,110 @@
+import logging
+import os
+
+from pyrrent.selection import FilePriority
+
+
+class StreamError(Exception):
+    pass
+
+
+async def open_stream(storage_handler, metafile, file_index, selection=None, readahead=8):
+    if not 0 <= file_index < len(metafile.files):
+        raise StreamError(f'Invalid file index: {file_index}')
+
+    # With a single piece, its length is the total length, which works the same here
+    piece_length = metafile.pieces[0].length
+    file_offset = sum(file.length for file in metafile.files[:file_index])
+    stream = FileStream(storage_handler, piece_length, file_offset, metafile.files[file_index].length,
+                        selection, readahead)
+
+    if selection and not selection.is_file_wanted(file_index):
+        selection.set_file_priority(file_index, FilePriority.NORMAL)
+
+    return stream
+
+
+class FileStream:
+    # Reads a file of the torrent straight from stored pieces while it downloads. A read waits
+    # only for the pieces it covers, and pieces ahead of the read position are marked urgent
+    def __init__(self, storage_handler, piece_length, file_offset, file_length, selection=None, readahead=8):
+        self._storage_handler = storage_handler
+        self._piece_length = piece_length
+        self._file_offset = file_offset
+        self._file_length = file_length
+        self._selection = selection
+        self._readahead = readahead
+        self._position = 0
+        self._closed = False
+
+    @property
+    def length(self):
+        return self._file_length
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self._position + offset
+        elif whence == os.SEEK_END:
+            position = self._file_length + offset
+        else:
+            raise StreamError(f'Invalid whence: {whence}')
+
+        if position < 0:
+            raise StreamError(f'Negative seek position: {position}')
+
+        self._position = position
+        self._update_readahead()
+        return position
+
+    async def read(self, size=-1):
+        if self._closed:
+            raise StreamError(f'Read from closed stream')
+
+        remaining = self._file_length - self._position
+        if size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b''
+
+        self._update_readahead()
+        chunks = []
+
+        while size:
+            piece_index, piece_offset = divmod(self._file_offset + self._position, self._piece_length)
+            await self._storage_handler.wait_for_piece(piece_index)
+            piece_data = await self._storage_handler.retrieve(piece_index, throttle=False)
+
+            chunk = piece_data[piece_offset:piece_offset + size]
+            if not chunk:
+                raise StreamError(f'Piece {piece_index} shorter than expected')
+
+            chunks.append(chunk)
+            size -= len(chunk)
+            self._position += len(chunk)
+            if size:
+                self._update_readahead()
+
+        return b''.join(chunks)
+
+    def close(self):
+        if self._closed:
+            return
+
+        self._closed = True
+        if self._selection:
+            self._selection.set_urgent_pieces([])
+
+    def _update_readahead(self):
+        if not self._selection or self._position >= self._file_length:
+            return
+
+        first = (self._file_offset + self._position) // self._piece_length
+        last = (self._file_offset + self._file_length - 1) // self._piece_length
+        window = list(range(first, min(first + self._readahead, last + 1)))
+        logging.debug(f'Stream read-ahead window: {window[0]}-{window[-1]}')
+        self._selection.set_urgent_pieces(window)
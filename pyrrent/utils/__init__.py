@@ -1 +1,3 @@
-from .cache import Cache
\ No newline at end of file
+from .cache import Cache
+from .memory import MemoryBudget, MemoryBudgetError
+from .metrics import MetricsRegistry, MetricsExporter, REGISTRY
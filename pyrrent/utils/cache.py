@@ -2,20 +2,44 @@ import time
 
 
 class Cache:
-    def __init__(self, max_records):
+    # With max_bytes or a memory budget, records are sized with len() and the cache also evicts
+    # by bytes. A budget accounts the records under subsystem and may shrink the cache through it
+    def __init__(self, max_records, max_bytes=None, budget=None, subsystem='cache'):
         self._max_record_count = max_records
+        self._max_bytes = max_bytes
+        self._budget = budget
+        self._subsystem = subsystem
+        self._sized = max_bytes is not None or budget is not None
+        self._size = 0
         self._records = {}
 
+        if budget:
+            budget.add_reclaimer(self.shrink)
+
+    @property
+    def size(self):
+        return self._size
+
     def put(self, key, data):
         if key in self._records:
             return
 
+        size = len(data) if self._sized else 0
+        if self._max_bytes is not None and size > self._max_bytes:
+            return
+
         if len(self._records) == self._max_record_count:
             self._purge()
+        if self._max_bytes is not None and self._size + size > self._max_bytes:
+            self.shrink(self._size + size - self._max_bytes)
 
         ts = time.time()
-        new_record = _CacheRecord(key, ts, data)
+        new_record = _CacheRecord(key, ts, data, size)
         self._records[key] = new_record
+        self._size += size
+
+        if self._budget:
+            self._budget.allocate(self._subsystem, size)
 
     def get(self, key):
         record = self._records.get(key)
@@ -25,20 +49,47 @@ class Cache:
         record.timestamp = time.time()
         return record.data
 
+    # Evicts least recently used records until at least size bytes are freed, returns bytes freed
+    def shrink(self, size):
+        freed = 0
+        for record in sorted(self._records.values(), key=lambda record: record.timestamp):
+            if freed >= size:
+                break
+            self._remove(record)
+            freed += record.size
+
+        return freed
+
+    def clear(self):
+        for record in list(self._records.values()):
+            self._remove(record)
+
+    def close(self):
+        self.clear()
+        if self._budget:
+            self._budget.remove_reclaimer(self.shrink)
+
     def _purge(self):
-        to_remove = self._max_record_count * 1 // 3
+        to_remove = max(self._max_record_count // 3, 1)
         all_records = list(self._records.values())
         all_records.sort(key=lambda record: record.timestamp)
 
         for record in all_records[:to_remove]:
-            self._records.pop(record.key)
+            self._remove(record)
+
+    def _remove(self, record):
+        self._records.pop(record.key)
+        self._size -= record.size
+        if self._budget:
+            self._budget.release(self._subsystem, record.size)
 
 
 class _CacheRecord:
-    __slots__ = 'key', 'timestamp', 'data'
+    __slots__ = 'key', 'timestamp', 'data', 'size'
 
 
-    def __init__(self, key, timestamp, data):
+    def __init__(self, key, timestamp, data, size):
         self.key = key
         self.timestamp = timestamp
-        self.data = data
\ No newline at end of file
+        self.data = data
+        self.size = size
@@ -0,0 +1,159 @@
+import asyncio
+import collections
+import logging
+
+from pyrrent.utils.metrics import REGISTRY
+
+
+_LIMIT = REGISTRY.gauge('pyrrent_memory_limit_bytes', 'Memory budget limit')
+_RECLAIMED = REGISTRY.counter('pyrrent_memory_reclaimed_bytes_total', 'Bytes freed by shrinking caches')
+_WAITS = REGISTRY.counter('pyrrent_memory_waits_total', 'Reservations that waited for memory to be released')
+
+
+class MemoryBudgetError(Exception):
+    pass
+
+
+class MemoryBudget:
+    # Byte accounting shared by everything holding piece-sized buffers in one process. Subsystems
+    # allocate and release bytes under their own name, so usage is visible per subsystem.
+    # Caches register as reclaimers - callables taking a byte count to free and returning bytes
+    # actually freed. Passing the high watermark shrinks them down to the low watermark.
+    # Buffers that cannot be dropped go through try_allocate or reserve instead, which is where
+    # backpressure comes from: callers stop requesting or wait until memory is released
+    def __init__(self, limit, high_watermark=0.9, low_watermark=0.75, loop=None):
+        if limit <= 0:
+            raise MemoryBudgetError(f'Invalid memory limit: {limit}')
+        if not 0 < low_watermark <= high_watermark <= 1:
+            raise MemoryBudgetError(f'Invalid watermarks: {low_watermark}, {high_watermark}')
+
+        self.limit = limit
+        self._high = int(limit * high_watermark)
+        self._low = int(limit * low_watermark)
+        self._loop = loop if loop else asyncio.get_event_loop()
+        self._used = 0
+        self._usage = collections.defaultdict(int)
+        self._gauges = {}
+        self._reclaimers = []
+        self._reclaiming = False
+        self._waiters = collections.deque()
+        _LIMIT.set(limit)
+
+    @property
+    def used(self):
+        return self._used
+
+    @property
+    def available(self):
+        return max(self.limit - self._used, 0)
+
+    @property
+    def under_pressure(self):
+        return self._used >= self._high
+
+    def usage(self):
+        return {subsystem: size for subsystem, size in self._usage.items() if size}
+
+    def add_reclaimer(self, reclaimer):
+        self._reclaimers.append(reclaimer)
+
+    def remove_reclaimer(self, reclaimer):
+        if reclaimer in self._reclaimers:
+            self._reclaimers.remove(reclaimer)
+
+    # For memory that is already held, such as cache records - always accounted, may shrink caches
+    def allocate(self, subsystem, size):
+        self._add(subsystem, size)
+        if self._used > self._high:
+            self._reclaim(self._used - self._low)
+
+    def try_allocate(self, subsystem, size):
+        if not self._make_room(size):
+            return False
+
+        self._add(subsystem, size)
+        return True
+
+    # A single reservation larger than the whole budget is let through once nothing else is
+    # reserved, otherwise it would wait forever
+    async def reserve(self, subsystem, size):
+        if not self._waiters and self._make_room(size):
+            self._add(subsystem, size)
+            return
+
+        _WAITS.inc()
+        waiter = self._loop.create_future()
+        entry = (waiter, subsystem, size)
+        self._waiters.append(entry)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Granted just before cancellation, give it back
+                self.release(subsystem, size)
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                self._wake_waiters()
+            raise
+
+    def release(self, subsystem, size):
+        if size > self._usage[subsystem]:
+            raise MemoryBudgetError(f'Releasing {size} bytes for {subsystem}, only {self._usage[subsystem]} allocated')
+
+        self._usage[subsystem] -= size
+        self._used -= size
+        self._update_gauge(subsystem)
+        self._wake_waiters()
+
+    def _add(self, subsystem, size):
+        self._usage[subsystem] += size
+        self._used += size
+        self._update_gauge(subsystem)
+
+    def _make_room(self, size):
+        if self._used + size <= self.limit:
+            return True
+
+        self._reclaim(self._used + size - self._low)
+        return self._used + size <= self.limit or self._used == 0
+
+    def _reclaim(self, size):
+        # Reclaimers release through this budget, which must not start another round
+        if self._reclaiming:
+            return
+
+        self._reclaiming = True
+        try:
+            freed = 0
+            for reclaimer in list(self._reclaimers):
+                if freed >= size:
+                    break
+                freed += reclaimer(size - freed)
+        finally:
+            self._reclaiming = False
+
+        if freed:
+            logging.debug(f'Reclaimed {freed} bytes, {self._used} of {self.limit} in use')
+            _RECLAIMED.inc(freed)
+
+    def _wake_waiters(self):
+        while self._waiters:
+            waiter, subsystem, size = self._waiters[0]
+            if waiter.done():
+                self._waiters.popleft()
+                continue
+
+            if not self._make_room(size):
+                break
+
+            self._waiters.popleft()
+            self._add(subsystem, size)
+            waiter.set_result(None)
+
+    def _update_gauge(self, subsystem):
+        gauge = self._gauges.get(subsystem)
+        if gauge is None:
+            gauge = REGISTRY.gauge('pyrrent_memory_used_bytes', 'Bytes accounted by the memory budget',
+                                   labels={'subsystem': subsystem})
+            self._gauges[subsystem] = gauge
+        gauge.set(self._usage[subsystem])
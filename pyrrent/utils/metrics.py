@@ -0,0 +1,229 @@
+import asyncio
+import bisect
+import logging
+import time
+
+
+DEFAULT_LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+
+class MetricsRegistry:
+    # Disabled registry keeps metric objects but counter and histogram updates return after one
+    # flag check, so instrumentation in hot paths costs next to nothing until metrics are enabled
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._metrics = {}
+
+    def counter(self, name, help='', labels=None):
+        return self._get_or_create(Counter, name, help, labels)
+
+    def gauge(self, name, help='', labels=None):
+        return self._get_or_create(Gauge, name, help, labels)
+
+    def histogram(self, name, help='', labels=None, buckets=DEFAULT_LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, help, labels, buckets)
+
+    def snapshot(self):
+        return {metric.key: metric.snapshot() for metric in self._metrics.values()}
+
+    def render_prometheus(self):
+        lines = []
+        described = set()
+
+        for metric in sorted(self._metrics.values(), key=lambda m: m.key):
+            if metric.name not in described:
+                described.add(metric.name)
+                if metric.help:
+                    lines.append(f'# HELP {metric.name} {metric.help}')
+                lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+    def _get_or_create(self, metric_class, name, help, labels, *args):
+        key = _metric_key(name, labels)
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = metric_class(self, name, help, labels, *args)
+            self._metrics[key] = metric
+        elif not isinstance(metric, metric_class):
+            raise ValueError(f'Metric {key} already registered as {metric.TYPE}')
+
+        return metric
+
+
+class _Metric:
+    TYPE = 'untyped'
+
+    def __init__(self, registry, name, help, labels):
+        self._registry = registry
+        self.name = name
+        self.help = help
+        self.labels = dict(labels) if labels else {}
+        self.key = _metric_key(name, labels)
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def __init__(self, registry, name, help, labels):
+        super().__init__(registry, name, help, labels)
+        self.value = 0
+
+    def inc(self, amount=1):
+        if self._registry.enabled:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+    def render(self):
+        return [f'{self.name}{_render_labels(self.labels)} {self.value}']
+
+
+class Gauge(_Metric):
+    TYPE = 'gauge'
+
+    def __init__(self, registry, name, help, labels):
+        super().__init__(registry, name, help, labels)
+        self.value = 0
+
+    # Gauges hold current level rather than count events, so they are kept up to date even while
+    # the registry is disabled - otherwise enabling it mid-run would leave them off by whatever
+    # was in flight
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def snapshot(self):
+        return self.value
+
+    def render(self):
+        return [f'{self.name}{_render_labels(self.labels)} {self.value}']
+
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, registry, name, help, labels, buckets):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(buckets)
+        # Last slot counts observations above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        if self._registry.enabled:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def snapshot(self):
+        return {
+            'buckets': dict(zip(self.buckets + ('+Inf',), self.counts)),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+    def render(self):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            labels = dict(self.labels, le=bound)
+            lines.append(f'{self.name}_bucket{_render_labels(labels)} {cumulative}')
+
+        lines.append(f'{self.name}_sum{_render_labels(self.labels)} {self.sum}')
+        lines.append(f'{self.name}_count{_render_labels(self.labels)} {self.count}')
+        return lines
+
+
+class _Timer:
+    __slots__ = '_histogram', '_start'
+
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+        self._start = None
+
+    def __enter__(self):
+        if self._histogram._registry.enabled:
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._start is not None:
+            self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+
+class MetricsExporter:
+    # Serves registry in Prometheus text format on GET /metrics. Meant for local scraping only
+    def __init__(self, registry, host='127.0.0.1', port=9464, loop=None):
+        self._registry = registry
+        self._host = host
+        self._port = port
+        self._loop = loop if loop else asyncio.get_event_loop()
+        self._server = None
+
+    async def start(self):
+        logging.info(f'Starting metrics exporter on {self._host}:{self._port}')
+        self._server = await asyncio.start_server(self._handle_client, host=self._host, port=self._port)
+
+    def stop(self):
+        if self._server:
+            self._server.close()
+            self._server = None
+
+    async def _handle_client(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                body = self._registry.render_prometheus().encode()
+                status = '200 OK'
+            else:
+                body = b'Not found\n'
+                status = '404 Not Found'
+
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         f'Content-Type: text/plain; version=0.0.4\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logging.debug(f'Metrics client error: {e}')
+        finally:
+            writer.close()
+
+
+def _metric_key(name, labels):
+    if not labels:
+        return name
+    return name + _render_labels(labels)
+
+
+def _render_labels(labels):
+    if not labels:
+        return ''
+    rendered = ','.join(f'{k}="{_escape_label(v)}"' for k, v in sorted(labels.items()))
+    return '{' + rendered + '}'
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REGISTRY = MetricsRegistry()
@@ -1,10 +1,22 @@
 class PeerCoordinatorStub:
-    def __init__(self):
+    def __init__(self, wanted_peer_count=50):
         self._announce_results = []
+        self._announcer_errors = []
+        self.wanted_peer_count = wanted_peer_count
 
     @property
     def announce_results(self):
         return self._announce_results
 
-    def process_announce_result(self, result):
+    def process_announce_result(self, result, source=None):
         self._announce_results.append(result)
+
+    @property
+    def announcer_errors(self):
+        return self._announcer_errors
+
+    def process_announcer_error(self, event):
+        self._announcer_errors.append(event)
+
+    def get_wanted_peer_count(self):
+        return self.wanted_peer_count
@@ -27,8 +27,7 @@ class HTTPTrackerStub:
         try:
             self._server = await asyncio.start_server(self._handle_client,
                                                       host=self._address,
-                                                      port=self._port,
-                                                      loop = self._loop)
+                                                      port=self._port)
         except Exception as e:
             self._exceptions.append(e)
 
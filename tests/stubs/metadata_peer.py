@@ -0,0 +1,63 @@
+import asyncio
+import struct
+
+from pyrrent.bencoding import encode, decode_partial
+
+
+class MetadataPeerStub:
+    def __init__(self, info_hash, encoded_info, corrupt=False, reject=False, extensions=True):
+        self._info_hash = info_hash
+        self._encoded_info = encoded_info
+        self._corrupt = corrupt
+        self._reject = reject
+        self._extensions = extensions
+        self._server = None
+        self.requested_pieces = []
+
+    @property
+    def address(self):
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_client, host='127.0.0.1', port=0)
+
+    def stop(self):
+        if self._server:
+            self._server.close()
+
+    async def _handle_client(self, reader, writer):
+        try:
+            await reader.readexactly(68)
+            reserved = b'\x00\x00\x00\x00\x00\x10\x00\x00' if self._extensions else b'\x00' * 8
+            writer.write(b'\x13BitTorrent protocol' + reserved + self._info_hash + b'-ST0001-' + b'0' * 12)
+            # Bitfield before extended handshake, as real clients do
+            self._write_message(writer, b'\x05\xff')
+            self._write_message(writer, b'\x14\x00' + encode({'m': {'ut_metadata': 3},
+                                                               'metadata_size': len(self._encoded_info)}))
+
+            while True:
+                length, = struct.unpack('!I', await reader.readexactly(4))
+                message = await reader.readexactly(length)
+                if message[:2] != b'\x14\x03':
+                    continue
+
+                header, _ = decode_partial(message[2:])
+                piece = header['piece']
+                self.requested_pieces.append(piece)
+                if self._reject:
+                    self._write_message(writer, b'\x14\x01' + encode({'msg_type': 2, 'piece': piece}))
+                    continue
+
+                data = self._encoded_info[piece * 16384:(piece + 1) * 16384]
+                if self._corrupt:
+                    data = bytes(len(data))
+                self._write_message(writer, b'\x14\x01' + encode({'msg_type': 1, 'piece': piece,
+                                                                   'total_size': len(self._encoded_info)}) + data)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def _write_message(self, writer, message):
+        writer.write(struct.pack('!I', len(message)) + message)
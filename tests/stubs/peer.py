@@ -0,0 +1,40 @@
+import asyncio
+
+from pyrrent.connections import encode_handshake, HANDSHAKE_LENGTH
+
+
+class PeerStub:
+    def __init__(self, info_hash, peer_id=b'-ST0001-000000000000', respond=True):
+        self._info_hash = info_hash
+        self._peer_id = peer_id
+        self._respond = respond
+        self._server = None
+        self._writers = []
+        self.handshakes = []
+
+    @property
+    def address(self):
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_client, host='127.0.0.1', port=0)
+
+    def stop(self):
+        if self._server:
+            self._server.close()
+        for writer in self._writers:
+            writer.close()
+
+    async def _handle_client(self, reader, writer):
+        self._writers.append(writer)
+        try:
+            self.handshakes.append(await reader.readexactly(HANDSHAKE_LENGTH))
+            if self._respond:
+                writer.write(encode_handshake(self._info_hash, self._peer_id))
+                await writer.drain()
+            # Hold connection open until the other side closes it
+            await reader.read()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
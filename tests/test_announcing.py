@@ -1,7 +1,8 @@
 import asyncio
+import time
 import unittest
 
-from pyrrent.announcing import HTTPAnnouncer
+from pyrrent.announcing import HTTPAnnouncer, TrackerHealth
 from pyrrent.bencoding import decode
 
 from tests.stubs.http_tracker import HTTPTrackerStub
@@ -12,13 +13,15 @@ from tests.stubs.coordinator import PeerCoordinatorStub
 _HTTP_TRACKER_STUB_PORT = 30701
 
 
-def _tracker_response(seeders, leechers, interval=1, peers=b'', tracker_id=''):
+def _tracker_response(seeders, leechers, interval=1, peers=b'', tracker_id='', min_interval=None):
     resp = {
         'complete': seeders,
         'incomplete': leechers,
         'interval': interval,
         'peers': peers,
     }
+    if min_interval is not None:
+        resp['min interval'] = min_interval
     if tracker_id:
         resp['trackerid'] = tracker_id
     return resp
@@ -57,4 +60,114 @@ class HTTPAnnouncerTests(unittest.TestCase):
         result_0 = coordinator.announce_results[0]
         self.assertEqual(result_0.complete, 10)
         self.assertEqual(result_0.incomplete, 20)
-        self.assertEqual(result_0.peers, b'\x01\x02\x03\x04\x05\x06')
\ No newline at end of file
+        self.assertEqual(result_0.peers, [('1.2.3.4', 1286)])
+
+    def test_numwant_follows_coordinator_demand(self):
+        loop = asyncio.get_event_loop()
+        download_info = DownloadInfoStub('peer_id', b'info_hash', 5000, [0, 0], [0, 0], [10000, 10000])
+        coordinator = PeerCoordinatorStub(wanted_peer_count=1000)
+        responses = [_tracker_response(10, 20, interval=100), _tracker_response(10, 20, interval=100)]
+        http_tracker = HTTPTrackerStub('0.0.0.0', _HTTP_TRACKER_STUB_PORT, responses)
+        announcer = HTTPAnnouncer(f'http://127.0.0.1:{_HTTP_TRACKER_STUB_PORT}',
+                                  download_info,
+                                  coordinator,
+                                  max_numwant=300)
+
+        loop.run_until_complete(http_tracker.start())
+        loop.run_until_complete(asyncio.sleep(0.01))
+
+        task = loop.create_task(announcer.announcing())
+        loop.run_until_complete(asyncio.sleep(0.01))
+
+        coordinator.wanted_peer_count = 0
+        announcer.stop()
+        loop.run_until_complete(asyncio.wait_for(task, 1))
+        http_tracker.stop()
+
+        self.assertEqual(len(http_tracker.requests), 2)
+        self.assertEqual(http_tracker.requests[0]['numwant'], '300')
+        self.assertEqual(http_tracker.requests[1]['event'], 'stopped')
+        self.assertEqual(http_tracker.requests[1]['numwant'], '0')
+        self.assertTrue(announcer._session.closed)
+
+    def test_request_peers_announces_early(self):
+        loop = asyncio.get_event_loop()
+        download_info = DownloadInfoStub('peer_id', b'info_hash', 5000, [0, 0], [0, 0], [10000, 10000])
+        coordinator = PeerCoordinatorStub()
+        responses = [_tracker_response(10, 20, interval=100, min_interval=0),
+                     _tracker_response(10, 20, interval=100, min_interval=0)]
+        http_tracker = HTTPTrackerStub('0.0.0.0', _HTTP_TRACKER_STUB_PORT, responses)
+        announcer = HTTPAnnouncer(f'http://127.0.0.1:{_HTTP_TRACKER_STUB_PORT}',
+                                  download_info,
+                                  coordinator)
+
+        loop.run_until_complete(http_tracker.start())
+        loop.run_until_complete(asyncio.sleep(0.01))
+
+        loop.create_task(announcer.announcing())
+        loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual(len(http_tracker.requests), 1)
+
+        announcer.request_peers()
+        loop.run_until_complete(asyncio.sleep(0.01))
+        http_tracker.stop()
+
+        self.assertEqual(len(http_tracker.requests), 2)
+        self.assertEqual(http_tracker.requests[1]['event'], 'normal')
+        self.assertEqual(len(coordinator.announce_results), 2)
+
+    def test_failed_announce_is_retried(self):
+        loop = asyncio.get_event_loop()
+        download_info = DownloadInfoStub('peer_id', b'info_hash', 5000, [0, 0], [0, 0], [10000, 10000])
+        coordinator = PeerCoordinatorStub()
+        http_tracker = HTTPTrackerStub('0.0.0.0', _HTTP_TRACKER_STUB_PORT, [_tracker_response(10, 20, interval=100)])
+        announcer = HTTPAnnouncer(f'http://127.0.0.1:{_HTTP_TRACKER_STUB_PORT}',
+                                  download_info,
+                                  coordinator,
+                                  retry_base=0.05)
+
+        loop.create_task(announcer.announcing())
+        loop.run_until_complete(asyncio.sleep(0.01))
+
+        self.assertEqual(coordinator.announcer_errors, ['started'])
+        self.assertEqual(announcer.health.consecutive_failures, 1)
+
+        loop.run_until_complete(http_tracker.start())
+        loop.run_until_complete(asyncio.sleep(0.1))
+        http_tracker.stop()
+
+        self.assertEqual(len(http_tracker.requests), 1)
+        self.assertEqual(http_tracker.requests[0]['event'], 'started')
+        self.assertEqual(len(coordinator.announce_results), 1)
+        self.assertEqual(announcer.health.consecutive_failures, 0)
+        self.assertEqual(announcer.health.success_count, 1)
+
+
+class TrackerHealthTests(unittest.TestCase):
+    def test_latency_histogram(self):
+        health = TrackerHealth()
+
+        health.record_success(0.01)
+        health.record_success(0.3)
+        health.record_success(100)
+
+        self.assertEqual(health.latency_histogram, [1, 0, 0, 1, 0, 0, 0, 0, 1])
+        self.assertEqual(health.success_count, 3)
+
+    def test_circuit_opens_after_consecutive_failures(self):
+        health = TrackerHealth(failure_threshold=2, open_duration=0.01)
+
+        health.record_failure()
+        self.assertTrue(health.is_available)
+        self.assertLess(health.success_rate, 1)
+
+        health.record_failure()
+        self.assertFalse(health.is_available)
+        self.assertGreater(health.time_until_available(), 0)
+
+        time.sleep(0.02)
+        self.assertTrue(health.is_available)
+
+        health.record_success(0.1)
+        self.assertEqual(health.consecutive_failures, 0)
+        self.assertEqual(health.time_until_available(), 0)
@@ -1,6 +1,6 @@
 import unittest
 
-from pyrrent.bencoding import encode, decode, BencodingError
+from pyrrent.bencoding import encode, decode, decode_partial, BencodingError
 
 
 class BencodingTests(unittest.TestCase):
@@ -116,3 +116,29 @@ class BencodingTests(unittest.TestCase):
         for invalid_input in invalid_inputs:
             with self.assertRaises(BencodingError):
                 decode(invalid_input)
+
+
+    def test_decode_dict_binary_keys(self):
+        encoded = b'd5:spam\xff4:eggs3:foo3:bare'
+
+        with self.assertRaises(BencodingError):
+            decode(encoded)
+
+        self.assertEqual(decode(encoded, binary_keys=True), {b'spam\xff': b'eggs', 'foo': b'bar'})
+
+    def test_encode_dict_bytes_keys(self):
+        self.assertEqual(encode({b'\xff\x00': 1}), b'd2:\xff\x00i1ee')
+
+    def test_decode_truncated(self):
+        inputs = [b'', b'l', b'd1:a', b'li1e']
+
+        for input in inputs:
+            with self.assertRaises(BencodingError):
+                decode(input)
+
+    def test_decode_partial(self):
+        self.assertEqual(decode_partial(b'd3:fooi1eeraw data'), ({'foo': 1}, b'raw data'))
+        self.assertEqual(decode_partial(b'i5e'), (5, b''))
+
+        with self.assertRaises(BencodingError):
+            decode_partial(b'd3:foo')
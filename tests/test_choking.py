@@ -0,0 +1,93 @@
+import unittest
+
+from pyrrent.choking import RateMeter, Choker
+
+
+class _FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RateMeterTests(unittest.TestCase):
+    def test_rate_over_window(self):
+        clock = _FakeClock()
+        meter = RateMeter(window=4, clock=clock)
+
+        meter.add(400)
+        self.assertEqual(meter.rate, 100)
+
+        clock.now += 2
+        meter.add(400)
+        self.assertEqual(meter.rate, 200)
+
+        clock.now += 2
+        self.assertEqual(meter.rate, 100)
+
+        clock.now += 100
+        self.assertEqual(meter.rate, 0)
+
+
+class ChokerTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = _FakeClock()
+        self.choker = Choker(upload_slots=3, optimistic_rounds=3, clock=self.clock)
+        for peer in range(10):
+            self.choker.add_peer(peer)
+            self.choker.set_interested(peer, True)
+            self.choker.record_download(peer, peer * 1000)
+            self.choker.record_upload(peer, (10 - peer) * 1000)
+
+    def test_leecher_unchokes_fastest_downloaders_and_optimistic(self):
+        newly_unchoked, newly_choked = self.choker.run_round()
+
+        optimistic_peer = self.choker.optimistic_peer
+        self.assertNotIn(optimistic_peer, (8, 9))
+        self.assertEqual(newly_unchoked, {8, 9, optimistic_peer})
+        self.assertEqual(newly_choked, set())
+
+    def test_seeder_unchokes_fastest_uploads(self):
+        self.choker.set_seeding(True)
+
+        self.choker.run_round()
+
+        self.assertTrue({0, 1} <= self.choker.unchoked)
+        self.assertEqual(len(self.choker.unchoked), 3)
+
+    def test_optimistic_unchoke_rotates(self):
+        self.choker.run_round()
+        optimistic_peer = self.choker.optimistic_peer
+
+        self.choker.run_round()
+        self.choker.run_round()
+        self.assertEqual(self.choker.optimistic_peer, optimistic_peer)
+
+        self.choker.set_interested(optimistic_peer, False)
+        self.choker.run_round()
+        self.assertNotEqual(self.choker.optimistic_peer, optimistic_peer)
+
+    def test_uninterested_and_removed_peers_are_choked(self):
+        self.choker.run_round()
+
+        self.choker.set_interested(9, False)
+        self.choker.remove_peer(8)
+        newly_unchoked, newly_choked = self.choker.run_round()
+
+        self.assertIn(9, newly_choked)
+        self.assertNotIn(8, self.choker.unchoked)
+        self.assertIn(7, self.choker.unchoked)
+
+    def test_optimistic_peer_ranked_into_regular_slots_is_replaced(self):
+        self.choker.run_round()
+        optimistic_peer = self.choker.optimistic_peer
+
+        # Between rotations, optimistic peer becomes the fastest downloader
+        self.choker.record_download(optimistic_peer, 100000)
+        self.choker.run_round()
+
+        self.assertIn(optimistic_peer, self.choker.unchoked)
+        self.assertNotEqual(self.choker.optimistic_peer, optimistic_peer)
+        self.assertIn(self.choker.optimistic_peer, self.choker.unchoked)
+        self.assertEqual(len(self.choker.unchoked), 3)
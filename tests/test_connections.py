@@ -0,0 +1,233 @@
+import asyncio
+import time
+import unittest
+
+from pyrrent.connections import (ConnectionManager, ConnectionManagerError, encode_handshake, decode_handshake,
+                                 HANDSHAKE_LENGTH)
+from pyrrent.peers import PeerStore
+from pyrrent.utils import MemoryBudget
+from tests.stubs.peer import PeerStub
+
+
+INFO_HASH = b'\x01' * 20
+OTHER_INFO_HASH = b'\x02' * 20
+PEER_ID = b'-PY0001-000000000000'
+
+
+class HandshakeTests(unittest.TestCase):
+    def test_encode_and_decode(self):
+        encoded = encode_handshake(INFO_HASH, PEER_ID)
+
+        self.assertEqual(len(encoded), HANDSHAKE_LENGTH)
+        info_hash, peer_id, reserved = decode_handshake(encoded)
+        self.assertEqual((info_hash, peer_id), (INFO_HASH, PEER_ID))
+        self.assertTrue(reserved[5] & 0x10)
+
+    def test_decode_invalid(self):
+        with self.assertRaises(ConnectionManagerError):
+            decode_handshake(b'\x13' + b'x' * 67)
+        with self.assertRaises(ConnectionManagerError):
+            decode_handshake(b'\x13BitTorrent protocol')
+
+
+class ConnectionManagerTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.stubs = []
+        self.managers = []
+
+    def tearDown(self):
+        for manager in self.managers:
+            manager.stop()
+        for stub in self.stubs:
+            stub.stop()
+        self.run_for(0.01)
+
+    def run_for(self, duration):
+        self.loop.run_until_complete(asyncio.sleep(duration))
+
+    def run_until(self, condition, timeout=2):
+        async def wait():
+            while not condition():
+                await asyncio.sleep(0.01)
+
+        self.loop.run_until_complete(asyncio.wait_for(wait(), timeout))
+
+    def start_stubs(self, count, **kwargs):
+        stubs = [PeerStub(INFO_HASH, **kwargs) for _ in range(count)]
+        for stub in stubs:
+            self.loop.run_until_complete(stub.start())
+        self.stubs.extend(stubs)
+        return stubs
+
+    def create_manager(self, listen=False, **kwargs):
+        manager = ConnectionManager(PEER_ID, loop=self.loop, **kwargs)
+        if listen:
+            self.loop.run_until_complete(manager.start('127.0.0.1', 0))
+        self.managers.append(manager)
+        return manager
+
+    def test_connects_to_known_peers(self):
+        stubs = self.start_stubs(3)
+        peer_store = PeerStore()
+        peer_store.add([stub.address for stub in stubs])
+        connected = []
+        manager = self.create_manager()
+
+        manager.register(INFO_HASH, peer_store, connected.append)
+        self.run_until(lambda: len(connected) == 3)
+
+        self.assertEqual({c.peer for c in connected}, {stub.address for stub in stubs})
+        self.assertTrue(all(c.outgoing and c.supports_extensions for c in connected))
+        self.assertEqual(manager.connection_count, 3)
+        for stub in stubs:
+            self.assertEqual(decode_handshake(stub.handshakes[0])[:2], (INFO_HASH, PEER_ID))
+
+    def test_new_peers_are_dialed_immediately(self):
+        stubs = self.start_stubs(2)
+        peer_store = PeerStore()
+        manager = self.create_manager()
+        manager.register(INFO_HASH, peer_store)
+        self.run_for(0.01)
+
+        peer_store.add([stub.address for stub in stubs])
+        manager.peers_added(INFO_HASH)
+        self.run_until(lambda: manager.connection_count == 2)
+
+    def test_half_open_limit_and_backoff(self):
+        stubs = self.start_stubs(5, respond=False)
+        peer_store = PeerStore(base_backoff=60)
+        peer_store.add([stub.address for stub in stubs])
+        manager = self.create_manager(max_half_open=2, handshake_timeout=0.05)
+        half_open_counts = []
+
+        manager.register(INFO_HASH, peer_store)
+        for _ in range(30):
+            self.run_for(0.01)
+            half_open_counts.append(manager.half_open_count)
+
+        self.assertEqual(max(half_open_counts), 2)
+        self.assertEqual(manager.connection_count, 0)
+        # Every peer was tried and is now backing off
+        self.assertTrue(all(stub.handshakes for stub in stubs))
+        self.assertEqual(peer_store.get_connectable(5), [])
+
+    def test_per_torrent_cap_is_refilled_on_close(self):
+        stubs = self.start_stubs(4)
+        peer_store = PeerStore()
+        peer_store.add([stub.address for stub in stubs])
+        manager = self.create_manager(max_connections_per_torrent=2)
+
+        manager.register(INFO_HASH, peer_store)
+        self.run_until(lambda: manager.connection_count == 2)
+        self.run_for(0.05)
+        self.assertEqual(manager.connection_count, 2)
+
+        closed = manager.get_connections(INFO_HASH)[0]
+        closed.close()
+        self.run_until(lambda: len(manager.get_connections(INFO_HASH)) == 2)
+
+        self.assertNotIn(closed, manager.get_connections(INFO_HASH))
+
+    def test_self_connection_is_dropped(self):
+        stub, = self.start_stubs(1, peer_id=PEER_ID)
+        peer_store = PeerStore()
+        peer_store.add([stub.address])
+        manager = self.create_manager()
+
+        manager.register(INFO_HASH, peer_store)
+        self.run_until(lambda: stub.handshakes)
+        self.run_for(0.02)
+
+        self.assertEqual(manager.connection_count, 0)
+        self.assertNotIn(stub.address, peer_store)
+
+    def test_incoming_connections_are_routed_by_info_hash(self):
+        manager = self.create_manager(listen=True)
+        connected = {INFO_HASH: [], OTHER_INFO_HASH: []}
+        manager.register(INFO_HASH, PeerStore(), connected[INFO_HASH].append)
+        manager.register(OTHER_INFO_HASH, PeerStore(), connected[OTHER_INFO_HASH].append)
+
+        async def connect(info_hash):
+            reader, writer = await asyncio.open_connection(*manager.address)
+            writer.write(encode_handshake(info_hash, b'-ST0001-111111111111'))
+            data = await reader.read(HANDSHAKE_LENGTH)
+            return data, writer
+
+        reply, writer_1 = self.loop.run_until_complete(connect(INFO_HASH))
+        self.assertEqual(decode_handshake(reply)[:2], (INFO_HASH, PEER_ID))
+        reply, writer_2 = self.loop.run_until_complete(connect(OTHER_INFO_HASH))
+        self.assertEqual(decode_handshake(reply)[:2], (OTHER_INFO_HASH, PEER_ID))
+        reply, writer_3 = self.loop.run_until_complete(connect(b'\x03' * 20))
+        self.assertEqual(reply, b'')
+
+        self.assertEqual(len(connected[INFO_HASH]), 1)
+        self.assertEqual(len(connected[OTHER_INFO_HASH]), 1)
+        self.assertFalse(connected[INFO_HASH][0].outgoing)
+        for writer in (writer_1, writer_2, writer_3):
+            writer.close()
+
+    def test_unproductive_connection_is_evicted_for_incoming(self):
+        stubs = self.start_stubs(2)
+        peer_store = PeerStore()
+        peer_store.add([stub.address for stub in stubs])
+        manager = self.create_manager(listen=True, max_connections_per_torrent=2, unproductive_timeout=10)
+        manager.register(INFO_HASH, peer_store)
+        self.run_until(lambda: manager.connection_count == 2)
+
+        productive, idle = manager.get_connections(INFO_HASH)
+        productive.record_download(100)
+        idle.last_active = time.monotonic() - 20
+
+        async def connect():
+            reader, writer = await asyncio.open_connection(*manager.address)
+            writer.write(encode_handshake(INFO_HASH, b'-ST0001-111111111111'))
+            data = await reader.read(HANDSHAKE_LENGTH)
+            writer.close()
+            return data
+
+        self.assertEqual(len(self.loop.run_until_complete(connect())), HANDSHAKE_LENGTH)
+        self.assertTrue(idle.closed)
+        self.assertFalse(productive.closed)
+
+        # Nobody idle long enough now, so the next one is turned away
+        self.assertEqual(self.loop.run_until_complete(connect()), b'')
+
+    def test_unregister_closes_connections(self):
+        stubs = self.start_stubs(2)
+        peer_store = PeerStore()
+        peer_store.add([stub.address for stub in stubs])
+        manager = self.create_manager()
+        manager.register(INFO_HASH, peer_store)
+        self.run_until(lambda: manager.connection_count == 2)
+        connections = manager.get_connections(INFO_HASH)
+
+        manager.unregister(INFO_HASH)
+
+        self.assertTrue(all(c.closed for c in connections))
+        self.assertEqual(manager.connection_count, 0)
+        self.assertEqual(manager.get_connections(INFO_HASH), [])
+
+    def test_dialing_stops_when_receive_buffers_do_not_fit(self):
+        stubs = self.start_stubs(3)
+        peer_store = PeerStore()
+        peer_store.add([stub.address for stub in stubs])
+        budget = MemoryBudget(2500, loop=self.loop)
+        manager = self.create_manager(receive_buffer_size=1000, memory_budget=budget)
+
+        manager.register(INFO_HASH, peer_store)
+        self.run_until(lambda: manager.connection_count == 2)
+        self.run_for(0.05)
+
+        self.assertEqual(manager.connection_count, 2)
+        self.assertEqual(budget.usage(), {'receive_buffers': 2000})
+
+        closed = manager.get_connections(INFO_HASH)[0]
+        closed.close()
+        self.run_until(lambda: manager.connection_count == 2)
+
+        self.assertNotIn(closed, manager.get_connections(INFO_HASH))
+        self.assertEqual(budget.usage(), {'receive_buffers': 2000})
+
+        manager.unregister(INFO_HASH)
+        self.assertEqual(budget.used, 0)
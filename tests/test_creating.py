@@ -0,0 +1,76 @@
+import hashlib
+import os
+import shutil
+import unittest
+
+from pyrrent.bencoding import decode
+from pyrrent.creating import create_metafile, choose_piece_length, MIN_PIECE_LENGTH, MAX_PIECE_LENGTH
+from pyrrent.metafile import Metafile, MetafileError
+
+
+class CreateMetafileTests(unittest.TestCase):
+    TEST_PATH = '/tmp/pyrrent/tests/creating'
+
+
+    def setUp(self):
+        if os.path.exists(self.TEST_PATH):
+            shutil.rmtree(self.TEST_PATH)
+        os.makedirs(os.path.join(self.TEST_PATH, 'content/dir1'))
+        self.file_contents = [
+            ('content/dir1/file1', b'\x01' * 40000),
+            ('content/dir1/file2', b''),
+            ('content/file3', b'\x03' * 10000),
+            ('content/file4', b'\x04' * 30000),
+        ]
+        for path, content in self.file_contents:
+            with open(os.path.join(self.TEST_PATH, path), 'wb') as f:
+                f.write(content)
+
+    def test_create_multi_file(self):
+        content_path = os.path.join(self.TEST_PATH, 'content')
+        encoded = create_metafile(content_path, 'http://tracker/announce', piece_length=2 ** 14, workers=2)
+
+        metafile = Metafile.parse(encoded)
+
+        self.assertEqual(metafile.announce_url, 'http://tracker/announce')
+        self.assertEqual([(f.path, f.length) for f in metafile.files],
+                         [(path, len(content)) for path, content in self.file_contents])
+
+        all_content = b''.join(content for _, content in self.file_contents)
+        expected_hashes = [hashlib.sha1(all_content[i:i + 2 ** 14]).digest()
+                           for i in range(0, len(all_content), 2 ** 14)]
+        self.assertEqual([piece.hash for piece in metafile.pieces], expected_hashes)
+        self.assertEqual(metafile.pieces[-1].length, len(all_content) % 2 ** 14)
+
+    def test_create_single_file(self):
+        file_path = os.path.join(self.TEST_PATH, 'content/file4')
+        encoded = create_metafile(file_path, 'http://tracker/announce', piece_length=2 ** 14)
+
+        metafile = Metafile.parse(encoded)
+
+        self.assertEqual(len(metafile.files), 1)
+        self.assertEqual(metafile.files[0].path, 'file4')
+        self.assertEqual(metafile.files[0].length, 30000)
+        self.assertEqual(metafile.pieces[0].hash, hashlib.sha1(b'\x04' * 2 ** 14).digest())
+
+    def test_non_ascii_name_and_comment(self):
+        file_path = os.path.join(self.TEST_PATH, 'content/file4')
+        encoded = create_metafile(file_path, 'http://tracker/announce', name='fïle', comment='héllo')
+
+        decoded = decode(encoded)
+
+        self.assertEqual(decoded['comment'], 'héllo'.encode('utf-8'))
+        self.assertEqual(decoded['info']['name'], 'fïle'.encode('utf-8'))
+        self.assertEqual(Metafile.parse(encoded).files[0].path, 'fïle')
+
+    def test_invalid_input(self):
+        with self.assertRaises(MetafileError):
+            create_metafile(os.path.join(self.TEST_PATH, 'missing'), 'http://tracker/announce')
+
+        with self.assertRaises(MetafileError):
+            create_metafile(os.path.join(self.TEST_PATH, 'content'), 'http://tracker/announce', piece_length=1000)
+
+    def test_choose_piece_length(self):
+        self.assertEqual(choose_piece_length(1), MIN_PIECE_LENGTH)
+        self.assertEqual(choose_piece_length(2 ** 40), MAX_PIECE_LENGTH)
+        self.assertEqual(choose_piece_length(1500 * 2 ** 20), 2 ** 20)
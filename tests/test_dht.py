@@ -0,0 +1,234 @@
+import asyncio
+import os
+import shutil
+import time
+import unittest
+
+from pyrrent.dht import (RoutingTable, DHTNode, DHTAnnouncer, DHTError, decode_compact_nodes,
+                         encode_compact_nodes)
+from tests.stubs.coordinator import PeerCoordinatorStub
+from tests.stubs.download_info import DownloadInfoStub
+
+
+class CompactNodesTests(unittest.TestCase):
+    def test_encode_and_decode(self):
+        table = RoutingTable(0)
+        table.add(1, ('127.0.0.1', 6881))
+        table.add(2 ** 159, ('10.0.0.1', 80))
+
+        encoded = encode_compact_nodes(table.get_nodes())
+        decoded = [(node.id, node.address) for node in decode_compact_nodes(encoded)]
+
+        self.assertEqual(len(encoded), 52)
+        self.assertEqual(decoded, [(1, ('127.0.0.1', 6881)), (2 ** 159, ('10.0.0.1', 80))])
+
+    def test_decode_invalid(self):
+        with self.assertRaises(DHTError):
+            decode_compact_nodes(b'\x00' * 25)
+
+
+class RoutingTableTests(unittest.TestCase):
+    def test_nodes_go_to_bucket_by_distance(self):
+        table = RoutingTable(0, k=2)
+
+        self.assertTrue(table.add(4, ('127.0.0.1', 1)))
+        self.assertTrue(table.add(5, ('127.0.0.1', 2)))
+        # Same bucket as 4 and 5, which is full of responsive nodes
+        self.assertFalse(table.add(6, ('127.0.0.1', 3)))
+        self.assertTrue(table.add(1, ('127.0.0.1', 4)))
+        self.assertFalse(table.add(0, ('127.0.0.1', 5)))
+
+        self.assertEqual(len(table), 3)
+        self.assertIn(5, table)
+        self.assertNotIn(6, table)
+
+    def test_failed_node_is_replaced_in_full_bucket(self):
+        table = RoutingTable(0, k=2, max_failures=2)
+        table.add(4, ('127.0.0.1', 1))
+        table.add(5, ('127.0.0.1', 2))
+
+        table.node_failed(5)
+        self.assertIn(5, table)
+        self.assertTrue(table.add(6, ('127.0.0.1', 3)))
+
+        self.assertNotIn(5, table)
+        self.assertIn(6, table)
+        self.assertEqual(len(table), 2)
+
+    def test_node_removed_after_max_failures(self):
+        table = RoutingTable(0, max_failures=2)
+        table.add(4, ('127.0.0.1', 1))
+
+        table.node_failed(4)
+        table.node_failed(4)
+
+        self.assertNotIn(4, table)
+        self.assertEqual(len(table), 0)
+
+    def test_closest(self):
+        table = RoutingTable(0)
+        for node_id in range(1, 20):
+            table.add(node_id, ('127.0.0.1', node_id))
+
+        closest = table.closest(12, 3)
+
+        self.assertEqual([node.id for node in closest], [12, 13, 14])
+
+    def test_random_id_in_bucket(self):
+        table = RoutingTable(1000)
+
+        for bucket_index in (0, 10, 159):
+            node_id = table.get_random_id_in_bucket(bucket_index)
+            self.assertEqual((node_id ^ 1000).bit_length() - 1, bucket_index)
+
+    def test_stale_buckets(self):
+        table = RoutingTable(0)
+        table.add(4, ('127.0.0.1', 1))
+        table._bucket_updated[2] = time.monotonic() - 100
+
+        self.assertEqual(table.get_stale_buckets(50), [2])
+        self.assertEqual(table.get_stale_buckets(200), [])
+
+    def test_save_and_load(self):
+        path = '/tmp/pyrrent/tests/dht/table'
+        if os.path.exists(os.path.dirname(path)):
+            shutil.rmtree(os.path.dirname(path))
+        os.makedirs(os.path.dirname(path))
+
+        table = RoutingTable(12345)
+        table.add(1, ('127.0.0.1', 6881))
+        table.add(2 ** 100, ('10.0.0.1', 80))
+        table.save(path)
+
+        loaded = RoutingTable.load(path)
+
+        self.assertEqual(loaded.node_id, 12345)
+        self.assertEqual(sorted((node.id, node.address) for node in loaded.get_nodes()),
+                         [(1, ('127.0.0.1', 6881)), (2 ** 100, ('10.0.0.1', 80))])
+
+        with open(path, 'wb') as f:
+            f.write(b'garbage')
+        with self.assertRaises(DHTError):
+            RoutingTable.load(path)
+
+
+class DHTSwarmTests(unittest.TestCase):
+    SWARM_SIZE = 30
+
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.nodes = []
+
+    def tearDown(self):
+        for node in self.nodes:
+            node.stop()
+
+    def start_swarm(self, size, **kwargs):
+        async def start():
+            first = DHTNode(query_timeout=0.5, loop=self.loop, **kwargs)
+            await first.start('127.0.0.1', 0)
+            self.nodes.append(first)
+
+            for _ in range(size - 1):
+                node = DHTNode(query_timeout=0.5, loop=self.loop, **kwargs)
+                await node.start('127.0.0.1', 0, bootstrap=[first.address])
+                self.nodes.append(node)
+
+        self.loop.run_until_complete(start())
+
+    def test_nodes_learn_each_other_on_bootstrap(self):
+        self.start_swarm(self.SWARM_SIZE)
+
+        for node in self.nodes:
+            self.assertGreater(len(node.routing_table), 0)
+        self.assertGreaterEqual(len(self.nodes[-1].routing_table), 8)
+
+    def test_announced_peer_is_found(self):
+        self.start_swarm(self.SWARM_SIZE)
+        info_hash = b'\x42' * 20
+
+        self.loop.run_until_complete(self.nodes[3].announce_peer(info_hash, 6881))
+        peers = self.loop.run_until_complete(self.nodes[-1].get_peers(info_hash))
+
+        self.assertEqual(peers, [('127.0.0.1', 6881)])
+
+    def test_get_peers_of_unknown_torrent(self):
+        self.start_swarm(5)
+
+        peers = self.loop.run_until_complete(self.nodes[-1].get_peers(b'\x01' * 20))
+
+        self.assertEqual(peers, [])
+
+    def test_announce_with_invalid_token_is_rejected(self):
+        self.start_swarm(2)
+        query = self.nodes[1]._query(self.nodes[0].address, b'announce_peer',
+                                     {'info_hash': b'\x42' * 20, 'port': 6881, 'token': b'bad'})
+
+        with self.assertRaises(DHTError):
+            self.loop.run_until_complete(query)
+
+        self.assertEqual(self.nodes[0]._stored_peers, {})
+
+    def test_unresponsive_nodes_are_dropped_from_routing_table(self):
+        self.start_swarm(3)
+        node = self.nodes[0]
+        dead_id = int.from_bytes(self.nodes[2].node_id, 'big')
+        self.nodes[2].stop()
+
+        for _ in range(2):
+            self.loop.run_until_complete(node.get_peers(b'\x01' * 20))
+
+        self.assertNotIn(dead_id, node.routing_table)
+
+    def test_invalid_datagrams_are_ignored(self):
+        self.start_swarm(2)
+        node = self.nodes[0]
+
+        for data in (b'', b'garbage', b'd1:t2:aae', b'd1:q4:ping1:t2:aa1:y1:qe'):
+            node._datagram_received(data, ('127.0.0.1', 1))
+
+        ping = self.nodes[1]._query(node.address, b'ping', {})
+        response = self.loop.run_until_complete(ping)
+        self.assertEqual(response['id'], node.node_id)
+
+    def test_routing_table_is_persisted(self):
+        path = '/tmp/pyrrent/tests/dht/state'
+        if os.path.exists(os.path.dirname(path)):
+            shutil.rmtree(os.path.dirname(path))
+        os.makedirs(os.path.dirname(path))
+
+        self.start_swarm(5)
+        node = DHTNode(state_path=path, loop=self.loop)
+        self.loop.run_until_complete(node.start('127.0.0.1', 0, bootstrap=[self.nodes[0].address]))
+        known_count = len(node.routing_table)
+        node.stop()
+
+        restarted = DHTNode(state_path=path, loop=self.loop)
+        self.loop.run_until_complete(restarted.start('127.0.0.1', 0))
+        self.nodes.append(restarted)
+
+        self.assertEqual(restarted.node_id, node.node_id)
+        self.assertGreaterEqual(len(restarted.routing_table), known_count)
+
+    def test_announcer_reports_peers_to_coordinator(self):
+        self.start_swarm(5)
+        info_hash = b'\x42' * 20
+        self.loop.run_until_complete(self.nodes[1].announce_peer(info_hash, 7000))
+
+        download_info = DownloadInfoStub(b'x' * 20, info_hash, 6881, 0, 0, 0)
+        coordinator = PeerCoordinatorStub()
+        announcer = DHTAnnouncer(self.nodes[-1], download_info, coordinator, loop=self.loop)
+
+        async def announce_once():
+            task = self.loop.create_task(announcer.announcing())
+            while not coordinator.announce_results:
+                await asyncio.sleep(0.01)
+            announcer.stop()
+            await task
+
+        self.loop.run_until_complete(asyncio.wait_for(announce_once(), 5))
+
+        self.assertEqual(coordinator.announce_results[0].peers, [('127.0.0.1', 7000)])
+        peers = self.loop.run_until_complete(self.nodes[0].get_peers(info_hash))
+        self.assertEqual(sorted(peers), [('127.0.0.1', 6881), ('127.0.0.1', 7000)])
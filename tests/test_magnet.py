@@ -0,0 +1,165 @@
+import asyncio
+import base64
+import hashlib
+import os
+import shutil
+import unittest
+
+from pyrrent.bencoding import encode
+from pyrrent.magnet import MagnetLink, MetadataCache, MetadataFetcher, MagnetError, resolve_magnet
+from pyrrent.utils import MemoryBudget
+from tests.stubs.metadata_peer import MetadataPeerStub
+
+
+def _encoded_info(piece_count=3):
+    # Pieces field alone takes the info dictionary over several metadata pieces
+    return encode({
+        'length': 100 * piece_count * 1000,
+        'name': 'file',
+        'piece length': 100,
+        'pieces': os.urandom(20 * piece_count * 1000),
+    })
+
+
+class MagnetLinkTests(unittest.TestCase):
+    def test_parse(self):
+        info_hash = bytes(range(20))
+        uri = (f'magnet:?xt=urn:btih:{info_hash.hex()}&dn=some+file'
+               f'&tr=http%3A%2F%2Ftracker.example%2Fannounce&tr=http%3A%2F%2Fbackup.example%2Fannounce'
+               f'&x.pe=10.0.0.1:6881&x.pe=[::1]:51413')
+
+        magnet = MagnetLink.parse(uri)
+
+        self.assertEqual(magnet.info_hash, info_hash)
+        self.assertEqual(magnet.name, 'some file')
+        self.assertEqual(magnet.trackers, ['http://tracker.example/announce', 'http://backup.example/announce'])
+        self.assertEqual(magnet.peers, [('10.0.0.1', 6881), ('::1', 51413)])
+
+    def test_parse_base32_info_hash(self):
+        info_hash = bytes(range(20))
+        encoded = base64.b32encode(info_hash).decode().lower()
+
+        magnet = MagnetLink.parse(f'magnet:?xt=urn:btih:{encoded}')
+
+        self.assertEqual(magnet.info_hash, info_hash)
+        self.assertEqual(magnet.trackers, [])
+
+    def test_parse_invalid(self):
+        invalid_uris = [
+            'http://example.com',
+            'magnet:?dn=name',
+            'magnet:?xt=urn:btih:1234',
+            'magnet:?xt=urn:btih:' + 'z' * 40,
+            'magnet:?xt=urn:btih:' + '0' * 40 + '&x.pe=10.0.0.1',
+        ]
+
+        for uri in invalid_uris:
+            with self.assertRaises(MagnetError):
+                MagnetLink.parse(uri)
+
+
+class MetadataCacheTests(unittest.TestCase):
+    TEST_PATH = '/tmp/pyrrent/tests/metadata_cache'
+
+
+    def setUp(self):
+        if os.path.exists(self.TEST_PATH):
+            shutil.rmtree(self.TEST_PATH)
+
+    def test_cache_survives_restart(self):
+        encoded_info = _encoded_info(1)
+        info_hash = hashlib.sha1(encoded_info).digest()
+
+        MetadataCache(self.TEST_PATH).put(info_hash, encoded_info)
+        cache = MetadataCache(self.TEST_PATH)
+
+        self.assertEqual(cache.get(info_hash), encoded_info)
+        self.assertIsNone(cache.get(b'\x00' * 20))
+
+    def test_corrupted_entry_is_ignored(self):
+        encoded_info = _encoded_info(1)
+        info_hash = hashlib.sha1(encoded_info).digest()
+        MetadataCache(self.TEST_PATH).put(info_hash, encoded_info)
+
+        with open(os.path.join(self.TEST_PATH, f'{info_hash.hex()}.info'), 'wb') as f:
+            f.write(b'garbage')
+
+        self.assertIsNone(MetadataCache(self.TEST_PATH).get(info_hash))
+
+
+class MetadataFetcherTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.encoded_info = _encoded_info()
+        self.info_hash = hashlib.sha1(self.encoded_info).digest()
+        self.peers = []
+
+    def tearDown(self):
+        for peer in self.peers:
+            peer.stop()
+
+    def start_peer(self, **kwargs):
+        peer = MetadataPeerStub(self.info_hash, self.encoded_info, **kwargs)
+        self.loop.run_until_complete(peer.start())
+        self.peers.append(peer)
+        return peer
+
+    def fetch(self, addresses, memory_budget=None):
+        fetcher = MetadataFetcher(self.info_hash, b'p' * 20, request_timeout=2, memory_budget=memory_budget,
+                                  loop=self.loop)
+        return self.loop.run_until_complete(fetcher.fetch(addresses))
+
+    def test_fetch_spreads_pieces_across_peers(self):
+        peer_1 = self.start_peer()
+        peer_2 = self.start_peer()
+
+        encoded_info = self.fetch([peer_1.address, peer_2.address])
+
+        self.assertEqual(encoded_info, self.encoded_info)
+        self.assertGreater(len(self.encoded_info), 2 * 16384)
+        self.assertTrue(peer_1.requested_pieces)
+        self.assertTrue(peer_2.requested_pieces)
+
+    def test_fetch_skips_bad_peers(self):
+        peers = [self.start_peer(extensions=False), self.start_peer(reject=True), self.start_peer()]
+
+        encoded_info = self.fetch([('127.0.0.1', 1)] + [peer.address for peer in peers])
+
+        self.assertEqual(encoded_info, self.encoded_info)
+
+    def test_fetch_recovers_from_corrupt_peer(self):
+        corrupt_peer = self.start_peer(corrupt=True)
+
+        with self.assertRaises(MagnetError):
+            self.fetch([corrupt_peer.address])
+
+        good_peer = self.start_peer()
+        encoded_info = self.fetch([corrupt_peer.address, good_peer.address])
+
+        self.assertEqual(encoded_info, self.encoded_info)
+
+    def test_fetch_accounts_assembly_memory(self):
+        corrupt_peer = self.start_peer(corrupt=True)
+        good_peer = self.start_peer()
+        budget = MemoryBudget(2 ** 20, loop=self.loop)
+
+        encoded_info = self.fetch([corrupt_peer.address, good_peer.address], memory_budget=budget)
+        # Cancelled peer tasks give their copies back once they finish
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+
+        self.assertEqual(encoded_info, self.encoded_info)
+        self.assertEqual(budget.used, 0)
+
+    def test_resolve_magnet_uses_cache(self):
+        peer = self.start_peer()
+        magnet = MagnetLink(self.info_hash, trackers=['http://tracker.example/announce'], peers=[peer.address])
+        cache = MetadataCache()
+
+        metafile = self.loop.run_until_complete(resolve_magnet(magnet, b'p' * 20, cache, loop=self.loop))
+        peer.stop()
+        cached_metafile = self.loop.run_until_complete(resolve_magnet(magnet, b'p' * 20, cache, loop=self.loop))
+
+        for result in (metafile, cached_metafile):
+            self.assertEqual(result.info_hash, self.info_hash)
+            self.assertEqual(result.announce_url, 'http://tracker.example/announce')
+            self.assertEqual(len(result.pieces), 3000)
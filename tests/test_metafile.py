@@ -1,6 +1,6 @@
 import unittest
 
-from pyrrent.metafile import Metafile
+from pyrrent.metafile import Metafile, MetafileError
 
 _TEST_PIECES_HASH = b'\x00' * 20 + b'\x01' * 20
 _TEST_ENCODED_METAFILE = (
@@ -28,4 +28,19 @@ class MetafileTests(unittest.TestCase):
         self.assertEqual(metafile.files[0].length, 120)
         self.assertEqual(metafile.files[0].path, 'base/dir1/file1')
         self.assertEqual(metafile.files[1].length, 50)
-        self.assertEqual(metafile.files[1].path, 'base/file2')
\ No newline at end of file
+        self.assertEqual(metafile.files[1].path, 'base/file2')
+
+    def test_from_info(self):
+        info_index = _TEST_ENCODED_METAFILE.find(b'4:info') + 6
+        encoded_info = _TEST_ENCODED_METAFILE[info_index:-1]
+
+        metafile = Metafile.from_info(encoded_info)
+
+        self.assertEqual(metafile.info_hash, Metafile.parse(_TEST_ENCODED_METAFILE).info_hash)
+        self.assertIsNone(metafile.announce_url)
+        self.assertEqual(len(metafile.pieces), 2)
+        self.assertEqual(metafile.pieces[1].length, 70)
+        self.assertEqual(metafile.files[1].path, 'base/file2')
+
+        with self.assertRaises(MetafileError):
+            Metafile.from_info(b'i1e')
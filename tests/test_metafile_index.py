@@ -0,0 +1,120 @@
+import os
+import shutil
+import unittest
+
+from pyrrent.metafile import Metafile
+from pyrrent.metafile_index import MetafileIndex, MetafileIndexError
+
+from tests.test_metafile import _TEST_ENCODED_METAFILE
+
+
+class MetafileIndexTests(unittest.TestCase):
+    TEST_PATH = '/tmp/pyrrent/tests/metafile_index'
+
+
+    def setUp(self):
+        if os.path.exists(self.TEST_PATH):
+            shutil.rmtree(self.TEST_PATH)
+        os.makedirs(self.TEST_PATH)
+        self.metafile_path = os.path.join(self.TEST_PATH, 'test.torrent')
+        with open(self.metafile_path, 'wb') as f:
+            f.write(_TEST_ENCODED_METAFILE)
+        self.index_path = os.path.join(self.TEST_PATH, 'index')
+
+    def assertMetafileEqual(self, metafile, expected):
+        self.assertEqual(metafile.info_hash, expected.info_hash)
+        self.assertEqual(metafile.announce_url, expected.announce_url)
+        self.assertEqual(len(metafile.pieces), len(expected.pieces))
+        for piece, expected_piece in zip(metafile.pieces, expected.pieces):
+            self.assertEqual(piece.index, expected_piece.index)
+            self.assertEqual(piece.hash, expected_piece.hash)
+            self.assertEqual(piece.length, expected_piece.length)
+        self.assertEqual([(f.path, f.length) for f in metafile.files],
+                         [(f.path, f.length) for f in expected.files])
+
+    def test_load_from_persisted_index(self):
+        index = MetafileIndex.open(self.index_path)
+        parsed = index.load(self.metafile_path)
+        index.close()
+
+        index = MetafileIndex.open(self.index_path)
+        self.assertEqual(len(index), 1)
+        indexed = index.load(self.metafile_path)
+
+        self.assertNotIsInstance(indexed.pieces, list)
+        self.assertMetafileEqual(indexed, parsed)
+        self.assertEqual(indexed.pieces[-1].hash, b'\x01' * 20)
+        index.close()
+
+    def test_changed_metafile_is_reparsed(self):
+        index = MetafileIndex.open(self.index_path)
+        index.load(self.metafile_path)
+        index.close()
+
+        changed_content = _TEST_ENCODED_METAFILE.replace(b'www.test-url.com', b'www.test-url.org')
+        with open(self.metafile_path, 'wb') as f:
+            f.write(changed_content)
+        os.utime(self.metafile_path, ns=(0, 0))
+
+        index = MetafileIndex.open(self.index_path)
+        metafile = index.load(self.metafile_path)
+        self.assertEqual(metafile.announce_url, 'http://www.test-url.org')
+        index.close()
+
+    def test_invalid_index_is_discarded(self):
+        os.makedirs(self.index_path)
+        with open(os.path.join(self.index_path, 'index'), 'wb') as f:
+            f.write(b'garbage')
+
+        index = MetafileIndex.open(self.index_path)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.load(self.metafile_path).announce_url, 'http://www.test-url.com')
+        index.close()
+
+    def test_truncated_hashes_fall_back_to_parsing(self):
+        index = MetafileIndex.open(self.index_path)
+        parsed = index.load(self.metafile_path)
+        index.close()
+
+        hashes_path, = [os.path.join(self.index_path, name) for name in os.listdir(self.index_path)
+                        if name.startswith('hashes')]
+        with open(hashes_path, 'r+b') as f:
+            f.truncate(10)
+
+        index = MetafileIndex.open(self.index_path)
+        metafile = index.load(self.metafile_path)
+
+        self.assertIsInstance(metafile.pieces, list)
+        self.assertMetafileEqual(metafile, parsed)
+        index.close()
+
+    def test_hashes_are_compacted_on_save(self):
+        paths = []
+        for i in range(4):
+            path = os.path.join(self.TEST_PATH, f'test_{i}.torrent')
+            shutil.copy(self.metafile_path, path)
+            paths.append(path)
+
+        index = MetafileIndex.open(self.index_path)
+        for path in paths:
+            index.load(path)
+        index.save()
+        kept = index.load(paths[0])
+        dropped = index.load(paths[1])
+        for path in paths[1:]:
+            index.remove(path)
+        index.close()
+
+        hashes_files = [name for name in os.listdir(self.index_path) if name.startswith('hashes')]
+        self.assertEqual(len(hashes_files), 1)
+        self.assertEqual(os.path.getsize(os.path.join(self.index_path, hashes_files[0])),
+                         len(kept.pieces) * 20)
+
+        index = MetafileIndex.open(self.index_path)
+        self.assertEqual(len(index), 1)
+        self.assertMetafileEqual(index.load(paths[0]), Metafile.parse(_TEST_ENCODED_METAFILE))
+        index.close()
+
+        # Metafiles from dropped entries fail loudly instead of reading other torrents' hashes
+        with self.assertRaises(MetafileIndexError):
+            dropped.pieces[0]
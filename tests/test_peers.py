@@ -0,0 +1,88 @@
+import time
+import unittest
+
+from pyrrent.peers import (decode_compact_peers, decode_compact_peers6, decode_dict_peers, encode_compact_peers,
+                           PeerStore, PeerError)
+
+
+class PeerDecodingTests(unittest.TestCase):
+    def test_decode_compact_peers(self):
+        inputs = [b'', b'\x01\x02\x03\x04\x05\x06', b'\x7f\x00\x00\x01\x1a\xe1\xc0\xa8\x00\x01\x00\x50']
+        expected_outputs = [[], [('1.2.3.4', 1286)], [('127.0.0.1', 6881), ('192.168.0.1', 80)]]
+
+        for i, input in enumerate(inputs):
+            self.assertEqual(decode_compact_peers(input), expected_outputs[i])
+
+        with self.assertRaises(PeerError):
+            decode_compact_peers(b'\x01\x02\x03\x04\x05')
+
+    def test_encode_compact_peers(self):
+        peers = [('127.0.0.1', 6881), ('::1', 80), ('192.168.0.1', 80)]
+
+        self.assertEqual(encode_compact_peers(peers), b'\x7f\x00\x00\x01\x1a\xe1\xc0\xa8\x00\x01\x00\x50')
+
+    def test_decode_compact_peers6(self):
+        data = b'\x00' * 15 + b'\x01' + b'\x1a\xe1'
+
+        self.assertEqual(decode_compact_peers6(data), [('::1', 6881)])
+
+        with self.assertRaises(PeerError):
+            decode_compact_peers6(data[:-1])
+
+    def test_decode_dict_peers(self):
+        peer_dicts = [
+            {'peer id': b'x' * 20, 'ip': b'10.0.0.1', 'port': 6881},
+            {'ip': b'example.com', 'port': 80},
+        ]
+
+        self.assertEqual(decode_dict_peers(peer_dicts), [('10.0.0.1', 6881), ('example.com', 80)])
+
+        invalid_inputs = [
+            [{'ip': b'10.0.0.1'}],
+            [{'ip': b'10.0.0.1', 'port': 0}],
+            [{'ip': 1, 'port': 80}],
+            [b'10.0.0.1'],
+        ]
+
+        for invalid_input in invalid_inputs:
+            with self.assertRaises(PeerError):
+                decode_dict_peers(invalid_input)
+
+
+class PeerStoreTests(unittest.TestCase):
+    def test_add_deduplicates(self):
+        store = PeerStore()
+
+        self.assertEqual(store.add([('1.2.3.4', 1), ('1.2.3.4', 2)], source='tracker1'), 2)
+        self.assertEqual(store.add([('1.2.3.4', 1), ('5.6.7.8', 1)], source='tracker2'), 1)
+
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.get_sources(('1.2.3.4', 1)), {'tracker1', 'tracker2'})
+
+    def test_connect_failure_backoff(self):
+        store = PeerStore(base_backoff=1000, max_failures=2)
+        peer_1 = ('1.2.3.4', 1)
+        peer_2 = ('5.6.7.8', 1)
+        store.add([peer_1, peer_2])
+
+        store.connect_failed(peer_1)
+        self.assertEqual(store.get_connectable(10), [peer_2])
+        self.assertEqual(store.get_connectable(10, exclude={peer_2}), [])
+
+        store.connect_succeeded(peer_1)
+        self.assertEqual(store.get_connectable(10), [peer_1, peer_2])
+
+        store.connect_failed(peer_2)
+        store.connect_failed(peer_2)
+        self.assertNotIn(peer_2, store)
+
+    def test_backoff_expires(self):
+        store = PeerStore(base_backoff=0.01)
+        peer = ('1.2.3.4', 1)
+        store.add([peer])
+
+        store.connect_failed(peer)
+        self.assertEqual(store.get_connectable(1), [])
+
+        time.sleep(0.02)
+        self.assertEqual(store.get_connectable(1), [peer])
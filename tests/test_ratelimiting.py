@@ -0,0 +1,92 @@
+import asyncio
+import unittest
+
+from pyrrent.ratelimiting import BandwidthLimiter, RateLimitError
+
+
+class BandwidthLimiterTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.limiter = BandwidthLimiter(rate=10000, burst=0.1, tick=0.01)
+
+    def tearDown(self):
+        self.limiter.stop()
+
+    def test_consume_within_burst_does_not_wait(self):
+        bucket = self.limiter.create_bucket()
+
+        self.assertTrue(bucket.try_consume(1000))
+        self.assertFalse(bucket.try_consume(1))
+
+    def test_consume_waits_for_refill(self):
+        bucket = self.limiter.create_bucket()
+        bucket.try_consume(1000)
+        self.limiter.start()
+
+        start = self.loop.time()
+        self.loop.run_until_complete(bucket.consume(500))
+
+        self.assertGreaterEqual(self.loop.time() - start, 0.005)
+
+    def test_consume_without_start_does_not_hang(self):
+        bucket = self.limiter.create_bucket()
+        bucket.try_consume(1000)
+
+        self.loop.run_until_complete(asyncio.wait_for(bucket.consume(500), 1))
+
+    def test_stop_releases_waiters(self):
+        bucket = self.limiter.create_bucket(rate=1, burst=1)
+        bucket.try_consume(1)
+
+        async def run():
+            waiter = self.loop.create_task(bucket.consume(1))
+            await asyncio.sleep(0.01)
+            self.assertFalse(waiter.done())
+
+            self.limiter.stop()
+            await asyncio.wait_for(waiter, 1)
+
+        self.loop.run_until_complete(run())
+
+    def test_child_limit(self):
+        torrent_bucket = self.limiter.create_bucket(rate=1000, burst=0.1)
+
+        self.assertTrue(torrent_bucket.try_consume(100))
+        self.assertFalse(torrent_bucket.try_consume(100))
+        self.assertTrue(self.limiter.root.try_consume(100))
+
+    def test_parent_limit_applies_to_children(self):
+        peer_bucket = self.limiter.create_bucket().create_child()
+
+        self.assertTrue(peer_bucket.try_consume(1000))
+        self.assertFalse(peer_bucket.try_consume(1))
+
+    def test_fair_sharing_between_children(self):
+        bucket_1 = self.limiter.create_bucket()
+        bucket_2 = self.limiter.create_bucket()
+        bucket_1.try_consume(1000)
+        granted = []
+
+        async def transfer(bucket, name):
+            await bucket.consume(100)
+            granted.append(name)
+
+        tasks = [transfer(bucket_1, 1) for _ in range(3)] + [transfer(bucket_2, 2) for _ in range(3)]
+        self.limiter.start()
+        self.loop.run_until_complete(asyncio.gather(*tasks))
+
+        self.assertEqual(granted, [1, 2, 1, 2, 1, 2])
+
+    def test_live_rate_change(self):
+        bucket = self.limiter.create_bucket()
+        bucket.try_consume(1000)
+        self.limiter.root.rate = None
+
+        self.assertTrue(bucket.try_consume(10 ** 9))
+
+        self.limiter.root.rate = 100
+        self.assertTrue(bucket.try_consume(10))
+        self.assertFalse(bucket.try_consume(10))
+
+        with self.assertRaises(RateLimitError):
+            bucket.rate = 0
@@ -0,0 +1,127 @@
+import asyncio
+import unittest
+
+from pyrrent.bencoding import encode
+from pyrrent.scraping import HTTPScraper, ScrapeResult, ScraperError, get_scrape_url
+
+
+_INFO_HASH_1 = b'\xff' * 20
+_INFO_HASH_2 = b'\x01' * 20
+
+
+class ScrapeUrlTests(unittest.TestCase):
+    def test_get_scrape_url(self):
+        inputs = [
+            'http://example.com/announce',
+            'http://example.com/x/announce',
+            'http://example.com/announce.php',
+            'http://example.com/announce?x2%0644',
+        ]
+        expected_outputs = [
+            'http://example.com/scrape',
+            'http://example.com/x/scrape',
+            'http://example.com/scrape.php',
+            'http://example.com/scrape?x2%0644',
+        ]
+
+        for i, input in enumerate(inputs):
+            self.assertEqual(get_scrape_url(input), expected_outputs[i])
+
+    def test_get_scrape_url_unsupported(self):
+        invalid_inputs = [
+            'http://example.com/a',
+            'http://example.com/announce/x',
+            'http://example.com/x%064announce',
+        ]
+
+        for invalid_input in invalid_inputs:
+            with self.assertRaises(ScraperError):
+                get_scrape_url(invalid_input)
+
+
+class HTTPScraperTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.scraper = HTTPScraper('http://127.0.0.1/announce', cache_ttl=60, batch_size=1)
+
+    def test_parse_scrape_response(self):
+        response = encode({
+            'files': {
+                _INFO_HASH_1: {'complete': 5, 'downloaded': 50, 'incomplete': 10},
+                _INFO_HASH_2: {'complete': 1, 'downloaded': 2, 'incomplete': 3},
+            },
+            'flags': {'min_request_interval': 900},
+        })
+
+        results, ttl = self.scraper._parse_scrape_response(response)
+
+        self.assertEqual(ttl, 900)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[_INFO_HASH_1].complete, 5)
+        self.assertEqual(results[_INFO_HASH_1].downloaded, 50)
+        self.assertEqual(results[_INFO_HASH_1].incomplete, 10)
+        self.assertEqual(results[_INFO_HASH_2].complete, 1)
+
+    def test_parse_invalid_scrape_response(self):
+        invalid_responses = [
+            encode([]),
+            encode({'failure reason': 'nope'}),
+            encode({'files': {_INFO_HASH_1: {'complete': 5}}}),
+            encode({'files': {_INFO_HASH_1: {'complete': 5, 'downloaded': b'x', 'incomplete': 1}}}),
+        ]
+
+        for invalid_response in invalid_responses:
+            with self.assertRaises(ScraperError):
+                self.scraper._parse_scrape_response(invalid_response)
+
+    def test_scrape_batches_and_caches(self):
+        requested_batches = []
+
+        async def scrape_stub(info_hashes):
+            requested_batches.append(info_hashes)
+            return {info_hash: ScrapeResult(1, 2, 3) for info_hash in info_hashes}, 60
+
+        self.scraper._scrape = scrape_stub
+
+        results = self.loop.run_until_complete(self.scraper.scrape([_INFO_HASH_1, _INFO_HASH_2]))
+        self.assertEqual(set(results), {_INFO_HASH_1, _INFO_HASH_2})
+        self.assertEqual(requested_batches, [[_INFO_HASH_1], [_INFO_HASH_2]])
+
+        results = self.loop.run_until_complete(self.scraper.scrape([_INFO_HASH_1, _INFO_HASH_2]))
+        self.assertEqual(set(results), {_INFO_HASH_1, _INFO_HASH_2})
+        self.assertEqual(len(requested_batches), 2)
+
+        self.scraper.invalidate(_INFO_HASH_2)
+        self.loop.run_until_complete(self.scraper.scrape([_INFO_HASH_1, _INFO_HASH_2]))
+        self.assertEqual(requested_batches[-1], [_INFO_HASH_2])
+
+    def test_failed_batches_do_not_discard_others(self):
+        requested_batches = []
+
+        async def scrape_stub(info_hashes):
+            requested_batches.append(info_hashes)
+            if info_hashes == [_INFO_HASH_1]:
+                raise ScraperError('Tracker failed')
+            return {}, 60
+
+        self.scraper._scrape = scrape_stub
+
+        # Second batch succeeds, even though tracker did not report its info hash
+        results = self.loop.run_until_complete(self.scraper.scrape([_INFO_HASH_1, _INFO_HASH_2]))
+        self.assertEqual(results, {})
+
+        # Missing info hash is cached, only the failed one is asked for again
+        with self.assertRaises(ScraperError):
+            self.loop.run_until_complete(self.scraper.scrape([_INFO_HASH_1, _INFO_HASH_2]))
+        self.assertEqual(requested_batches, [[_INFO_HASH_1], [_INFO_HASH_2], [_INFO_HASH_1]])
+
+    def test_expired_entries_are_purged(self):
+        async def scrape_stub(info_hashes):
+            return {info_hash: ScrapeResult(1, 2, 3) for info_hash in info_hashes}, -1
+
+        self.scraper._scrape = scrape_stub
+
+        self.loop.run_until_complete(self.scraper.scrape([_INFO_HASH_1]))
+        self.loop.run_until_complete(self.scraper.scrape([_INFO_HASH_2]))
+
+        self.assertEqual(set(self.scraper._cache), {_INFO_HASH_2})
@@ -0,0 +1,56 @@
+import unittest
+
+from pyrrent.metafile import FileInfo
+from pyrrent.selection import FileSelection, FilePriority, SelectionError
+
+
+class FileSelectionTests(unittest.TestCase):
+    def setUp(self):
+        # Pieces:  0: file1          1: file1,file2,file3   2: file3    3: file3,file4
+        self.files = [
+            FileInfo('file1', 13),
+            FileInfo('file2', 5),
+            FileInfo('file3', 15),
+            FileInfo('empty', 0),
+            FileInfo('file4', 5),
+        ]
+        self.selection = FileSelection(self.files, 10, 4)
+
+    def test_all_wanted_by_default(self):
+        self.assertEqual(self.selection.get_wanted_pieces(), [0, 1, 2, 3])
+        self.assertEqual(self.selection.get_wanted_length(), 38)
+
+    def test_file_piece_range(self):
+        self.assertEqual(self.selection.get_file_piece_range(0), (0, 2))
+        self.assertEqual(self.selection.get_file_piece_range(1), (1, 2))
+        self.assertEqual(self.selection.get_file_piece_range(2), (1, 4))
+        self.assertEqual(self.selection.get_file_piece_range(3), (3, 3))
+        self.assertEqual(self.selection.get_file_piece_range(4), (3, 4))
+
+    def test_skipped_files(self):
+        for file_index in (0, 2, 4):
+            self.selection.set_file_priority(file_index, FilePriority.SKIP)
+
+        self.assertEqual(self.selection.get_wanted_pieces(), [1])
+        self.assertFalse(self.selection.is_piece_wanted(0))
+        self.assertFalse(self.selection.is_file_wanted(0))
+        self.assertTrue(self.selection.is_file_wanted(1))
+        self.assertEqual(self.selection.get_wanted_length(), 10)
+
+    def test_boundary_piece_takes_highest_priority(self):
+        self.selection.set_file_priority(2, FilePriority.LOW)
+        self.selection.set_file_priority(4, FilePriority.HIGH)
+
+        self.assertEqual(self.selection.get_piece_priority(1), FilePriority.NORMAL)
+        self.assertEqual(self.selection.get_piece_priority(2), FilePriority.LOW)
+        self.assertEqual(self.selection.get_piece_priority(3), FilePriority.HIGH)
+        self.assertEqual(self.selection.get_wanted_pieces(), [3, 0, 1, 2])
+
+        self.selection.set_file_priority(4, FilePriority.SKIP)
+        self.assertEqual(self.selection.get_piece_priority(3), FilePriority.LOW)
+
+    def test_invalid_priority(self):
+        with self.assertRaises(SelectionError):
+            self.selection.set_file_priority(0, 10)
+        with self.assertRaises(SelectionError):
+            self.selection.set_file_priority(10, FilePriority.LOW)
@@ -0,0 +1,154 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import unittest
+
+from pyrrent.bencoding import encode
+from pyrrent.session import Session, SessionError
+from tests.stubs.metadata_peer import MetadataPeerStub
+
+
+def _encoded_metafile(name):
+    return encode({
+        'announce': 'http://127.0.0.1:1/announce',
+        'info': {
+            'piece length': 100,
+            'pieces': b'\x00' * 40,
+            'name': name,
+            'length': 150,
+        },
+    })
+
+
+class SessionTests(unittest.TestCase):
+    TEST_PATH = '/tmp/pyrrent/tests/session'
+
+
+    def setUp(self):
+        if os.path.exists(self.TEST_PATH):
+            shutil.rmtree(self.TEST_PATH)
+        self.loop = asyncio.get_event_loop()
+        self.session = Session(self.TEST_PATH, worker_count=2)
+        self.loop.run_until_complete(self.session.start())
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.session.close())
+
+    def test_torrents_are_sharded_across_workers(self):
+        info_hash_1 = self.loop.run_until_complete(self.session.add(_encoded_metafile('file1')))
+        info_hash_2 = self.loop.run_until_complete(self.session.add(_encoded_metafile('file2')))
+
+        self.assertNotEqual(self.session._torrent_workers[info_hash_1], self.session._torrent_workers[info_hash_2])
+
+        stats = self.loop.run_until_complete(self.session.stats())
+        self.assertEqual(set(stats['torrents']), {info_hash_1, info_hash_2})
+        self.assertEqual(stats['torrents'][info_hash_1]['left'], 150)
+        self.assertEqual(stats['torrents'][info_hash_1]['state'], 'stopped')
+        self.assertEqual(stats['memory'], {'limit': None, 'used': 0, 'subsystems': {}})
+
+    def test_torrent_lifecycle(self):
+        info_hash = self.loop.run_until_complete(self.session.add(_encoded_metafile('file1')))
+
+        self.loop.run_until_complete(self.session.start_torrent(info_hash))
+        stats = self.loop.run_until_complete(self.session.stats())
+        self.assertEqual(stats['torrents'][info_hash]['state'], 'started')
+        self.assertTrue(os.path.exists(os.path.join(self.TEST_PATH, info_hash.hex(), '.pieces')))
+
+        self.loop.run_until_complete(self.session.pause_torrent(info_hash))
+        stats = self.loop.run_until_complete(self.session.stats())
+        self.assertEqual(stats['torrents'][info_hash]['state'], 'paused')
+
+        self.loop.run_until_complete(self.session.stop_torrent(info_hash))
+        stats = self.loop.run_until_complete(self.session.stats())
+        self.assertEqual(stats['torrents'][info_hash]['state'], 'stopped')
+
+        self.loop.run_until_complete(self.session.remove_torrent(info_hash))
+        stats = self.loop.run_until_complete(self.session.stats())
+        self.assertEqual(stats['torrents'], {})
+
+    def test_add_magnet(self):
+        encoded_info = encode({'length': 150, 'name': 'file1', 'piece length': 100, 'pieces': b'\x00' * 40})
+        info_hash = hashlib.sha1(encoded_info).digest()
+        peer = MetadataPeerStub(info_hash, encoded_info)
+        self.loop.run_until_complete(peer.start())
+        uri = f'magnet:?xt=urn:btih:{info_hash.hex()}'
+
+        try:
+            added_info_hash = self.loop.run_until_complete(self.session.add_magnet(uri, peers=[peer.address]))
+        finally:
+            peer.stop()
+
+        self.assertEqual(added_info_hash, info_hash)
+        stats = self.loop.run_until_complete(self.session.stats())
+        self.assertEqual(stats['torrents'][info_hash]['left'], 150)
+        self.loop.run_until_complete(self.session.start_torrent(info_hash))
+
+        # Cached metadata needs no peers
+        self.loop.run_until_complete(self.session.remove_torrent(info_hash))
+        self.assertEqual(self.loop.run_until_complete(self.session.add_magnet(uri)), info_hash)
+
+        with self.assertRaises(SessionError):
+            self.loop.run_until_complete(self.session.add_magnet(f'magnet:?xt=urn:btih:{"1" * 40}'))
+
+    def test_errors(self):
+        with self.assertRaises(SessionError):
+            self.loop.run_until_complete(self.session.add(b'invalid'))
+        with self.assertRaises(SessionError):
+            self.loop.run_until_complete(asyncio.wait_for(self.session.add(b'd8:announcei1e4:infodee'), 5))
+
+        self.loop.run_until_complete(self.session.add(_encoded_metafile('file1')))
+        with self.assertRaises(SessionError):
+            self.loop.run_until_complete(self.session.add(_encoded_metafile('file1')))
+
+        with self.assertRaises(SessionError):
+            self.loop.run_until_complete(self.session.start_torrent(b'\x00' * 20))
+        with self.assertRaises(SessionError):
+            self.loop.run_until_complete(asyncio.wait_for(self.session._workers[0].request('start'), 5))
+
+
+class SessionDHTTests(unittest.TestCase):
+    TEST_PATH = '/tmp/pyrrent/tests/session_dht'
+
+
+    def setUp(self):
+        if os.path.exists(self.TEST_PATH):
+            shutil.rmtree(self.TEST_PATH)
+        self.loop = asyncio.get_event_loop()
+        self.session = Session(self.TEST_PATH, worker_count=2, dht_port=30710)
+        self.loop.run_until_complete(self.session.start())
+
+    def test_workers_keep_dht_state(self):
+        info_hash = self.loop.run_until_complete(self.session.add(_encoded_metafile('file1')))
+        self.loop.run_until_complete(self.session.start_torrent(info_hash))
+        self.loop.run_until_complete(self.session.close())
+
+        self.assertTrue(os.path.exists(os.path.join(self.TEST_PATH, '.dht-0')))
+        self.assertTrue(os.path.exists(os.path.join(self.TEST_PATH, '.dht-1')))
+
+
+class SessionMemoryTests(unittest.TestCase):
+    TEST_PATH = '/tmp/pyrrent/tests/session_memory'
+
+
+    def setUp(self):
+        if os.path.exists(self.TEST_PATH):
+            shutil.rmtree(self.TEST_PATH)
+        self.loop = asyncio.get_event_loop()
+
+    def test_memory_limit_is_split_across_processes(self):
+        session = Session(self.TEST_PATH, worker_count=2, port=30720, memory_limit=2 ** 26)
+        self.loop.run_until_complete(session.start())
+        try:
+            info_hash = self.loop.run_until_complete(session.add(_encoded_metafile('file1')))
+            self.loop.run_until_complete(session.start_torrent(info_hash))
+            stats = self.loop.run_until_complete(session.stats())
+        finally:
+            self.loop.run_until_complete(session.close())
+
+        self.assertEqual(stats['memory']['limit'], 2 ** 26)
+        self.assertEqual(stats['memory']['used'], sum(stats['memory']['subsystems'].values()))
+
+    def test_memory_limit_too_low(self):
+        with self.assertRaises(SessionError):
+            Session(self.TEST_PATH, worker_count=2, memory_limit=2 ** 20)
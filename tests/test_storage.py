@@ -2,9 +2,13 @@ import asyncio
 import unittest
 import os
 import shutil
+import threading
 
 from pyrrent.storage import Storage, StorageError
 from pyrrent.metafile import FileInfo
+from pyrrent.ratelimiting import BandwidthLimiter
+from pyrrent.selection import FileSelection, FilePriority
+from pyrrent.utils import MemoryBudget
 
 
 class StorageTests(unittest.TestCase):
@@ -57,6 +61,62 @@ class StorageTests(unittest.TestCase):
 
         self.assertEqual(content, piece_data)
 
+    def test_store_piece_leaves_no_temp_files(self):
+        self.loop.run_until_complete(self.storage_handler.store(1, b'test_piece_data'))
+
+        pieces_path = os.path.join(self.TEST_PATH, 'test_download/.pieces')
+        self.assertEqual(os.listdir(pieces_path), ['1.piece'])
+
+    def test_create_handler_removes_unfinished_pieces(self):
+        path = '/tmp/pyrrent/tests/storage/test_download_2/.pieces'
+        os.makedirs(path)
+        with open(os.path.join(path, '1.piece'), 'wb') as f:
+            f.write(b'complete')
+        with open(os.path.join(path, '2.abc123.tmp'), 'wb') as f:
+            f.write(b'trunc')
+
+        handler = self.storage.create_handler_for_download('test_download_2')
+
+        self.assertEqual(os.listdir(path), ['1.piece'])
+        with self.assertRaises(StorageError):
+            self.loop.run_until_complete(handler.retrieve(2))
+
+    def test_synced_stores_are_committed_together(self):
+        handler = self.storage.create_handler_for_download('test_download_2', sync_interval=0.01)
+        commits = []
+        sync_and_rename = handler._sync_and_rename
+
+        def record_commit(paths):
+            commits.append(len(paths))
+            sync_and_rename(paths)
+
+        handler._sync_and_rename = record_commit
+
+        self.loop.run_until_complete(asyncio.gather(*(handler.store(i, bytes([i])) for i in range(10))))
+
+        self.assertEqual(commits, [10])
+        path = os.path.join(self.TEST_PATH, 'test_download_2/.pieces')
+        self.assertEqual(sorted(os.listdir(path)), sorted(f'{i}.piece' for i in range(10)))
+        retrieved = self.loop.run_until_complete(handler.retrieve(3))
+        self.assertEqual(retrieved, bytes([3]))
+
+    def test_close_commits_pending_pieces_and_shuts_pool_down(self):
+        handler = self.storage.create_handler_for_download('test_download_2', sync_interval=60)
+
+        async def store_and_close():
+            store = self.loop.create_task(handler.store(1, b'data'))
+            await asyncio.sleep(0.05)
+            self.storage.remove_handler_for_download('test_download_2')
+            await asyncio.wait_for(store, 1)
+
+        self.loop.run_until_complete(store_and_close())
+
+        path = os.path.join(self.TEST_PATH, 'test_download_2/.pieces')
+        self.assertEqual(os.listdir(path), ['1.piece'])
+        self.assertIsNone(handler._pool)
+        with self.assertRaises(StorageError):
+            self.loop.run_until_complete(handler.retrieve(1))
+
     def test_retrieve_piece(self):
         piece_index = 1000
         piece_content = b'test_piece_data'
@@ -66,6 +126,19 @@ class StorageTests(unittest.TestCase):
 
         self.assertEqual(retrieved_piece_content, piece_content)
 
+    def test_concurrent_store_and_retrieve(self):
+        async def store_and_retrieve_all():
+            await asyncio.gather(*(self.storage_handler.store(i, bytes([i])) for i in range(50)))
+            return await asyncio.gather(*(self.storage_handler.retrieve(i) for i in range(50)))
+
+        retrieved = self.loop.run_until_complete(store_and_retrieve_all())
+
+        self.assertEqual(retrieved, [bytes([i]) for i in range(50)])
+
+    def test_retrieve_missing_piece_raises(self):
+        with self.assertRaises(StorageError):
+            self.loop.run_until_complete(self.storage_handler.retrieve(1000))
+
     def test_retrieve_piece_returns_cached(self):
         # Checks if piece is retrieved from cache by deleting it from file system between 2 reads
         piece_index = 1000
@@ -82,14 +155,50 @@ class StorageTests(unittest.TestCase):
         retrieved_piece_content = self.loop.run_until_complete(self.storage_handler.retrieve(piece_index))
         self.assertEqual(retrieved_piece_content, piece_content)
 
+    def test_memory_budget_accounts_cache_and_stores(self):
+        budget = MemoryBudget(1000, loop=self.loop)
+        handler = self.storage.create_handler_for_download('test_download_2', memory_budget=budget)
+
+        async def store_while_full():
+            budget.allocate('receive_buffers', 900)
+            store = self.loop.create_task(handler.store(0, b'x' * 200))
+            await asyncio.sleep(0.05)
+            self.assertFalse(store.done())
+
+            budget.release('receive_buffers', 900)
+            await store
+
+        self.loop.run_until_complete(store_while_full())
+        self.assertEqual(budget.used, 0)
+
+        self.loop.run_until_complete(handler.retrieve(0))
+        self.assertEqual(budget.usage(), {'piece_cache': 200})
+
+        self.storage.remove_handler_for_download('test_download_2')
+        self.assertEqual(budget.used, 0)
+
+    def test_store_and_retrieve_draw_from_buckets(self):
+        limiter = BandwidthLimiter(rate=1000)
+        read_bucket = limiter.create_bucket(rate=100)
+        write_bucket = limiter.create_bucket(rate=100)
+        handler = self.storage.create_handler_for_download('test_download_limited',
+                                                           read_bucket=read_bucket,
+                                                           write_bucket=write_bucket)
+
+        self.loop.run_until_complete(handler.store(1, b'\x00' * 100))
+        self.assertFalse(write_bucket.try_consume(1))
+
+        self.loop.run_until_complete(handler.retrieve(1))
+        self.assertFalse(read_bucket.try_consume(1))
+
     def test_compose_files(self):
         file_infos = [
-            FileInfo(path='dir1/file1', size=13),
-            FileInfo(path='dir1/file2', size=5),
-            FileInfo(path='dir1/file3', size=6),
-            FileInfo(path='file4', size=20),
-            FileInfo(path='dir2/file5', size=6),
-            FileInfo(path='dir2/file6', size=3),
+            FileInfo(path='dir1/file1', length=13),
+            FileInfo(path='dir1/file2', length=5),
+            FileInfo(path='dir1/file3', length=6),
+            FileInfo(path='file4', length=20),
+            FileInfo(path='dir2/file5', length=6),
+            FileInfo(path='dir2/file6', length=3),
         ]
         self.createTestPiece(0, b'\x00' * 10)
         self.createTestPiece(1, b'\x01' * 10)
@@ -98,7 +207,7 @@ class StorageTests(unittest.TestCase):
         self.createTestPiece(4, b'\x04' * 10)
         self.createTestPiece(5, b'\x05' * 3)
 
-        self.loop.run_until_complete(self.storage_handler.compose_files(file_infos))
+        self.loop.run_until_complete(self.storage_handler.compose_files(file_infos, 10))
 
         with open(os.path.join(self.storage_handler._path, 'dir1/file1'), 'rb') as f:
             self.assertEqual(f.read(), b'\x00' * 10 + b'\x01' * 3)
@@ -112,3 +221,58 @@ class StorageTests(unittest.TestCase):
             self.assertEqual(f.read(), b'\x04' * 6)
         with open(os.path.join(self.storage_handler._path, 'dir2/file6'), 'rb') as f:
             self.assertEqual(f.read(), b'\x05' * 3)
+
+    def test_retrieve_is_not_held_up_by_compose(self):
+        for i in range(6):
+            self.createTestPiece(i, b'data')
+        compose_started = threading.Event()
+        release_compose = threading.Event()
+
+        def slow_compose(*args):
+            compose_started.set()
+            release_compose.wait(5)
+
+        self.storage_handler._compose_files = slow_compose
+
+        async def retrieve_during_compose():
+            compose = self.loop.create_task(self.storage_handler.compose_files([], 4))
+            # More operations than workers, so batching would put some of them with compose
+            retrieves = asyncio.gather(*(self.storage_handler.retrieve(i) for i in range(6)))
+            try:
+                self.assertEqual(await asyncio.wait_for(retrieves, 1), [b'data'] * 6)
+                self.assertTrue(compose_started.is_set())
+                self.assertFalse(compose.done())
+            finally:
+                release_compose.set()
+            await compose
+
+        self.loop.run_until_complete(retrieve_during_compose())
+
+    def test_compose_selected_files(self):
+        file_infos = [
+            FileInfo(path='file1', length=13),
+            FileInfo(path='file2', length=15),
+            FileInfo(path='file3', length=12),
+        ]
+        selection = FileSelection(file_infos, 10, 4)
+        selection.set_file_priority(0, FilePriority.SKIP)
+        selection.set_file_priority(2, FilePriority.SKIP)
+        self.createTestPiece(1, b'\x01' * 10)
+        self.createTestPiece(2, b'\x02' * 10)
+
+        self.loop.run_until_complete(self.storage_handler.compose_files(file_infos, 10, selection))
+
+        self.assertFalse(os.path.exists(os.path.join(self.storage_handler._path, 'file1')))
+        self.assertFalse(os.path.exists(os.path.join(self.storage_handler._path, 'file3')))
+        with open(os.path.join(self.storage_handler._path, 'file2'), 'rb') as f:
+            self.assertEqual(f.read(), b'\x01' * 7 + b'\x02' * 8)
+
+    def test_compose_fails_on_missing_piece(self):
+        file_infos = [FileInfo(path='file1', length=15)]
+        self.createTestPiece(0, b'\x00' * 10)
+
+        with self.assertRaises(StorageError):
+            self.loop.run_until_complete(self.storage_handler.compose_files(file_infos, 10))
+
+        # Neither a partial file nor its temp file is left behind
+        self.assertEqual(sorted(os.listdir(os.path.join(self.TEST_PATH, 'test_download'))), ['.pieces'])
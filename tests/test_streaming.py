@@ -0,0 +1,72 @@
+import asyncio
+import os
+import shutil
+import unittest
+
+from pyrrent.metafile import Metafile, FileInfo, Piece
+from pyrrent.selection import FileSelection, FilePriority
+from pyrrent.storage import Storage
+from pyrrent.streaming import open_stream, StreamError
+
+
+class StreamingTests(unittest.TestCase):
+    TEST_PATH = '/tmp/pyrrent/tests/streaming'
+
+
+    def setUp(self):
+        if os.path.exists(self.TEST_PATH):
+            shutil.rmtree(self.TEST_PATH)
+        self.loop = asyncio.get_event_loop()
+        storage = Storage.prepare(self.TEST_PATH)
+        self.storage_handler = storage.create_handler_for_download('test_download')
+        files = [FileInfo('file1', 13), FileInfo('file2', 22), FileInfo('file3', 5)]
+        pieces = [Piece(i, b'\x00' * 20, 10) for i in range(4)]
+        self.metafile = Metafile(b'\x00' * 20, 'http://tracker/announce', pieces, files)
+        self.selection = FileSelection(files, 10, 4)
+
+    def store(self, piece_index):
+        data = bytes([piece_index]) * 10
+        self.loop.run_until_complete(self.storage_handler.store(piece_index, data))
+
+    def test_read_stored_pieces(self):
+        for piece_index in range(4):
+            self.store(piece_index)
+        stream = self.loop.run_until_complete(open_stream(self.storage_handler, self.metafile, 1))
+
+        self.assertEqual(stream.length, 22)
+        self.assertEqual(self.loop.run_until_complete(stream.read(4)), b'\x01' * 4)
+        self.assertEqual(self.loop.run_until_complete(stream.read()), b'\x01' * 3 + b'\x02' * 10 + b'\x03' * 5)
+        self.assertEqual(self.loop.run_until_complete(stream.read()), b'')
+
+        stream.seek(-2, os.SEEK_END)
+        self.assertEqual(self.loop.run_until_complete(stream.read(100)), b'\x03' * 2)
+        self.assertEqual(stream.tell(), 22)
+
+    def test_read_waits_for_pieces(self):
+        self.store(1)
+        self.selection.set_file_priority(1, FilePriority.SKIP)
+        stream = self.loop.run_until_complete(open_stream(self.storage_handler, self.metafile, 1,
+                                                          self.selection, readahead=2))
+        self.assertTrue(self.selection.is_file_wanted(1))
+
+        read_task = self.loop.create_task(stream.read(10))
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertFalse(read_task.done())
+        self.assertEqual(self.selection.get_wanted_pieces()[:2], [2, 3])
+
+        self.store(2)
+        data = self.loop.run_until_complete(read_task)
+
+        self.assertEqual(data, b'\x01' * 7 + b'\x02' * 3)
+        self.assertEqual(self.selection.get_wanted_pieces()[:2], [2, 3])
+
+        stream.close()
+        self.assertEqual(self.selection.get_wanted_pieces(), [0, 1, 2, 3])
+
+    def test_invalid_stream(self):
+        with self.assertRaises(StreamError):
+            self.loop.run_until_complete(open_stream(self.storage_handler, self.metafile, 3))
+
+        stream = self.loop.run_until_complete(open_stream(self.storage_handler, self.metafile, 0))
+        with self.assertRaises(StreamError):
+            stream.seek(-1)
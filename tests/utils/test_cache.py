@@ -36,3 +36,31 @@ class CacheTests(unittest.TestCase):
         self.assertEqual(cache.get(8), 64)
         self.assertEqual(cache.get(9), 81)
         self.assertEqual(cache.get(10), 100)
+
+    def test_purge_small_cache(self):
+        cache = Cache(1)
+
+        cache.put(0, 0)
+        cache.put(1, 1)
+
+        self.assertEqual(len(cache._records), 1)
+        self.assertIsNone(cache.get(0))
+        self.assertEqual(cache.get(1), 1)
+
+    def test_max_bytes(self):
+        cache = Cache(10, max_bytes=10)
+
+        cache.put(0, b'abcd')
+        cache.put(1, b'efgh')
+        cache.get(0)
+        cache.put(2, b'ijkl')
+
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.get(0), b'abcd')
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(2), b'ijkl')
+
+        # Records larger than the whole cache are not kept
+        cache.put(3, b'x' * 11)
+        self.assertIsNone(cache.get(3))
+        self.assertEqual(cache.size, 8)
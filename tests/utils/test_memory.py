@@ -0,0 +1,108 @@
+import asyncio
+import unittest
+
+from pyrrent.utils.cache import Cache
+from pyrrent.utils.memory import MemoryBudget, MemoryBudgetError
+
+
+class MemoryBudgetTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_usage_by_subsystem(self):
+        budget = MemoryBudget(1000, loop=self.loop)
+
+        budget.allocate('piece_cache', 300)
+        self.assertTrue(budget.try_allocate('receive_buffers', 200))
+        budget.release('piece_cache', 100)
+
+        self.assertEqual(budget.usage(), {'piece_cache': 200, 'receive_buffers': 200})
+        self.assertEqual(budget.used, 400)
+        self.assertEqual(budget.available, 600)
+
+        with self.assertRaises(MemoryBudgetError):
+            budget.release('receive_buffers', 300)
+
+    def test_try_allocate_fails_when_full(self):
+        budget = MemoryBudget(1000, loop=self.loop)
+
+        self.assertTrue(budget.try_allocate('receive_buffers', 800))
+        self.assertFalse(budget.try_allocate('receive_buffers', 300))
+        self.assertEqual(budget.used, 800)
+
+    def test_caches_are_shrunk_under_pressure(self):
+        budget = MemoryBudget(1000, high_watermark=0.9, low_watermark=0.5, loop=self.loop)
+        cache = Cache(100, budget=budget, subsystem='piece_cache')
+
+        for i in range(9):
+            cache.put(i, b'x' * 100)
+        self.assertEqual(budget.usage(), {'piece_cache': 900})
+
+        cache.put(9, b'x' * 100)
+
+        # Oldest records made way down to the low watermark, newest one is kept
+        self.assertEqual(budget.used, 500)
+        self.assertEqual(cache.size, 500)
+        self.assertIsNone(cache.get(0))
+        self.assertIsNotNone(cache.get(9))
+
+        # Allocations that must fit take memory from caches
+        self.assertTrue(budget.try_allocate('write_queue', 800))
+        self.assertEqual(budget.usage(), {'write_queue': 800})
+        self.assertEqual(cache.size, 0)
+
+        cache.close()
+        self.assertEqual(budget.used, 800)
+
+    def test_reserve_waits_for_release(self):
+        budget = MemoryBudget(1000, loop=self.loop)
+        budget.allocate('write_queue', 900)
+        order = []
+
+        async def reserve(name, size):
+            await budget.reserve(name, size)
+            order.append(name)
+
+        async def run():
+            first = self.loop.create_task(reserve('first', 500))
+            second = self.loop.create_task(reserve('second', 50))
+            await asyncio.sleep(0.01)
+            # Smaller reservation that would fit still waits its turn
+            self.assertEqual(order, [])
+
+            budget.release('write_queue', 900)
+            await asyncio.gather(first, second)
+
+        self.loop.run_until_complete(run())
+
+        self.assertEqual(order, ['first', 'second'])
+        self.assertEqual(budget.usage(), {'first': 500, 'second': 50})
+
+    def test_cancelled_reserve_lets_others_through(self):
+        budget = MemoryBudget(1000, loop=self.loop)
+        budget.allocate('write_queue', 600)
+
+        async def run():
+            blocked = self.loop.create_task(budget.reserve('big', 900))
+            small = self.loop.create_task(budget.reserve('small', 300))
+            await asyncio.sleep(0.01)
+            blocked.cancel()
+            await asyncio.wait_for(small, 1)
+
+        self.loop.run_until_complete(run())
+
+        self.assertEqual(budget.usage(), {'write_queue': 600, 'small': 300})
+
+    def test_oversized_reservation_passes_when_empty(self):
+        budget = MemoryBudget(1000, loop=self.loop)
+
+        self.loop.run_until_complete(asyncio.wait_for(budget.reserve('write_queue', 2000), 1))
+
+        self.assertEqual(budget.used, 2000)
+        self.assertTrue(budget.under_pressure)
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(MemoryBudgetError):
+            MemoryBudget(0, loop=self.loop)
+        with self.assertRaises(MemoryBudgetError):
+            MemoryBudget(1000, high_watermark=0.5, low_watermark=0.8, loop=self.loop)
@@ -0,0 +1,102 @@
+import asyncio
+import unittest
+
+from pyrrent.utils.metrics import MetricsRegistry, MetricsExporter
+
+
+_METRICS_EXPORTER_PORT = 30702
+
+
+class MetricsRegistryTests(unittest.TestCase):
+    def test_disabled_registry_ignores_updates(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('requests_total')
+        histogram = registry.histogram('duration_seconds', buckets=(1, 2))
+
+        counter.inc()
+        histogram.observe(1)
+        with histogram.time():
+            pass
+
+        self.assertEqual(registry.snapshot(), {
+            'requests_total': 0,
+            'duration_seconds': {'buckets': {1: 0, 2: 0, '+Inf': 0}, 'sum': 0, 'count': 0},
+        })
+
+    def test_gauges_track_level_while_disabled(self):
+        registry = MetricsRegistry()
+        gauge = registry.gauge('in_flight')
+
+        gauge.inc(2)
+        registry.enabled = True
+        gauge.dec()
+
+        self.assertEqual(registry.snapshot(), {'in_flight': 1})
+
+    def test_enabled_registry(self):
+        registry = MetricsRegistry(enabled=True)
+        counter = registry.counter('requests_total', labels={'tracker': 'a'})
+        gauge = registry.gauge('in_flight')
+        histogram = registry.histogram('duration_seconds', buckets=(1, 2))
+
+        counter.inc()
+        counter.inc(2)
+        gauge.inc(3)
+        gauge.dec()
+        for value in (0.5, 1, 1.5, 3):
+            histogram.observe(value)
+
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['requests_total{tracker="a"}'], 3)
+        self.assertEqual(snapshot['in_flight'], 2)
+        self.assertEqual(snapshot['duration_seconds'], {'buckets': {1: 2, 2: 1, '+Inf': 1}, 'sum': 6, 'count': 4})
+
+    def test_same_metric_returned_for_same_name(self):
+        registry = MetricsRegistry()
+
+        self.assertIs(registry.counter('requests_total'), registry.counter('requests_total'))
+        self.assertIsNot(registry.counter('requests_total'),
+                         registry.counter('requests_total', labels={'tracker': 'a'}))
+        with self.assertRaises(ValueError):
+            registry.gauge('requests_total')
+
+    def test_render_prometheus(self):
+        registry = MetricsRegistry(enabled=True)
+        registry.counter('requests_total', 'Requests', labels={'tracker': 'a'}).inc()
+        registry.histogram('duration_seconds', 'Duration', buckets=(1,)).observe(0.5)
+
+        self.assertEqual(registry.render_prometheus(), (
+            '# HELP duration_seconds Duration\n'
+            '# TYPE duration_seconds histogram\n'
+            'duration_seconds_bucket{le="1"} 1\n'
+            'duration_seconds_bucket{le="+Inf"} 1\n'
+            'duration_seconds_sum 0.5\n'
+            'duration_seconds_count 1\n'
+            '# HELP requests_total Requests\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{tracker="a"} 1\n'
+        ))
+
+
+class MetricsExporterTests(unittest.TestCase):
+    def test_serves_metrics(self):
+        loop = asyncio.get_event_loop()
+        registry = MetricsRegistry(enabled=True)
+        registry.counter('requests_total').inc()
+        exporter = MetricsExporter(registry, port=_METRICS_EXPORTER_PORT)
+        loop.run_until_complete(exporter.start())
+
+        async def get(path):
+            reader, writer = await asyncio.open_connection('127.0.0.1', _METRICS_EXPORTER_PORT)
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+            response = await reader.read()
+            writer.close()
+            return response
+
+        response = loop.run_until_complete(get('/metrics'))
+        not_found_response = loop.run_until_complete(get('/other'))
+        exporter.stop()
+
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 OK'))
+        self.assertTrue(response.endswith(b'requests_total 1\n'))
+        self.assertTrue(not_found_response.startswith(b'HTTP/1.1 404'))